@@ -0,0 +1,434 @@
+#bench_load.py
+"""Load generator for a running indexer server.  Opens many persistent
+connections at once from a single thread (using epoll/poll, so that the
+client side doesn't need a thread per connection), then has every connection
+issue a configurable mix of INDEX, REMOVE and QUERY requests, one at a time
+(closed loop), optionally paced to a target total rate, and reports
+throughput and latency percentiles, optionally saved as JSON.
+Usage: python bench_load.py <ip> <port> [connection counts...] [--mix=<mix>]
+         [--rate=<req/s>] [--duration=<secs>] [--warmup=<secs>]
+         [--packages=<n>] [--deps=<n>] [--seed=<n>] [--output=<file.json>]"""
+
+import sys
+import json
+import time
+import errno
+import heapq
+import bisect
+import random
+import select
+import socket
+import resource
+from collections import deque
+
+NUM_ARGS= 2
+MAX_PKT_BYTES= 1024
+MAX_CONNECTING= 200     #max connections in the middle of their handshake at once
+                        #NOTE: keeps the server's listen queue from overflowing
+TIMEOUT_SECS= 60.0
+MAX_POLL_SECS= 0.1
+PRELOAD_CHUNK= 1000     #preload commands pipelined per round trip
+
+MIX_COMMANDS= ("INDEX", "REMOVE", "QUERY")
+DEFAULT_OPTIONS= {
+    "mix": "query:8,index:1,remove:1",
+    "rate": "0",            #total requests/s over all connections; 0 for as fast as possible
+    "duration": "10",
+    "warmup": "1",          #secs at the start whose requests aren't measured
+    "packages": "10000",    #preloaded packages that QUERYs and new INDEXes' deps pick from
+    "deps": "3",            #max deps of each preloaded or newly indexed package
+    "seed": "0",
+    "output": None
+}
+PERCENTILES= [("p50", 0.5), ("p99", 0.99), ("p999", 0.999)]
+
+RESP_OK= "OK\n"
+RESP_FAIL= "FAIL\n"
+RESP_ERR= "ERROR\n"
+
+
+#------------------------- Load Driver ---------------------------
+class Workload(object):
+    def __init__(self, mix, numPackages, maxDeps):
+        """Class to model what the connections send: <mix> is a dict of
+             command name->relative weight, the preloaded packages are named
+             base0 to base<numPackages-1>, and every INDEX has up to
+             <maxDeps> of them as deps."""
+        self.commands= sorted(mix)
+        self.cumulativeWeights= []
+        total= 0
+        for cmd in self.commands:
+            total+= mix[cmd]
+            self.cumulativeWeights.append(total)
+        self.numPackages= numPackages
+        self.maxDeps= maxDeps
+
+    def pickCommand(self, rnd):
+        """Returns: name of a random command, with the mix's weights."""
+        point= rnd.random() * self.cumulativeWeights[-1]
+        return self.commands[bisect.bisect_right(self.cumulativeWeights, point)]
+
+    def pickDeps(self, rnd, limit):
+        """Returns: list of up to maxDeps distinct random preloaded packages
+             out of the first <limit>."""
+        if limit == 0:
+            return []
+        numDeps= rnd.randint(0, self.maxDeps)
+        return list(set(["base%d" % rnd.randrange(limit) for i in range(numDeps)]))
+
+    def getPreloadLines(self, rnd):
+        """Returns: list of INDEX lines for every preloaded package, each one
+             after its deps."""
+        return ["INDEX|base%d|%s\n" % (i, ",".join(self.pickDeps(rnd, i)))
+            for i in xrange(self.numPackages)]
+
+
+class Connection(object):
+    def __init__(self, connId, sock, runId, seed):
+        """Class to model one client connection and its request progress.
+             Each connection INDEXes and REMOVEs packages of its own (named
+             after <runId> and <connId>), so that all of its requests should
+             succeed no matter what the other connections do."""
+        self.connId= connId
+        self.sock= sock
+        self.prefix= "load%d-%d-" % (runId, connId)
+        self.rnd= random.Random("%d-%d-%d" % (seed, runId, connId))
+        self.numCreated= 0
+        self.ownPackages= deque()
+        self.pending= None
+        self.dueTimestamp= 0.0
+        self.inBuf= ""
+
+    def nextRequest(self, workload):
+        """Picks this connection's next command, and records it as pending.
+           Returns: str of the command line to send."""
+        cmd= workload.pickCommand(self.rnd)
+        deps= []
+        if cmd == "INDEX":
+            pkg= self.prefix + str(self.numCreated)
+            self.numCreated+= 1
+            deps= workload.pickDeps(self.rnd, workload.numPackages)
+        elif cmd == "REMOVE":
+            #Nothing depends on a connection's own packages, so removing the
+            #oldest one succeeds (as does removing one that was never indexed)
+            if len(self.ownPackages) > 0:
+                pkg= self.ownPackages.popleft()
+            else:
+                pkg= self.prefix + "none"
+        else:
+            pkg= "base%d" % self.rnd.randrange(workload.numPackages)
+        self.pending= (cmd, pkg)
+        return "%s|%s|%s\n" % (cmd, pkg, ",".join(deps))
+
+
+class LoadRun(object):
+    def __init__(self, ip, port, numConns, runId, workload, options):
+        """Class to model one load test: <numConns> connections, each one
+             sending its next request as soon as it gets the response to the
+             last one, or at its next slot if the run is paced to a rate.
+           Precondition: options is a dict of parsed options (see parseArgs)."""
+        self.ip= ip
+        self.port= port
+        self.numConns= numConns
+        self.runId= runId
+        self.workload= workload
+        self.options= options
+        self.conns= {}
+        self.dueHeap= []
+        self.latencies= dict((cmd, []) for cmd in MIX_COMMANDS)
+        self.numFails= dict((cmd, 0) for cmd in MIX_COMMANDS)
+        self.numErrors= 0
+        if hasattr(select, "epoll"):
+            self.poller= select.epoll()
+            self.pollUnitsPerSec= 1.0
+        else:
+            self.poller= select.poll()
+            self.pollUnitsPerSec= 1000.0
+
+    def connectAll(self):
+        """Opens every connection, keeping at most MAX_CONNECTING in flight.
+           Returns: number of connections that failed to open."""
+        numFailed= 0
+        connecting= {}
+        nextConnId= 0
+        deadline= time.time() + TIMEOUT_SECS
+        while (nextConnId < self.numConns or connecting) and time.time() < deadline:
+            while nextConnId < self.numConns and len(connecting) < MAX_CONNECTING:
+                sock= socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                sock.connect_ex((self.ip, self.port))
+                connecting[sock.fileno()]= Connection(nextConnId, sock, self.runId,
+                    self.options["seed"])
+                self.poller.register(sock.fileno(), select.POLLOUT)
+                nextConnId+= 1
+            for (fd, eventMask) in self.poller.poll(MAX_POLL_SECS * self.pollUnitsPerSec):
+                if fd not in connecting:
+                    continue
+                conn= connecting.pop(fd)
+                if conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                    self.poller.unregister(fd)
+                    conn.sock.close()
+                    numFailed+= 1
+                    continue
+                self.poller.modify(fd, select.POLLIN)
+                self.conns[fd]= conn
+        numFailed+= len(connecting)
+        return numFailed
+
+    def sendNext(self, conn):
+        """Sends <conn>'s next request.  Its latency is timed from when it was
+             due, not from when it was sent, so that a slow server delaying a
+             paced connection's requests can't hide that delay (coordinated
+             omission)."""
+        conn.sock.sendall(conn.nextRequest(self.workload))
+
+    def scheduleNext(self, conn, now, interval):
+        """Sets when <conn> is due to send its next request, and sends it at
+             once if that's already past."""
+        if interval == 0.0:
+            conn.dueTimestamp= now
+        else:
+            conn.dueTimestamp+= interval
+            if conn.dueTimestamp > now:
+                heapq.heappush(self.dueHeap, (conn.dueTimestamp, conn.sock.fileno()))
+                return
+        self.sendNext(conn)
+
+    def sendDue(self, now):
+        """Sends the request of every connection that is due by <now>.
+           Returns: secs until the next connection is due, at most MAX_POLL_SECS."""
+        while len(self.dueHeap) > 0 and self.dueHeap[0][0] <= now:
+            (dueTimestamp, fd)= heapq.heappop(self.dueHeap)
+            if fd in self.conns:
+                self.sendNext(self.conns[fd])
+        if len(self.dueHeap) == 0:
+            return MAX_POLL_SECS
+        return min(MAX_POLL_SECS, self.dueHeap[0][0] - now)
+
+    def run(self):
+        """Opens all connections, then drives them for the run's warmup and
+             duration, and lets each finish its last request.
+           Returns: tuple of (connect failures, measured secs)."""
+        numFailed= self.connectAll()
+        interval= 0.0
+        if self.options["rate"] > 0:
+            interval= len(self.conns) / self.options["rate"]
+        start= time.time()
+        measureFrom= start + self.options["warmup"]
+        stopAt= measureFrom + self.options["duration"]
+        for conn in self.conns.values():
+            if interval == 0.0:
+                conn.dueTimestamp= start
+                self.sendNext(conn)
+            else:
+                #Spread the paced connections' slots over the interval, not all at once
+                conn.dueTimestamp= start + conn.rnd.random() * interval
+                heapq.heappush(self.dueHeap, (conn.dueTimestamp, conn.sock.fileno()))
+        deadline= stopAt + TIMEOUT_SECS
+        pollSecs= MAX_POLL_SECS
+        while self.conns and time.time() < deadline:
+            for (fd, eventMask) in self.poller.poll(pollSecs * self.pollUnitsPerSec):
+                if fd not in self.conns:
+                    continue
+                conn= self.conns[fd]
+                try:
+                    data= conn.sock.recv(MAX_PKT_BYTES)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue
+                    data= ""
+                if len(data) == 0:
+                    self.numErrors+= 1
+                    self.closeConn(conn)
+                    continue
+                conn.inBuf+= data
+                if not conn.inBuf.endswith("\n"):
+                    continue
+                now= time.time()
+                self.handleResponse(conn, now, measureFrom <= conn.dueTimestamp < stopAt)
+                if now >= stopAt:
+                    self.closeConn(conn)
+                else:
+                    self.scheduleNext(conn, now, interval)
+            pollSecs= self.sendDue(time.time())
+        for conn in self.conns.values():
+            self.numErrors+= 1
+            self.closeConn(conn)
+        return (numFailed, self.options["duration"])
+
+    def handleResponse(self, conn, now, isMeasured):
+        """Checks and records the response in <conn>'s input buffer, to its
+             pending request."""
+        (cmd, pkg)= conn.pending
+        (response, conn.inBuf)= (conn.inBuf, "")
+        if cmd == "INDEX" and response == RESP_OK:
+            conn.ownPackages.append(pkg)
+        if not isMeasured:
+            return
+        self.latencies[cmd].append(now - conn.dueTimestamp)
+        if response == RESP_FAIL:
+            self.numFails[cmd]+= 1
+        elif response != RESP_OK:
+            self.numErrors+= 1
+
+    def closeConn(self, conn):
+        """Unregisters and closes <conn>'s socket."""
+        fd= conn.sock.fileno()
+        del self.conns[fd]
+        self.poller.unregister(fd)
+        conn.sock.close()
+
+
+def preload(ip, port, workload, seed):
+    """INDEXes every preloaded package of <workload> over one connection,
+         pipelining PRELOAD_CHUNK commands per round trip.
+       Returns: number of packages that didn't get an OK."""
+    lines= workload.getPreloadLines(random.Random(seed))
+    sock= socket.create_connection((ip, port), TIMEOUT_SECS)
+    numFailed= 0
+    try:
+        reader= sock.makefile("rb")
+        for i in xrange(0, len(lines), PRELOAD_CHUNK):
+            chunk= lines[i:i+PRELOAD_CHUNK]
+            sock.sendall("".join(chunk))
+            for line in chunk:
+                if reader.readline() != RESP_OK:
+                    numFailed+= 1
+    finally:
+        sock.close()
+    return numFailed
+
+
+#-------------------------- Reporting ----------------------------
+def getPercentile(sortedSamples, fraction):
+    """Returns: the sample at <fraction> of the way through <sortedSamples>."""
+    if len(sortedSamples) == 0:
+        return 0.0
+    return sortedSamples[min(len(sortedSamples) - 1, int(len(sortedSamples) * fraction))]
+
+
+def getLatencyStats(samples):
+    """Returns: dict of latency stat name->ms, for the secs in <samples>.
+       Precondition: samples is sorted."""
+    stats= dict((name, getPercentile(samples, fraction) * 1000)
+        for (name, fraction) in PERCENTILES)
+    stats["max"]= samples[-1] * 1000 if len(samples) > 0 else 0.0
+    stats["mean"]= sum(samples) / len(samples) * 1000 if len(samples) > 0 else 0.0
+    return stats
+
+
+def getRunResults(loadRun, numFailed, elapsed):
+    """Returns: dict of the results of the finished <loadRun>, as saved to JSON."""
+    commands= {}
+    for cmd in MIX_COMMANDS:
+        samples= sorted(loadRun.latencies[cmd])
+        if len(samples) == 0:
+            continue
+        commands[cmd]= {"requests": len(samples), "fails": loadRun.numFails[cmd],
+            "latencyMs": getLatencyStats(samples)}
+    samples= sorted(sum(loadRun.latencies.values(), []))
+    return {
+        "connections": loadRun.numConns,
+        "connectFailures": numFailed,
+        "requests": len(samples),
+        "fails": sum(loadRun.numFails.values()),
+        "errors": loadRun.numErrors,
+        "measuredSecs": elapsed,
+        "throughput": len(samples) / elapsed,
+        "latencyMs": getLatencyStats(samples),
+        "commands": commands
+    }
+
+
+#---------------------- Script Functions -------------------------
+def showUsage():
+    print "Usage: python bench_load.py <ip> <port> [connection counts...] [--mix=<mix>]"
+    print "         [--rate=<req/s>] [--duration=<secs>] [--warmup=<secs>]"
+    print "         [--packages=<n>] [--deps=<n>] [--seed=<n>] [--output=<file.json>]"
+    print "  <mix> is a list of command:weight, eg: %s" % DEFAULT_OPTIONS["mix"]
+
+
+def parseMix(s):
+    """Returns: dict of command name->weight for the mix <s>, eg:
+         "query:8,index:1,remove:1"; None if it's malformed."""
+    mix= {}
+    for item in s.split(","):
+        fields= item.split(":")
+        if len(fields) != 2 or fields[0].upper() not in MIX_COMMANDS or not fields[1].isdigit():
+            return None
+        mix[fields[0].upper()]= int(fields[1])
+    if sum(mix.values()) == 0:
+        return None
+    return mix
+
+
+def parseArgs():
+    """Returns: tuple of (ip, port, list of connection counts, dict of option
+         name->value); None if any argument is malformed."""
+    positional= [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options= dict(DEFAULT_OPTIONS)
+    for arg in sys.argv[1:]:
+        if not arg.startswith("--"):
+            continue
+        if "=" not in arg or arg[2:].split("=", 1)[0] not in options:
+            return None
+        (name, value)= arg[2:].split("=", 1)
+        options[name]= value
+    try:
+        assert(len(positional) >= NUM_ARGS)
+        socket.inet_aton(positional[0])
+        port= int(positional[1])
+        connCounts= [int(arg) for arg in positional[2:]] or [1000, 10000]
+        options["mix"]= parseMix(options["mix"])
+        for name in ("rate", "duration", "warmup"):
+            options[name]= float(options[name])
+        for name in ("packages", "deps", "seed"):
+            options[name]= int(options[name])
+        assert(options["mix"] != None and options["packages"] > 0 and options["duration"] > 0)
+        assert(min(connCounts) > 0 and min(options["rate"], options["warmup"], options["deps"]) >= 0)
+    except:
+        return None
+    return (positional[0], port, connCounts, options)
+
+
+def main():
+    args= parseArgs()
+    if args == None:
+        showUsage()
+        sys.exit(2)
+    (ip, port, connCounts, options)= args
+    #Every connection needs its own fd, so lift the soft limit as far as allowed
+    (softLimit, hardLimit)= resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hardLimit, hardLimit))
+    workload= Workload(options["mix"], options["packages"], options["deps"])
+    print "Preloading %d packages..." % options["packages"]
+    numPreloadFails= preload(ip, port, workload, options["seed"])
+    if numPreloadFails > 0:
+        print "Warning: %d preloaded packages didn't get an OK" % numPreloadFails
+    print "%12s %10s %10s %8s %8s %10s %10s %10s %10s" % ("connections", "conn fails",
+        "requests", "fails", "errors", "req/s", "p50 (ms)", "p99 (ms)", "p999 (ms)")
+    runs= []
+    #Each run gets its own id, so its connections' packages are new ones
+    runId= int(time.time())
+    for numConns in connCounts:
+        loadRun= LoadRun(ip, port, numConns, runId, workload, options)
+        (numFailed, elapsed)= loadRun.run()
+        results= getRunResults(loadRun, numFailed, elapsed)
+        runs.append(results)
+        latency= results["latencyMs"]
+        print "%12d %10d %10d %8d %8d %10.0f %10.2f %10.2f %10.2f" % (numConns, numFailed,
+            results["requests"], results["fails"], results["errors"], results["throughput"],
+            latency["p50"], latency["p99"], latency["p999"])
+        runId+= 1
+    if options["output"] != None:
+        config= dict(options)
+        del config["output"]
+        report= {"server": "%s:%d" % (ip, port), "timestamp": time.time(),
+            "config": config, "runs": runs}
+        with open(options["output"], "w") as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+        print "Saved results to %s" % options["output"]
+
+
+if __name__ == "__main__":
+    main()
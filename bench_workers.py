@@ -0,0 +1,165 @@
+#bench_workers.py
+"""QUERY throughput of the multi-process server.  For each worker count, starts
+an indexer server with --workers=<n> on localhost, preloaded with a manifest
+of packages, then drives it from several client processes that pipeline
+QUERYs over persistent connections, and reports QUERY/s.
+Usage: python bench_workers.py [worker counts...]"""
+
+import os
+import sys
+import time
+import errno
+import random
+import socket
+import tempfile
+import subprocess
+
+import indexer
+
+NUM_PACKAGES= 10000
+NUM_CLIENT_PROCS= 8         #client processes, so the client side isn't the bottleneck
+CONNS_PER_CLIENT= 4
+PIPELINE_DEPTH= 64          #QUERYs sent on a connection before reading their responses
+DURATION_SECS= 5.0
+STARTUP_TIMEOUT_SECS= 30.0
+
+SERVER_PATH= os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexer.py")
+
+
+#------------------------- Load Driver ---------------------------
+def writeManifest(path):
+    """Writes a random manifest of NUM_PACKAGES packages to <path>, for --load."""
+    rnd= random.Random(NUM_PACKAGES)
+    with open(path, "w") as manifest:
+        for i in xrange(NUM_PACKAGES):
+            deps= []
+            if i > 0:
+                deps= set(["pkg%d" % rnd.randrange(i) for j in range(rnd.randint(0, 5))])
+            manifest.write("INDEX|pkg%d|%s\n" % (i, ",".join(deps)))
+
+
+def startServer(numWorkers, manifestPath, logPath):
+    """Starts a server with <numWorkers> workers, and waits until every one
+         of them is accepting clients.
+       Returns: the server's subprocess.Popen object."""
+    cmd= [sys.executable, SERVER_PATH, "--localhost", "--workers=%d" % numWorkers,
+        "--load=%s" % manifestPath]
+    with open(logPath, "w") as log:
+        server= subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    deadline= time.time() + STARTUP_TIMEOUT_SECS
+    while time.time() < deadline:
+        with open(logPath) as log:
+            if log.read().count(" serving on ") == numWorkers:
+                return server
+        time.sleep(0.1)
+    server.kill()
+    raise Exception("server didn't start its workers, see %s" % logPath)
+
+
+def stopServer(server):
+    """Kills <server>, and waits until its workers have closed the port (they
+         exit once they lose the writer), so they can't take the next run's
+         connections."""
+    server.kill()
+    server.wait()
+    deadline= time.time() + STARTUP_TIMEOUT_SECS
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", indexer.PORT_LISTEN)).close()
+        except socket.error as e:
+            if e.errno == errno.ECONNREFUSED:
+                return
+        time.sleep(0.1)
+
+
+def runClient(clientId, stopAt):
+    """Sends QUERYs of random packages on CONNS_PER_CLIENT connections until
+         <stopAt>, a burst of PIPELINE_DEPTH at a time on each.
+       Returns: number of QUERYs answered."""
+    rnd= random.Random(clientId)
+    socks= [socket.create_connection(("127.0.0.1", indexer.PORT_LISTEN))
+        for i in range(CONNS_PER_CLIENT)]
+    numAnswered= 0
+    while time.time() < stopAt:
+        for sock in socks:
+            sock.sendall("".join(["QUERY|pkg%d|\n" % rnd.randrange(NUM_PACKAGES)
+                for i in range(PIPELINE_DEPTH)]))
+        for sock in socks:
+            numLines= 0
+            while numLines < PIPELINE_DEPTH:
+                data= sock.recv(65536)
+                if len(data) == 0:
+                    raise Exception("server closed the connection")
+                numLines+= data.count("\n")
+        numAnswered+= PIPELINE_DEPTH * len(socks)
+    for sock in socks:
+        sock.close()
+    return numAnswered
+
+
+def measure():
+    """Returns: QUERY/s that NUM_CLIENT_PROCS client processes get out of the
+         running server in DURATION_SECS."""
+    stopAt= time.time() + DURATION_SECS
+    pipes= []
+    for clientId in range(NUM_CLIENT_PROCS):
+        (readFd, writeFd)= os.pipe()
+        if os.fork() == 0:
+            os.close(readFd)
+            numAnswered= -1
+            try:
+                numAnswered= runClient(clientId, stopAt)
+            finally:
+                os.write(writeFd, "%d\n" % numAnswered)
+                os._exit(0)
+        os.close(writeFd)
+        pipes.append(readFd)
+    total= 0
+    for readFd in pipes:
+        numAnswered= int(os.read(readFd, 64))
+        os.close(readFd)
+        os.wait()
+        if numAnswered < 0:
+            raise Exception("a client process failed")
+        total+= numAnswered
+    return total / DURATION_SECS
+
+
+#---------------------- Script Functions -------------------------
+def showUsage():
+    print "Usage: python bench_workers.py [worker counts...]"
+
+
+def argsValid():
+    try:
+        [int(arg) for arg in sys.argv[1:]]
+    except:
+        return False
+    return True
+
+
+def main():
+    workerCounts= [int(arg) for arg in sys.argv[1:]] or [1, 2, 4, 8]
+    (manifestFd, manifestPath)= tempfile.mkstemp(suffix=".manifest")
+    os.close(manifestFd)
+    logPath= manifestPath + ".log"
+    writeManifest(manifestPath)
+    print "%8s %12s" % ("workers", "QUERY/s")
+    try:
+        for numWorkers in workerCounts:
+            server= startServer(numWorkers, manifestPath, logPath)
+            try:
+                queriesPerSec= measure()
+            finally:
+                stopServer(server)
+            print "%8d %12.0f" % (numWorkers, queriesPerSec)
+    finally:
+        os.remove(manifestPath)
+        os.remove(logPath)
+
+
+if __name__ == "__main__":
+    if argsValid():
+        main()
+    else:
+        showUsage()
@@ -0,0 +1,96 @@
+#dump_index.py
+"""Streams a dump of a running indexer server's index (see DUMP in README) to
+stdout or a file, one package per line in install order, without holding the
+whole dump in memory on either end.
+Usage: python dump_index.py [--host=<ip>] [--port=<port>] [--index=<name>]
+         [--format=<native|ndjson>] [--output=<file>]"""
+
+import sys
+import socket
+
+import indexer
+
+DEFAULT_HOST= "127.0.0.1"
+
+
+#------------------------- Dump Client ---------------------------
+def readResponse(reader):
+    """Returns: the next response line from <reader>, without its newline.
+       Raises: Exception if the server closed the connection instead."""
+    line= reader.readline()
+    if not line.endswith("\n"):
+        raise Exception("server closed the connection")
+    return line[:-1]
+
+
+def dumpIndex(host, port, indexName, fmt, out):
+    """Dumps the index <indexName> (None for the default one) of the server at
+         <host>:<port> to the file <out>, in format <fmt>.
+       Returns: number of packages dumped."""
+    sock= socket.create_connection((host, port))
+    try:
+        reader= sock.makefile("rb", indexer.DUMP_CHUNK_BYTES)
+        if indexName != None:
+            sock.sendall("%s|%s|\n" % (indexer.USE_COMMAND, indexName))
+            response= readResponse(reader)
+            if response != indexer.RESP_OK.rstrip():
+                raise Exception("server refused index %s: %s" % (indexName, response))
+        sock.sendall("%s|%s|\n" % (indexer.DUMP_COMMAND, fmt))
+        #Package lines start with "INDEX|" or "{", so the last line can't be
+        #mistaken for one
+        while True:
+            line= readResponse(reader)
+            if line.startswith("OK|"):
+                return int(line[3:])
+            if line in (indexer.RESP_FAIL.rstrip(), indexer.RESP_ERR.rstrip()):
+                raise Exception("server failed the dump: %s" % line)
+            out.write(line + "\n")
+    finally:
+        sock.close()
+
+
+#---------------------- Script Functions -------------------------
+def showUsage():
+    print "Usage: python dump_index.py [--host=<ip>] [--port=<port>] [--index=<name>]"
+    print "         [--format=<native|ndjson>] [--output=<file>]"
+
+
+def parseArgs():
+    """Returns: dict of option name->value for every --name=value argument;
+         None if any argument is malformed."""
+    options= {"host": DEFAULT_HOST, "port": str(indexer.PORT_LISTEN), "index": None,
+        "format": "native", "output": None}
+    for arg in sys.argv[1:]:
+        if not arg.startswith("--") or "=" not in arg:
+            return None
+        (name, value)= arg[2:].split("=", 1)
+        if name not in options:
+            return None
+        options[name]= value
+    if not options["port"].isdigit() or options["format"] not in indexer.DUMP_FORMATS:
+        return None
+    return options
+
+
+def main():
+    options= parseArgs()
+    if options == None:
+        showUsage()
+        sys.exit(2)
+    out= sys.stdout
+    if options["output"] != None:
+        out= open(options["output"], "w")
+    try:
+        numPackages= dumpIndex(options["host"], int(options["port"]), options["index"],
+            options["format"], out)
+    except Exception as e:
+        sys.stderr.write("Dump failed: %s\n" % e)
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    sys.stderr.write("Dumped %d packages\n" % numPackages)
+
+
+if __name__ == "__main__":
+    main()
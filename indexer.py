@@ -2,23 +2,95 @@
 """Package Indexer server code.
 Usage: python indexer.py
 Optional Args:
-  --debug       prints various debug stats, such as the duration of each API call.
-  --localhost   sets the server's bound IP to localhost instead of the default network IP."""
+  --debug       prints a summary of the server's metrics (see STATS) every DEBUG_STATS_SECS.
+  --localhost   sets the server's bound IP to localhost instead of the default network IP.
+  --compact     stores the index in the compact integer-id backend instead of one object per package.
+  --concurrency=<global|rwlock|lockfree|fine>
+                how commands synchronize with each other (default: global, one lock for everything).
+  --shards=<k>  partitions the index into <k> shards by package name hash, each with its own lock.
+  --event-loop  serves all clients from one thread with a readiness loop, instead of a thread per client.
+  --load=<manifest>
+                bulk loads a file of "INDEX|pkg|deps" lines into the index before accepting clients.
+  --data-dir=<dir>
+                persists the index in <dir> (a snapshot plus a write-ahead log), and recovers it from there on startup.
+  --export=<file>
+                writes the index (eg: as loaded with --load or --data-dir) to a read-only base file and exits.
+  --base=<file> serves QUERYs straight from a memory map of a base file, with changes kept in memory.
+  --workers=<n> serves clients from <n> forked worker processes sharing the port (SO_REUSEPORT), which
+                answer QUERYs from replicas of the index and forward changes to this process.
+  --slowlog-ms=<ms>
+                logs every command that takes at least <ms> (default: SLOWLOG_MS), see SLOWLOG.
+  --metrics-port=<port>
+                serves the server's metrics as text to HTTP GETs on localhost:<port> (each worker
+                on <port> + its number).
+  --trace=<off|info|debug|trace>
+                writes the trace points up to that level as JSON lines (default: off), see TRACE.
+  --trace-file=<file>
+                appends the trace to <file> instead of stdout."""
 
+import gc
+import os
 import re
 import sys
+import json
 import time
+import errno
+import fcntl
+import select
+import signal
 import socket
-from threading import Lock, Thread
+import resource
+import tempfile
+from array import array
+from collections import OrderedDict, deque
+from threading import Condition, Lock, Thread
+
+import metrics
+import tracing
+import persistence
+from protocol import CommandParser
 
 #-------------------------- Constants -----------------------------
 PORT_LISTEN= 8080           #the TCP/IP port to bind to and wait for clients on
 MAX_QUEUED_CONNECTIONS= 100 #how many connection requests the server will queue before denying
                             #NOTE: this must be >= the test script's concurrency value
 MAX_SOCK_TIMEOUT_SECS= 30.0 #if client doesn't respond for this many secs, socket closed
-MAX_PKT_BYTES= 1024         #max bytes read from a packet at once
+MAX_PKT_BYTES= 65536        #max bytes read from a packet at once
+MAX_LINE_BYTES= 1024        #max bytes in a single command, including its newline
 MAX_SESSION_SECS= 120.0     #max total time the server will stay connected to one client
 MAX_ERRORS= 100000          #max bad requests server will tolerate b4 disconnecting
+EVENT_LOOP_SWEEP_SECS= 1.0  #how often the event loop server checks for idle clients
+COMPACT_MIN_OVERFLOW= 4096  #min dirty ids before the compact store rebuilds its arrays
+MAX_BATCH_COMMANDS= 100000  #batches longer than this are committed in chunks
+DUMP_CHUNK_BYTES= 65536     #a DUMP is written and relayed to the client this much at a time
+DEBUG_STATS_SECS= 10.0      #how often --debug prints the server's metrics
+SLOWLOG_MS= 100.0           #commands that take at least this long go in the slow log, unless --slowlog-ms says otherwise
+DEFAULT_NUM_SHARDS= 16      #partitions of a ShardedPackageIndex, unless --shards says otherwise
+CLOSURE_CACHE_MAX_NAMES= 1000000    #max package names held by an index's cached DEPS/RDEPS responses
+REACHABILITY_MIN_STALE= 1000       #loosened labels a reachability index tolerates before a rebuild...
+REACHABILITY_STALE_FRACTION= 0.25  #...or this fraction of its labels, if that's more
+MAX_NAMED_INDICES= 256      #max named indices open at once, each with its own index (and log)
+MAX_RESIDENT_PACKAGES= 5000000  #named indices with a data dir are evicted to stay under this
+SO_REUSEPORT= getattr(socket, "SO_REUSEPORT", 15)   #Python 2's socket module lacks it; 15 on Linux
+
+CONCURRENCY_MODES= ("global", "rwlock", "lockfree", "fine")
+
+BATCH_BEGIN= "BEGIN"
+BATCH_COMMIT= "COMMIT"
+USE_COMMAND= "USE"
+DUMP_COMMAND= "DUMP"
+STATS_COMMAND= "STATS"
+SLOWLOG_COMMAND= "SLOWLOG"
+PROFILE_COMMAND= "PROFILE"
+TRACE_COMMAND= "TRACE"
+DUMP_FORMATS= ("native", "ndjson")
+CASCADE_ORPHANS= "orphans"         #CASCADE option to also remove dependencies left with no dependees
+READ_COMMANDS= ("QUERY", "DEPS", "RDEPS", "DEPENDS")
+NO_EDGES= frozenset()              #shared by every IndexEntry with no edges in a direction
+
+DEFAULT_INDEX_NAME= "default"
+INDEX_NAME_PATTERN= r"^[A-Za-z0-9_][A-Za-z0-9_.-]{0,63}$"  #safe to use as a directory name
+NAMED_INDICES_DIR= "indices"
 
 RESP_OK= "OK\n"
 RESP_FAIL= "FAIL\n"
@@ -28,39 +100,126 @@ RESP_ERR= "ERROR\n"
 #------------------------- Global State ---------------------------
 isDebug= False
 useLocalhost= False
+useCompactStore= False
+concurrencyMode= "global"
+useEventLoop= False
+manifestPath= None
+dataDirPath= None
+exportPath= None
+basePath= None
+numWorkers= 0
+numShards= 0
+metricsPort= None
 index= None
+indexRegistry= None
+serverMetrics= metrics.ServerMetrics()
+slowLog= metrics.SlowLog(SLOWLOG_MS / 1000)
+profiler= None
+profilerLock= Lock()
 
 
 #--------------------------- Classes -----------------------------
 class PackageIndex(object):
-    def __init__(self):
-        """Class to serve as the representation of the package indexer."""
+    def __init__(self, concurrency="global"):
+        """Class to serve as the representation of the package indexer.
+           Precondition: concurrency is one of CONCURRENCY_MODES:
+             -global: every command holds the same lock
+             -rwlock: QUERYs share a reader lock, writers hold it exclusively
+             -lockfree: QUERYs take no lock at all, writers hold a global one"""
         self.commands= {
             "INDEX": self.handleIndex,
             "REMOVE": self.handleRemove,
-            "QUERY": self.handleQuery
+            "QUERY": self.handleQuery,
+            "DEPS": self.handleDeps,
+            "RDEPS": self.handleRdeps,
+            "DEPENDS": self.handleDepends,
+            "CASCADE": self.handleCascade
+        }
+        self.unlockedCommands= {
+            "INDEX": self.indexPackage,
+            "REMOVE": self.removePackage,
+            "QUERY": self.queryPackage,
+            "DEPS": self.depsPackage,
+            "RDEPS": self.rdepsPackage,
+            "DEPENDS": self.dependsPackage,
+            "CASCADE": self.cascadePackage
         }
         self.entries= {}
-        self.lock= Lock()
-        self.cycleMemo= {}
+        if concurrency == "rwlock":
+            rwLock= ReadWriteLock()
+            self.lock= rwLock.getWriteLock()
+            self.readLock= rwLock.getReadLock()
+        else:
+            self.lock= Lock()
+            self.readLock= self.lock
+        self.lockFreeReads= concurrency == "lockfree"
+        self.orderSlots= []
+        self.numFreeSlots= 0
+        self.mutationLog= None
+        self.closureCache= ClosureCache()
+        self.reachability= ReachabilityIndex(self)
 
     def __str__(self):
-        """Returns: repr of the index as a str, for visual debugging."""
-        s= "EntryMap:\n    %s\nEntries:" % str(self.entries)
+        """Returns: repr of the index as a str, for visual debugging of small
+             indexes (see dump to inspect a large one)."""
+        lines= ["EntryMap:\n    %s\nEntries:" % str(self.entries)]
         for entry in [self.entries[name] for name in self.entries]:
-            s+= "\n    %s:" % entry.getName()
-            s+= "\n        Dependencies:"
+            lines.append("    %s:" % entry.getName())
+            lines.append("        Dependencies:")
             for dependency in entry.getDependencies():
-                s+= "\n            %s" % dependency.getName()
-            s+= "\n        Dependees:"
+                lines.append("            %s" % dependency.getName())
+            lines.append("        Dependees:")
             for dependee in entry.getDependees():
-                s+= "\n            %s" % dependee.getName()
-        return s
+                lines.append("            %s" % dependee.getName())
+        return "\n".join(lines)
     
     def getLock(self):
         """Returns: this index's lock object, for concurrency control."""
         return self.lock
 
+    def getReadLock(self):
+        """Returns: the lock object that excludes every writer, but not
+             necessarily other readers (eg: to take a consistent snapshot)."""
+        return self.readLock
+
+    def timeLock(self):
+        """Wraps this index's lock in a metrics.TimedLock, which measures how
+             long commands wait for it and hold it (reads too, where they
+             take the same lock)."""
+        timedLock= metrics.TimedLock(self.lock)
+        if self.readLock is self.lock:
+            self.readLock= timedLock
+        self.lock= timedLock
+
+    def getLockTimer(self):
+        """Returns: this index's lock as a metrics.TimedLock; None if it isn't
+             timed (see timeLock)."""
+        if isinstance(self.lock, metrics.TimedLock):
+            return self.lock
+        return None
+
+    def setMutationLog(self, mutationLog):
+        """Attaches <mutationLog>, which from now on gets every successful
+             INDEX and REMOVE passed to its append(cmd, pkg, deps) method,
+             in an order that can be replayed.
+           Precondition: mutationLog also has a waitDurable() method."""
+        self.mutationLog= mutationLog
+
+    def logMutation(self, cmd, pkg, deps):
+        """Passes a successful mutation on to the mutation log, if one is
+             attached.
+           Precondition: caller still holds the lock(s) that the mutation was
+             made under, so that the log's order matches the index's."""
+        if self.mutationLog != None:
+            self.mutationLog.append(cmd, pkg, deps)
+
+    def waitDurable(self):
+        """Blocks until every mutation logged by the calling thread is
+             durable, so its responses can be sent.  Returns at once if no
+             mutation log is attached."""
+        if self.mutationLog != None:
+            self.mutationLog.waitDurable()
+
     def getHandlerPtr(self, cmd):
         """Returns: pointer to function to handle the given command if it
              exists in this index instance; None otherwise."""
@@ -68,25 +227,130 @@ class PackageIndex(object):
             return None
         return self.commands[cmd]
 
-    def hasCycle(self, root, visited):
-        """Returns: True if there is a cycle in the graph containing the
-             root node; False otherwise.
-           Precondition: root is an IndexEntry instance; visited is a map of
-             IndexEntry->bool.
-           Note: using DFS to find the cycle."""
-        if root in self.cycleMemo:
-            return self.cycleMemo[root]
-        if root in visited:
-            return True
-        visited[root]= True
-        cycleFound= False
-        for child in root.dependees:
-            foundCycle= self.hasCycle(child, dict(visited))
-            if foundCycle:
-                cycleFound= True
-                break
-        self.cycleMemo[root]= cycleFound
-        return cycleFound
+    def getNumPackages(self):
+        """Returns: number of packages in the index."""
+        return len(self.entries)
+
+    def getInstallOrder(self):
+        """Returns: list of the names of every package in the index, ordered
+             so that each package comes after all of its dependencies."""
+        with self.readLock:
+            return [entry.getName() for entry in self.orderSlots if entry != None]
+
+    def addToOrder(self, entryPtr):
+        """Places a new entry at the end of the install order, which is always
+             valid because nothing can depend on it yet.
+           Precondition: entryPtr is an IndexEntry instance not in the order."""
+        entryPtr.order= len(self.orderSlots)
+        self.orderSlots.append(entryPtr)
+
+    def removeFromOrder(self, entryPtr):
+        """Frees <entryPtr>'s slot in the install order, and compacts the
+             order once more than half of its slots are free.
+           Precondition: entryPtr is an IndexEntry instance in the order."""
+        self.orderSlots[entryPtr.order]= None
+        entryPtr.order= None
+        self.numFreeSlots+= 1
+        if self.numFreeSlots * 2 > len(self.orderSlots):
+            self.orderSlots= [entry for entry in self.orderSlots if entry != None]
+            for (slot, entry) in enumerate(self.orderSlots):
+                entry.order= slot
+            self.numFreeSlots= 0
+
+    def reorder(self, entryPtr, depPtr):
+        """Updates the install order so that <entryPtr> and everything that
+             depends on it come after <depPtr> and everything it depends on.
+           Returns: False if this is impossible because <depPtr> already
+             depends on <entryPtr> (ie: the edge would close a cycle); True
+             otherwise.
+           Precondition: entryPtr and depPtr are IndexEntry instances, and
+             depPtr currently comes after entryPtr in the install order.
+           Note: only entries whose order lies between the two endpoints
+             can be out of place, so both searches stop at those bounds."""
+        lowerBound= entryPtr.order
+        upperBound= depPtr.order
+        forward= []
+        visited= set([entryPtr])
+        stack= [entryPtr]
+        while stack:
+            node= stack.pop()
+            forward.append(node)
+            for dependee in node.dependees:
+                if dependee is depPtr:
+                    metrics.trace.cycleVisits+= len(forward)
+                    return False
+                if dependee not in visited and dependee.order < upperBound:
+                    visited.add(dependee)
+                    stack.append(dependee)
+        backward= []
+        visited= set([depPtr])
+        stack= [depPtr]
+        while stack:
+            node= stack.pop()
+            backward.append(node)
+            for dependency in node.dependencies:
+                if dependency not in visited and dependency.order > lowerBound:
+                    visited.add(dependency)
+                    stack.append(dependency)
+        metrics.trace.cycleVisits+= len(forward) + len(backward)
+        getOrder= lambda entry: entry.order
+        backward.sort(key=getOrder)
+        forward.sort(key=getOrder)
+        moved= backward + forward
+        slots= sorted([entry.order for entry in moved])
+        for (entry, slot) in zip(moved, slots):
+            entry.order= slot
+            self.orderSlots[slot]= entry
+        return True
+
+    def hasCycle(self, root, newDepPtrs):
+        """Returns: True if making <root> depend on every entry in <newDepPtrs>
+             would create a cycle; False otherwise, in which case the install
+             order has already been updated to put root after all of them.
+           Precondition: root is an IndexEntry instance; newDepPtrs is a list
+             of IndexEntry instances.
+           Note: uses Pearce-Kelly dynamic topological ordering.  An edge that
+             already respects the install order can't close a cycle, so it
+             costs O(1); otherwise only the affected region is searched and
+             reordered (see reorder)."""
+        if tracing.traceOn:
+            tracing.emit(tracing.TRACE, "hasCycle", package=root.name,
+                newDeps=[dep.name for dep in newDepPtrs])
+        for dep in newDepPtrs:
+            if dep.order < root.order:
+                continue
+            if not self.reorder(root, dep):
+                if tracing.traceOn:
+                    tracing.emit(tracing.TRACE, "hasCycle.found", package=root.name,
+                        dependency=dep.name, visits=metrics.trace.cycleVisits)
+                return True
+        return False
+
+    def linkDependency(self, entryPtr, depPtr):
+        """Adds the edge "<entryPtr> depends on <depPtr>" to the graph.
+           Precondition: entryPtr and depPtr are IndexEntry instances."""
+        if entryPtr.dependencies is NO_EDGES:
+            entryPtr.dependencies= set()
+        entryPtr.dependencies.add(depPtr)
+        if depPtr.dependees is NO_EDGES:
+            depPtr.dependees= set()
+        depPtr.dependees.add(entryPtr)
+        self.closureCache.invalidateEdge(entryPtr.name, depPtr.name)
+        self.reachability.addEdge(entryPtr.name, depPtr.name)
+
+    def unlinkDependency(self, entryPtr, depPtr):
+        """Removes the edge "<entryPtr> depends on <depPtr>" from the graph.
+           Precondition: entryPtr and depPtr are IndexEntry instances, and
+             the edge exists."""
+        entryPtr.dependencies.remove(depPtr)
+        if len(entryPtr.dependencies) == 0:
+            entryPtr.dependencies= NO_EDGES
+        depPtr.dependees.remove(entryPtr)
+        if len(depPtr.dependees) == 0:
+            #Also frees the table of a set that once held a large fan-in
+            depPtr.dependees= NO_EDGES
+        self.closureCache.invalidateEdge(entryPtr.name, depPtr.name)
+        self.reachability.removeEdge(entryPtr.name, depPtr.name)
 
     def updateExisting(self, entryPtr, newDeps):
         """Attempts to update the index to reflect <newDeps> as <entryPtr>'s
@@ -96,38 +360,26 @@ class PackageIndex(object):
              (ie: cycle created).
            Precondition: entryPtr is an IndexEntry instance; newDeps is a
              list of strs."""
-        newDepPtrs= []
+        #Efficiency: only search from NEW edges, because others are known good.
+        #They're kept in the request's order, so the install order they
+        #reorder into doesn't depend on hash order
+        existingPtrs= entryPtr.getDependencies()
+        newDepPtrs= set()
+        onlyNewPtrs= []
         for dep in newDeps:
             if dep == entryPtr.getName():
                 return RESP_FAIL
-            newDepPtrs.append(self.entries[dep])
-        #Efficiency: only check NEW packages, because others are known good
-        existingPtrs= {}
-        onlyNewPtrs= []
-        for dep in entryPtr.getDependencies():
-            existingPtrs[dep]= 1
-        for dep in newDepPtrs:
-            if dep not in existingPtrs:
-                onlyNewPtrs.append(dep)
-        oldDeps= entryPtr.dependencies
-        entryPtr.dependencies= onlyNewPtrs
-        #Check for cycles in new deps only
-        for dep in oldDeps:
-            dependees= dep.getDependees()
-            dependees.pop(dependees.index(entryPtr))
-        for dep in newDepPtrs:
-            dep.getDependees().append(entryPtr)
-        foundCycle= self.hasCycle(entryPtr, {})
-        self.cycleMemo= {}
-        if foundCycle:
-            entryPtr.dependencies= oldDeps
-            for dep in oldDeps:
-                dep.getDependees().append(entryPtr)
-            for dep in newDepPtrs:
-                dependees= dep.getDependees()
-                dependees.pop(dependees.index(entryPtr))
+            depPtr= self.entries[dep]
+            if depPtr not in existingPtrs and depPtr not in newDepPtrs:
+                onlyNewPtrs.append(depPtr)
+            newDepPtrs.add(depPtr)
+        if self.hasCycle(entryPtr, onlyNewPtrs):
             return RESP_FAIL
-        entryPtr.dependencies= newDepPtrs
+        for dep in list(existingPtrs):
+            if dep not in newDepPtrs:
+                self.unlinkDependency(entryPtr, dep)
+        for dep in onlyNewPtrs:
+            self.linkDependency(entryPtr, dep)
         return RESP_OK
 
     def handleIndex(self, pkg, deps):
@@ -135,52 +387,754 @@ class PackageIndex(object):
              RESP_FAIL otherwise.
            Precondition: pkg is a str; deps is a list of str."""
         with self.lock:
-            depPtrs= []
-            for dep in deps:
-                if dep not in self.entries:
-                    return RESP_FAIL
-                depPtrs.append(self.entries[dep])
-            if pkg in self.entries:
-                return self.updateExisting(self.entries[pkg], deps)
-            newEntry= IndexEntry(pkg, depPtrs, [])
-            self.entries[pkg]= newEntry
-            for depPtr in depPtrs:
-                depPtr.getDependees().append(newEntry)
-            return RESP_OK
+            return self.indexPackage(pkg, deps)
     
     def handleRemove(self, pkg, deps):
         """Returns: RESP_OK if pkg isn't in the index or could be removed
              successfully; RESP_FAIL otherwise.
            Precondition: pkg is a str; deps is a list of str."""
         with self.lock:
-            if pkg not in self.entries:
-                return RESP_OK
-            entry= self.entries[pkg]
-            if len(entry.getDependees()) > 0:
-                return RESP_FAIL
-            for depPtr in entry.getDependencies():
-                dependees= depPtr.getDependees()
-                dependees.pop(dependees.index(entry))
-            del self.entries[pkg]
-            return RESP_OK
+            return self.removePackage(pkg, deps)
     
     def handleQuery(self, pkg, deps):
         """Returns: RESP_OK if <pkg> has an entry in the index; RESP_FAIL otherwise.
+           Precondition: pkg is a str; deps is a list of str.
+           Note: in lockfree mode this relies on a dict lookup being atomic
+             under the GIL.  Writers add a package to self.entries only once
+             its INDEX can no longer fail, and delete it as the last step of
+             its REMOVE, so that single dict operation is the point where
+             each mutation becomes visible to QUERY."""
+        if self.lockFreeReads:
+            return self.queryPackage(pkg, deps)
+        with self.readLock:
+            return self.queryPackage(pkg, deps)
+
+    def handleCascade(self, pkg, deps):
+        """Removes <pkg> and every package that transitively depends on it,
+             each one after everything that depends on it, all under one
+             acquisition of the lock.  If deps is [CASCADE_ORPHANS], the
+             dependencies of removed packages that are left with no
+             dependees are removed too (transitively).
+           Returns: "OK|<names>\n", where names are the removed packages,
+             comma separated in the order they were removed (none if pkg
+             isn't indexed); RESP_ERR if deps holds anything else.
+           Precondition: pkg is a str; deps is a list of str."""
+        with self.lock:
+            return self.cascadePackage(pkg, deps)
+
+    def handleDeps(self, pkg, deps):
+        """Returns: "OK|<names>\n", where names are every package that <pkg>
+             transitively depends on, comma separated and in install order
+             (each after its own dependencies); RESP_FAIL if pkg isn't
+             indexed.
+           Precondition: pkg is a str; deps is a list of str."""
+        with self.readLock:
+            return self.depsPackage(pkg, deps)
+
+    def handleRdeps(self, pkg, deps):
+        """Returns: "OK|<names>\n", where names are every package that
+             transitively depends on <pkg> (ie: would break if it were
+             removed), comma separated and in install order; RESP_FAIL if pkg
+             isn't indexed.
            Precondition: pkg is a str; deps is a list of str."""
+        with self.readLock:
+            return self.rdepsPackage(pkg, deps)
+
+    def handleDepends(self, pkg, deps):
+        """Returns: RESP_OK if <pkg> transitively depends on the package in
+             <deps>; RESP_FAIL if it doesn't, or either one isn't indexed;
+             RESP_ERR unless deps holds exactly one package.
+           Precondition: pkg is a str; deps is a list of str."""
+        with self.readLock:
+            return self.dependsPackage(pkg, deps)
+
+    def runBatch(self, cmdObjs):
+        """Runs every command in <cmdObjs> in order, while acquiring the lock
+             only once for the whole batch.
+           Returns: list of the response strs of each command, in order.
+           Precondition: cmdObjs is a list of IndexCommand objects parsed for
+             this index."""
         with self.lock:
-            if pkg not in self.entries:
+            results= []
+            for cmdObj in cmdObjs:
+                handlerFunc= self.unlockedCommands[cmdObj.getCommandName()]
+                results.append(handlerFunc(cmdObj.packageName, cmdObj.dependencies))
+            return results
+
+    def bulkLoad(self, lines):
+        """Loads a whole manifest of "INDEX|pkg|deps" lines (eg: a file) in one
+             pass, without replaying each line as a command.  The manifest may
+             list packages in any order: it is topologically sorted first, so
+             that every new package can be built directly after its
+             dependencies, with no cycle checks.  Packages that are malformed,
+             depend on missing packages, or are part of (or depend on) a cycle
+             are rejected.  A package listed more than once keeps its last
+             line, and packages already in the index are reindexed normally.
+           Returns: tuple of (number of packages loaded, list of (package or
+             line, reason str) tuples for every rejected line).
+           Precondition: lines is an iterable of str."""
+        with GcPause():
+            (pkgs, manifest, rejected)= self.parseManifest(lines)
+            with self.lock:
+                (sortedPkgs, reasons)= self.sortManifest(pkgs, manifest)
+                failed= self.buildSorted(sortedPkgs, manifest)
+        for pkg in failed:
+            reasons[pkg]= "cyclic"
+        rejected.extend([(pkg, reasons[pkg]) for pkg in pkgs if pkg in reasons])
+        return (len(sortedPkgs) - len(failed), rejected)
+
+    def parseManifest(self, lines):
+        """Does the parsing part of bulkLoad.
+           Returns: tuple of (list of package names in manifest order, dict of
+             package name->list of dependency names, list of (line,
+             "malformed") tuples for the lines that couldn't be parsed)."""
+        pkgs= []
+        manifest= {}
+        malformed= []
+        for line in lines:
+            line= line.strip()
+            if len(line) == 0:
+                continue
+            fields= line.split("|")
+            if len(fields) != 3 or fields[0] != "INDEX" or len(fields[1]) == 0:
+                malformed.append((line, "malformed"))
+                continue
+            deps= [dep for dep in fields[2].split(",") if len(dep) > 0]
+            if len(set(deps)) != len(deps):
+                deps= list(OrderedDict.fromkeys(deps))
+            if fields[1] not in manifest:
+                pkgs.append(fields[1])
+            manifest[fields[1]]= deps
+        return (pkgs, manifest, malformed)
+
+    def sortManifest(self, pkgs, manifest):
+        """Does the sorting part of bulkLoad, with Kahn's algorithm, where
+             only dependencies on other manifest packages have to wait.
+           Returns: tuple of (list of the loadable packages in topological
+             order, dict of rejected package name->"cyclic" or "dangling").
+           Precondition: caller holds self.lock."""
+        numPending= {}
+        dependees= {}
+        bad= []
+        for pkg in pkgs:
+            numPending[pkg]= 0
+            for dep in manifest[pkg]:
+                if dep == pkg:
+                    bad.append((pkg, "cyclic"))
+                elif dep in manifest:
+                    numPending[pkg]+= 1
+                    dependees.setdefault(dep, []).append(pkg)
+                elif self.queryPackage(dep, []) != RESP_OK:
+                    bad.append((pkg, "dangling"))
+        #Anything depending on a rejected package can't be loaded either
+        reasons= {}
+        while bad:
+            (pkg, reason)= bad.pop()
+            if pkg in reasons:
+                continue
+            reasons[pkg]= reason
+            bad.extend([(dependee, reason) for dependee in dependees.get(pkg, [])])
+        ready= [pkg for pkg in pkgs if numPending[pkg] == 0 and pkg not in reasons]
+        ready.reverse()
+        sortedPkgs= []
+        while ready:
+            pkg= ready.pop()
+            sortedPkgs.append(pkg)
+            for dependee in dependees.get(pkg, []):
+                numPending[dependee]-= 1
+                if numPending[dependee] == 0 and dependee not in reasons:
+                    ready.append(dependee)
+        #Whatever never became ready is in a cycle, or downstream of one
+        for pkg in pkgs:
+            if numPending[pkg] > 0 and pkg not in reasons:
+                reasons[pkg]= "cyclic"
+        return (sortedPkgs, reasons)
+
+    def buildSorted(self, pkgs, manifest):
+        """Does the graph building part of bulkLoad.  New packages are added
+             directly, with no dependency or cycle checks, since every one of
+             their dependencies is already indexed and nothing depends on them
+             yet.  Packages that are already indexed are reindexed normally.
+           Returns: list of the packages whose reindex failed (their old
+             version stays in the index).
+           Precondition: pkgs is in topological order, and manifest maps each
+             one to its list of dependency names; caller holds self.lock."""
+        failed= []
+        for pkg in pkgs:
+            if pkg in self.entries:
+                if self.updateExisting(self.entries[pkg], manifest[pkg]) != RESP_OK:
+                    failed.append(pkg)
+                continue
+            newEntry= IndexEntry(pkg)
+            self.entries[pkg]= newEntry
+            self.addToOrder(newEntry)
+            for dep in manifest[pkg]:
+                self.linkDependency(newEntry, self.entries[dep])
+        return failed
+
+    def loadSorted(self, pkgs, manifest):
+        """Builds packages that are already known to be sorted and valid (eg:
+             read back from a snapshot) into the index, with buildSorted.
+           Returns: list of the packages whose reindex failed.
+           Precondition: same as buildSorted, except that this acquires
+             self.lock itself."""
+        with GcPause():
+            with self.lock:
+                return self.buildSorted(pkgs, manifest)
+
+    def captureGraph(self):
+        """Copies the whole graph out of the index, in the same shape that
+             loadSorted takes, so it can be written out without the lock.
+           Returns: tuple of (list of every package name in install order,
+             dict of package name->list of its dependency names).
+           Precondition: caller holds self.readLock."""
+        pkgs= []
+        manifest= {}
+        with GcPause():
+            for (pkg, deps) in self.iterEntries():
+                pkgs.append(pkg)
+                manifest[pkg]= deps
+        return (pkgs, manifest)
+
+    def iterEntries(self):
+        """Yields: a (package name, list of its dependency names) tuple for
+             every package in the index, in install order.  The names are
+             sorted, so a dump or snapshot of the same index is always the
+             same, whatever order the adjacency sets are in.
+           Precondition: caller holds self.readLock."""
+        for entry in self.orderSlots:
+            if entry != None:
+                yield (entry.name, sorted([dep.name for dep in entry.dependencies]))
+
+    def dump(self, fmt):
+        """Starts a dump of every package in the index, as of this call, with
+             one line per package in install order in the format <fmt>:
+             -native: the INDEX|pkg|deps lines of the protocol (which --load
+              takes as a manifest)
+             -ndjson: one {"name": pkg, "deps": [...]} JSON object per line
+           followed by a last line of "OK|<number of packages>".  The dump is
+             written by a child process forked while holding the read lock,
+             which sees a copy-on-write snapshot of the whole index for as
+             long as it takes, so the lock is only held for the fork.  The
+             child writes into a pipe, which blocks it whenever the reader
+             falls behind, so neither process ever buffers more than a chunk.
+           Returns: DumpStream of the dump's chunks.
+           Precondition: fmt is one of DUMP_FORMATS."""
+        (readFd, writeFd)= os.pipe()
+        with self.readLock:
+            pid= os.fork()
+            if pid == 0:
+                os.close(readFd)
+                self.writeDump(writeFd, fmt)
+        os.close(writeFd)
+        return DumpStream(pid, readFd)
+
+    def writeDump(self, writeFd, fmt):
+        """Writes the dump in format <fmt> to <writeFd>, and exits.
+           Precondition: this is the child process forked by dump."""
+        exitCode= 1
+        try:
+            with os.fdopen(writeFd, "wb", DUMP_CHUNK_BYTES) as out:
+                numPackages= 0
+                for (pkg, deps) in self.iterEntries():
+                    if fmt == "ndjson":
+                        out.write('{"name": %s, "deps": %s}\n' % (json.dumps(pkg), json.dumps(deps)))
+                    else:
+                        out.write("INDEX|%s|%s\n" % (pkg, ",".join(deps)))
+                    numPackages+= 1
+                out.write("OK|%d\n" % numPackages)
+            exitCode= 0
+        finally:
+            os._exit(exitCode)
+
+    def indexPackage(self, pkg, deps):
+        """Does the work of handleIndex.
+           Precondition: caller holds self.lock."""
+        depPtrs= []
+        for dep in deps:
+            if dep not in self.entries:
+                if tracing.debugOn:
+                    tracing.emit(tracing.DEBUG, "index.missingDependency", package=pkg, dependency=dep)
                 return RESP_FAIL
+            depPtrs.append(self.entries[dep])
+        if pkg in self.entries:
+            if tracing.debugOn:
+                tracing.emit(tracing.DEBUG, "index.update", package=pkg)
+            if self.updateExisting(self.entries[pkg], deps) != RESP_OK:
+                return RESP_FAIL
+        else:
+            if tracing.debugOn:
+                tracing.emit(tracing.DEBUG, "index.create", package=pkg)
+            newEntry= IndexEntry(pkg)
+            self.entries[pkg]= newEntry
+            self.addToOrder(newEntry)
+            for depPtr in depPtrs:
+                self.linkDependency(newEntry, depPtr)
+        self.logMutation("INDEX", pkg, deps)
+        return RESP_OK
+
+    def removePackage(self, pkg, deps):
+        """Does the work of handleRemove.
+           Precondition: caller holds self.lock."""
+        if pkg not in self.entries:
+            if tracing.debugOn:
+                tracing.emit(tracing.DEBUG, "remove.notIndexed", package=pkg)
             return RESP_OK
+        entry= self.entries[pkg]
+        if len(entry.getDependees()) > 0:
+            if tracing.debugOn:
+                tracing.emit(tracing.DEBUG, "remove.hasDependees", package=pkg,
+                    numDependees=len(entry.getDependees()))
+            return RESP_FAIL
+        for depPtr in list(entry.getDependencies()):
+            self.unlinkDependency(entry, depPtr)
+        del self.entries[pkg]
+        self.removeFromOrder(entry)
+        self.closureCache.invalidatePackage(pkg)
+        self.reachability.removePackage(pkg)
+        self.logMutation("REMOVE", pkg, deps)
+        return RESP_OK
+
+    def queryPackage(self, pkg, deps):
+        """Does the work of handleQuery.
+           Precondition: caller holds self.readLock, or the index is in
+             lockfree mode."""
+        if pkg not in self.entries:
+            return RESP_FAIL
+        return RESP_OK
+
+    def cascadePackage(self, pkg, deps):
+        """Does the work of handleCascade.  Each package is removed with
+             removePackage, once nothing depends on it anymore, so every
+             removal is logged (and replicated) as a plain REMOVE.  Every
+             package and edge in the removed subgraph is visited a constant
+             number of times, so this is linear in its size.
+           Precondition: caller holds self.lock."""
+        if deps != [] and deps != [CASCADE_ORPHANS]:
+            return RESP_ERR
+        if self.queryPackage(pkg, []) != RESP_OK:
+            return "OK|\n"
+        removeOrphans= deps == [CASCADE_ORPHANS]
+        orphanCandidates= []
+        removed= []
+        #Postorder over dependees lists each package after all of its dependees
+        for name in self.walkPostorder(pkg, self.getDependeeNames):
+            if removeOrphans:
+                orphanCandidates.extend(self.getDependencyNames(name))
+            self.removePackage(name, [])
+            removed.append(name)
+        while orphanCandidates:
+            name= orphanCandidates.pop()
+            if self.queryPackage(name, []) != RESP_OK or self.getNumDependees(name) > 0:
+                continue
+            orphanCandidates.extend(self.getDependencyNames(name))
+            self.removePackage(name, [])
+            removed.append(name)
+        return "OK|%s\n" % ",".join(removed)
+
+    def depsPackage(self, pkg, deps):
+        """Does the work of handleDeps.
+           Precondition: caller holds self.readLock."""
+        return self.closurePackage("DEPS", pkg, False)
+
+    def rdepsPackage(self, pkg, deps):
+        """Does the work of handleRdeps.
+           Precondition: caller holds self.readLock."""
+        return self.closurePackage("RDEPS", pkg, True)
+
+    def dependsPackage(self, pkg, deps):
+        """Does the work of handleDepends.
+           Precondition: caller holds self.readLock."""
+        if len(deps) != 1:
+            return RESP_ERR
+        dep= deps[0]
+        if pkg == dep or self.queryPackage(pkg, []) != RESP_OK or self.queryPackage(dep, []) != RESP_OK:
+            return RESP_FAIL
+        if self.reachability.reaches(pkg, dep):
+            return RESP_OK
+        return RESP_FAIL
+
+    def closurePackage(self, cmd, pkg, reverse):
+        """Returns: the response to a DEPS (or, if <reverse>, RDEPS) command
+             <cmd> of <pkg>, from the closure cache if it's there.
+           Precondition: caller holds self.readLock."""
+        response= self.closureCache.get(cmd, pkg)
+        if response != None:
+            return response
+        closure= self.getClosure(pkg, reverse)
+        if closure == None:
+            return RESP_FAIL
+        response= "OK|%s\n" % ",".join(closure)
+        self.closureCache.put(cmd, pkg, closure, response)
+        return response
+
+    def getClosure(self, pkg, reverse):
+        """Returns: list of the names of every package that <pkg> transitively
+             depends on (or, if <reverse>, that transitively depend on pkg),
+             each after its own dependencies; None if pkg isn't indexed.
+           Precondition: caller holds self.readLock."""
+        entry= self.entries.get(pkg)
+        if entry == None:
+            return None
+        if reverse:
+            #Postorder over dependees lists each package before its dependencies
+            nodes= self.walkPostorder(entry, IndexEntry.getDependees)
+            nodes.reverse()
+        else:
+            nodes= self.walkPostorder(entry, IndexEntry.getDependencies)
+        return [node.name for node in nodes if node is not entry]
+
+    def getPackageNames(self):
+        """Returns: iterable of the names of every package in the index.
+           Precondition: caller holds self.readLock."""
+        return iter(self.entries)
+
+    def getDependencyNames(self, pkg):
+        """Returns: list of the names of the packages that <pkg> depends on;
+             empty if pkg isn't indexed."""
+        entry= self.entries.get(pkg)
+        if entry == None:
+            return []
+        return [dep.name for dep in entry.dependencies]
+
+    def getDependeeNames(self, pkg):
+        """Returns: list of the names of the packages that depend on <pkg>;
+             empty if pkg isn't indexed."""
+        entry= self.entries.get(pkg)
+        if entry == None:
+            return []
+        return [dependee.name for dependee in entry.dependees]
+
+    def getNumDependees(self, pkg):
+        """Returns: number of packages that depend on <pkg>.
+           Precondition: pkg is indexed."""
+        return len(self.entries[pkg].dependees)
+
+    def walkPostorder(self, root, getNeighbors):
+        """Returns: list of <root> and every node reachable from it through
+             getNeighbors(node), each after all of the nodes reachable from it
+             (ie: in depth-first postorder).
+           Precondition: the nodes reachable from root form a DAG."""
+        order= []
+        visited= set([root])
+        stack= [(root, iter(getNeighbors(root)))]
+        while stack:
+            (node, neighbors)= stack[-1]
+            for neighbor in neighbors:
+                if neighbor not in visited:
+                    visited.add(neighbor)
+                    stack.append((neighbor, iter(getNeighbors(neighbor))))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+        return order
+
+
+class ClosureCache(object):
+    def __init__(self, maxNames=CLOSURE_CACHE_MAX_NAMES):
+        """Class to model an index's cache of DEPS and RDEPS responses.  Each
+             response is kept with the closure it was built from, and is
+             indexed under every package whose edges it depends on: the
+             package itself and each one in its closure (an edge out of any
+             of them changes a DEPS closure, and an edge into any of them
+             changes an RDEPS one).  So when an edge changes, only the
+             responses indexed under its endpoints are dropped, and
+             invalidating costs no more than building them did.
+           The least recently used responses are dropped once the cached
+             closures hold more than <maxNames> names in total."""
+        self.responses= OrderedDict()
+        self.watchers= {}
+        self.numNames= 0
+        self.maxNames= maxNames
+        self.lock= Lock()
+
+    def get(self, cmd, pkg):
+        """Returns: the cached response str to <cmd> of <pkg>; None if there
+             is none."""
+        if len(self.responses) == 0:
+            return None
+        key= (cmd, pkg)
+        with self.lock:
+            item= self.responses.pop(key, None)
+            if item == None:
+                return None
+            #Reinserting moves it to the most recently used end
+            self.responses[key]= item
+            return item[0]
+
+    def put(self, cmd, pkg, closure, response):
+        """Caches <response> as the response to <cmd> of <pkg>, whose closure
+             is the list of names <closure>."""
+        numNames= len(closure) + 1
+        if numNames > self.maxNames:
+            return
+        key= (cmd, pkg)
+        with self.lock:
+            if key in self.responses:
+                return
+            self.responses[key]= (response, closure)
+            self.watchers.setdefault((cmd, pkg), set()).add(key)
+            for name in closure:
+                self.watchers.setdefault((cmd, name), set()).add(key)
+            self.numNames+= numNames
+            while self.numNames > self.maxNames:
+                self.drop(next(iter(self.responses)))
+
+    def invalidateEdge(self, pkg, dep):
+        """Drops every cached response that the edge "<pkg> depends on <dep>"
+             changes, whether it's being added or removed."""
+        if len(self.responses) == 0:
+            return
+        with self.lock:
+            self.dropWatchers(("DEPS", pkg))
+            self.dropWatchers(("RDEPS", dep))
+
+    def invalidatePackage(self, pkg):
+        """Drops every cached response about <pkg>, once it's removed."""
+        if len(self.responses) == 0:
+            return
+        with self.lock:
+            self.dropWatchers(("DEPS", pkg))
+            self.dropWatchers(("RDEPS", pkg))
+
+    def dropWatchers(self, watchKey):
+        """Drops every cached response indexed under <watchKey>.
+           Precondition: caller holds self.lock."""
+        if watchKey in self.watchers:
+            for key in list(self.watchers[watchKey]):
+                self.drop(key)
+
+    def drop(self, key):
+        """Drops the cached response <key>, and unindexes it.
+           Precondition: caller holds self.lock; key is cached."""
+        (response, closure)= self.responses.pop(key)
+        (cmd, pkg)= key
+        for name in [pkg] + closure:
+            watched= self.watchers[(cmd, name)]
+            watched.discard(key)
+            if len(watched) == 0:
+                del self.watchers[(cmd, name)]
+        self.numNames-= len(closure) + 1
+
+
+class ReachabilityIndex(object):
+    def __init__(self, indexPtr):
+        """Class to model a reachability index over the package graph of
+             <indexPtr>, for asking whether one package transitively depends
+             on another.  Each package gets an interval label (low, high),
+             such that a package's label contains the label of every package
+             it depends on (as in GRAIL's interval labeling).  So whenever
+             one label doesn't contain the other, the answer is "no" in O(1);
+             otherwise a search confirms it, and skips every package whose
+             label doesn't contain the target's.
+           Labels are built by one postorder DFS of the whole graph, and then
+             maintained as edges change: a new edge widens its source's label
+             (and its dependees', transitively) to contain the target's, and
+             a removed edge leaves every label as it is, which is still
+             correct, just looser.  Once more than a fraction of the labels
+             were loosened this way, a background thread rebuilds them from
+             scratch, and queries keep using the loose ones meanwhile.
+           Nothing is built until the first question, so an index that never
+             gets one pays nothing for it."""
+        self.indexPtr= indexPtr
+        self.labels= None
+        self.nextPost= 0
+        self.numStale= 0
+        self.isRebuilding= False
+        self.lock= Lock()
+
+    def reaches(self, pkg, dep):
+        """Returns: True if <pkg> transitively depends on <dep>; False
+             otherwise.
+           Precondition: pkg and dep are distinct indexed package names;
+             caller holds the index's readLock."""
+        labels= self.getLabels()
+        if labels == None:
+            return self.search(pkg, dep, None)
+        if not self.mayReach(labels, pkg, dep):
+            return False
+        return self.search(pkg, dep, labels)
+
+    def mayReachAny(self, pkgs, dep):
+        """Returns: False if none of <pkgs> can transitively depend on <dep>
+             according to the labels; True if one might, or there are no
+             labels yet.
+           Precondition: pkgs is a list of package names; dep is a package
+             name; nothing can add a path between existing packages while
+             this runs."""
+        labels= self.getLabels()
+        if labels == None:
+            return True
+        return any([self.mayReach(labels, pkg, dep) for pkg in pkgs])
+
+    def mayReach(self, labels, pkg, dep):
+        """Returns: False if the labels in <labels> rule out <pkg> depending
+             on <dep>; True otherwise.  A package without a label was indexed
+             after the last build, and hasn't gained an edge since, so
+             nothing reaches it and it reaches nothing."""
+        pkgLabel= labels.get(pkg)
+        depLabel= labels.get(dep)
+        if pkgLabel == None or depLabel == None:
+            return False
+        return pkgLabel[0] <= depLabel[0] and depLabel[1] <= pkgLabel[1]
+
+    def search(self, pkg, dep, labels):
+        """Returns: True if <pkg> transitively depends on <dep>; False
+             otherwise, found with a depth-first search that only enters
+             packages whose label (in <labels>, unless it's None) may reach
+             dep."""
+        getDependencyNames= self.indexPtr.getDependencyNames
+        visited= set([pkg])
+        stack= [pkg]
+        while stack:
+            node= stack.pop()
+            for neighbor in getDependencyNames(node):
+                if neighbor == dep:
+                    return True
+                if neighbor in visited:
+                    continue
+                visited.add(neighbor)
+                if labels == None or self.mayReach(labels, neighbor, dep):
+                    stack.append(neighbor)
+        return False
+
+    def getLabels(self):
+        """Returns: the current dict of package name->label; None if they
+             aren't built yet, in which case a build is started."""
+        labels= self.labels
+        if labels == None:
+            self.scheduleRebuild()
+        return labels
+
+    def scheduleRebuild(self):
+        """Starts a background thread to rebuild the labels, unless one is
+             already on it."""
+        with self.lock:
+            if self.isRebuilding:
+                return
+            self.isRebuilding= True
+        rebuilder= Thread(target=self.rebuild)
+        rebuilder.daemon= True
+        rebuilder.start()
+
+    def rebuild(self):
+        """Builds every label from scratch with a postorder DFS, holding the
+             index's readLock so that no edge changes meanwhile, and swaps
+             them in."""
+        indexPtr= self.indexPtr
+        with indexPtr.readLock:
+            labels= {}
+            post= 0
+            visited= set()
+            for root in indexPtr.getPackageNames():
+                if root in visited:
+                    continue
+                visited.add(root)
+                stack= [(root, iter(indexPtr.getDependencyNames(root)))]
+                while stack:
+                    (node, neighbors)= stack[-1]
+                    for neighbor in neighbors:
+                        if neighbor not in visited:
+                            visited.add(neighbor)
+                            stack.append((neighbor, iter(indexPtr.getDependencyNames(neighbor))))
+                            break
+                    else:
+                        stack.pop()
+                        low= post
+                        for dep in indexPtr.getDependencyNames(node):
+                            low= min(low, labels[dep][0])
+                        labels[node]= (low, post)
+                        post+= 1
+            with self.lock:
+                self.labels= labels
+                self.nextPost= post
+                self.numStale= 0
+                self.isRebuilding= False
+
+    def addEdge(self, pkg, dep):
+        """Widens the labels of <pkg> and everything that depends on it to
+             contain <dep>'s, for the new edge "<pkg> depends on <dep>".
+           Precondition: the edge is already in the graph."""
+        if self.labels == None:
+            return
+        getDependeeNames= self.indexPtr.getDependeeNames
+        with self.lock:
+            labels= self.labels
+            depLabel= self.getLabel(labels, dep)
+            stack= [pkg]
+            while stack:
+                node= stack.pop()
+                oldLabel= self.getLabel(labels, node)
+                newLabel= (min(oldLabel[0], depLabel[0]), max(oldLabel[1], depLabel[1]))
+                if newLabel == oldLabel:
+                    continue
+                labels[node]= newLabel
+                #Lowering a new package's low end is what a rebuild would do too
+                if node != pkg or newLabel[1] != oldLabel[1]:
+                    self.numStale+= 1
+                stack.extend(getDependeeNames(node))
+            isStale= self.isStale()
+        if isStale:
+            self.scheduleRebuild()
+
+    def removeEdge(self, pkg, dep):
+        """Notes that the edge "<pkg> depends on <dep>" was removed, which
+             leaves the labels looser than they need to be."""
+        if self.labels == None:
+            return
+        with self.lock:
+            self.numStale+= 1
+            isStale= self.isStale()
+        if isStale:
+            self.scheduleRebuild()
+
+    def removePackage(self, pkg):
+        """Drops the label of <pkg>, once it's removed."""
+        if self.labels == None:
+            return
+        with self.lock:
+            self.labels.pop(pkg, None)
+
+    def getLabel(self, labels, pkg):
+        """Returns: the label of <pkg> in <labels>, after giving it a new
+             one of its own if it has none yet.
+           Precondition: caller holds self.lock."""
+        label= labels.get(pkg)
+        if label == None:
+            label= (self.nextPost, self.nextPost)
+            labels[pkg]= label
+            self.nextPost+= 1
+        return label
+
+    def isStale(self):
+        """Returns: True if enough labels were loosened since the last build
+             that it's worth rebuilding them; False otherwise.
+           Precondition: caller holds self.lock."""
+        numLabels= len(self.labels)
+        return self.numStale > max(REACHABILITY_MIN_STALE, numLabels * REACHABILITY_STALE_FRACTION)
 
 
 class IndexEntry(object):
-    def __init__(self, name, dependencies=[], dependees=[]):
-        """Class to model a node in the dependency graph.  Contains two lists:
+    def __init__(self, name, dependencies=(), dependees=()):
+        """Class to model a node in the dependency graph.  Contains two sets:
              -dependencies: forward ptrs to the nodes this depends on
-             -dependees: back ptrs to the nodes that depend on this node."""
+             -dependees: back ptrs to the nodes that depend on this node.
+           Adding and removing an edge is O(1) regardless of fan-in.  Sets
+             are iterated in no particular order, so anything written out
+             sorts them first (see PackageIndex.iterEntries).  A direction
+             with no edges shares the empty NO_EDGES instead of its own set
+             (most packages have no dependees, and many no dependencies), so
+             only PackageIndex.linkDependency and unlinkDependency may change
+             them."""
         self.name= name
-        self.dependencies= dependencies
-        self.dependees= dependees
+        self.dependencies= NO_EDGES
+        self.dependees= NO_EDGES
+        if len(dependencies) > 0:
+            self.dependencies= set(dependencies)
+        if len(dependees) > 0:
+            self.dependees= set(dependees)
+        self.order= None
         self.lock= Lock()
 
     def getName(self):
@@ -188,71 +1142,1529 @@ class IndexEntry(object):
         return self.name
 
     def getDependencies(self):
-        """Returns: list of IndexEntry objs that is self.dependencies."""
+        """Returns: set of IndexEntry objs that is self.dependencies."""
         return self.dependencies
 
     def getDependees(self):
-        """Returns: list of IndexEntry objs that is self.dependees."""
+        """Returns: set of IndexEntry objs that is self.dependees."""
         return self.dependees
+
+    def getOrder(self):
+        """Returns: int position of this node in its index's install order."""
+        return self.order
     
     def getLock(self):
         """Returns: Lock object for this instance."""
         return self.lock
         
 
-class IndexCommand(object):
-    def __init__(self, handlerFunc, packageName, dependencies):
-        """Class to model a command on an index, by storing a pointer to that
-             index instance's handler function, along with any needed arguments.
-           Precondition: handlerFunc is a function pointer, packageName is a str,
-             dependencies is a list of str."""
-        self.handlerFunc= handlerFunc
-        self.packageName= packageName
-        self.dependencies= dependencies
+class FineLockPackageIndex(PackageIndex):
+    def __init__(self):
+        """Index that locks only the entries each command touches, instead of
+             the whole table.  A fresh INDEX locks the new entry and its direct
+             dependencies, a REMOVE locks the entry and its direct
+             dependencies, and a QUERY takes no lock at all (as in lockfree
+             mode).  Entry locks are always acquired in package name order, so
+             two commands can never deadlock on each other.
+           Only reindexing, whose cycle check may walk any part of the graph,
+             escalates to the whole index: every fine-grained command holds
+             the shared side of an escalation ReadWriteLock, and a reindex
+             holds its exclusive side (which is also self.lock)."""
+        PackageIndex.__init__(self, "lockfree")
+        escalationLock= ReadWriteLock()
+        self.lock= escalationLock.getWriteLock()
+        self.readLock= self.lock
+        self.sharedLock= escalationLock.getReadLock()
+        self.orderLock= Lock()
 
-    def runCommand(self):
-        return self.handlerFunc(self.packageName, self.dependencies)
+    def addToOrder(self, entryPtr):
+        """Same as PackageIndex.addToOrder, but safe to call concurrently."""
+        with self.orderLock:
+            PackageIndex.addToOrder(self, entryPtr)
 
+    def removeFromOrder(self, entryPtr):
+        """Same as PackageIndex.removeFromOrder, but safe to call concurrently."""
+        with self.orderLock:
+            PackageIndex.removeFromOrder(self, entryPtr)
 
-class IndexThread(Thread):
-    def __init__(self, threadId, cltSock, indexPtr):
-        """Class to serve as a handling thread to handle each new client
-             that connects to the indexer."""
-        Thread.__init__(self)
-        self.threadId= threadId
+    def lockEntries(self, entryPtrs):
+        """Acquires the locks of every entry in <entryPtrs> in a deterministic
+             (name) order, to avoid deadlocks.
+           Returns: list of the acquired locks, for unlockEntries.
+           Precondition: entryPtrs is an iterable of IndexEntry instances."""
+        locks= [entry.getLock() for entry in sorted(entryPtrs, key=IndexEntry.getName)]
+        for lock in locks:
+            lock.acquire()
+        return locks
+
+    def unlockEntries(self, locks):
+        """Releases locks acquired with lockEntries, in reverse order."""
+        for lock in reversed(locks):
+            lock.release()
+
+    def indexNew(self, pkg, deps):
+        """Adds <pkg> to the index while holding only its own lock and the
+             locks of its dependencies.
+           Returns: RESP_OK or RESP_FAIL as handleIndex would, or None if pkg
+             is already indexed and the caller must escalate to a reindex.
+           Precondition: pkg is a str; deps is a list of str; caller holds
+             self.sharedLock."""
+        depPtrs= []
+        for dep in deps:
+            depPtr= self.entries.get(dep)
+            if depPtr == None:
+                if tracing.debugOn:
+                    tracing.emit(tracing.DEBUG, "index.missingDependency", package=pkg, dependency=dep)
+                return RESP_FAIL
+            depPtrs.append(depPtr)
+        if pkg in self.entries:
+            return None
+        if tracing.debugOn:
+            tracing.emit(tracing.DEBUG, "index.create", package=pkg)
+        newEntry= IndexEntry(pkg)
+        locks= self.lockEntries(depPtrs + [newEntry])
+        try:
+            #A dependency may have been removed before we locked it
+            for depPtr in depPtrs:
+                if self.entries.get(depPtr.getName()) is not depPtr:
+                    return RESP_FAIL
+            #Atomically publish the new entry, unless another INDEX beat us to it
+            if self.entries.setdefault(pkg, newEntry) is not newEntry:
+                return None
+            self.addToOrder(newEntry)
+            for depPtr in depPtrs:
+                self.linkDependency(newEntry, depPtr)
+            #Logged under the entry locks, so dependent mutations log in order
+            self.logMutation("INDEX", pkg, deps)
+            return RESP_OK
+        finally:
+            self.unlockEntries(locks)
+
+    def handleIndex(self, pkg, deps):
+        """Returns: RESP_OK if pkg was successfully added to or updated in the index;
+             RESP_FAIL otherwise.
+           Precondition: pkg is a str; deps is a list of str."""
+        with self.sharedLock:
+            result= self.indexNew(pkg, deps)
+        if result != None:
+            return result
+        return PackageIndex.handleIndex(self, pkg, deps)
+
+    def handleRemove(self, pkg, deps):
+        """Returns: RESP_OK if pkg isn't in the index or could be removed
+             successfully; RESP_FAIL otherwise.
+           Precondition: pkg is a str; deps is a list of str."""
+        with self.sharedLock:
+            while True:
+                entry= self.entries.get(pkg)
+                if entry == None:
+                    if tracing.debugOn:
+                        tracing.emit(tracing.DEBUG, "remove.notIndexed", package=pkg)
+                    return RESP_OK
+                #Reindexes are excluded, but an INDEX that just published entry
+                #may still be linking its dependencies until we hold its lock
+                depPtrs= list(entry.getDependencies())
+                locks= self.lockEntries(depPtrs + [entry])
+                try:
+                    if self.entries.get(pkg) is not entry:
+                        return RESP_OK
+                    if list(entry.getDependencies()) != depPtrs:
+                        continue
+                    if len(entry.getDependees()) > 0:
+                        if tracing.debugOn:
+                            tracing.emit(tracing.DEBUG, "remove.hasDependees", package=pkg,
+                                numDependees=len(entry.getDependees()))
+                        return RESP_FAIL
+                    for depPtr in depPtrs:
+                        self.unlinkDependency(entry, depPtr)
+                    del self.entries[pkg]
+                    self.removeFromOrder(entry)
+                    self.closureCache.invalidatePackage(pkg)
+                    self.reachability.removePackage(pkg)
+                    self.logMutation("REMOVE", pkg, deps)
+                    return RESP_OK
+                finally:
+                    self.unlockEntries(locks)
+
+
+class ShardedPackageIndex(PackageIndex):
+    def __init__(self, numShards=DEFAULT_NUM_SHARDS):
+        """Index split into <numShards> partitions by the hash of each
+             package's name, each with its own entries and lock, so that
+             commands on different shards don't wait for each other:
+             -QUERY locks the package's shard
+             -REMOVE and a fresh INDEX lock the shards of the package and of
+              its direct dependencies (whose dependee sets change)
+           Shard locks are always acquired in shard number order, so two
+             commands can never deadlock on each other.
+           Only a reindex can add an edge between two existing packages, so
+             reindexes run one at a time (under self.reindexLock).  That keeps
+             every path between existing packages fixed during a reindex's
+             cycle check, which then only needs to lock one shard at a time
+             while it walks the graph, and the rest of the index stays
+             available (see reindex).
+           There is no global lock for a maintained install order, so this
+             index computes the order when it's asked for instead.  self.lock
+             takes the reindex lock and every shard lock, for the callers that
+             need the whole index at once (batches, bulk loads, snapshots)."""
+        PackageIndex.__init__(self)
+        self.shards= [IndexShard() for i in range(numShards)]
+        self.entries= ShardedEntries(self)
+        self.reindexLock= Lock()
+        self.lock= LockHandle(self.lockAll, self.unlockAll)
+        self.readLock= self.lock
+
+    def getShard(self, pkg):
+        """Returns: the IndexShard that <pkg> belongs in."""
+        return self.shards[hash(pkg) % len(self.shards)]
+
+    def lockShards(self, pkgs):
+        """Acquires the locks of the shards of every package in <pkgs>, each
+             once and in shard number order, to avoid deadlocks.
+           Returns: list of the acquired locks, for unlockShards.
+           Precondition: pkgs is an iterable of str."""
+        shardNums= sorted(set([hash(pkg) % len(self.shards) for pkg in pkgs]))
+        locks= [self.shards[shardNum].lock for shardNum in shardNums]
+        for lock in locks:
+            lock.acquire()
+        return locks
+
+    def unlockShards(self, locks):
+        """Releases locks acquired with lockShards, in reverse order."""
+        for lock in reversed(locks):
+            lock.release()
+
+    def lockAll(self):
+        """Acquires the reindex lock and then every shard lock."""
+        self.reindexLock.acquire()
+        for shard in self.shards:
+            shard.lock.acquire()
+
+    def unlockAll(self):
+        """Releases the locks acquired by lockAll."""
+        for shard in reversed(self.shards):
+            shard.lock.release()
+        self.reindexLock.release()
+
+    def addToOrder(self, entryPtr):
+        """Does nothing: this index has no maintained install order."""
+        pass
+
+    def removeFromOrder(self, entryPtr):
+        """Does nothing: this index has no maintained install order."""
+        pass
+
+    def getTopologicalOrder(self):
+        """Returns: list of every IndexEntry in the index, ordered so that each
+             one comes after all of its dependencies (Kahn's algorithm).
+           Precondition: caller holds self.lock."""
+        numPending= {}
+        ready= []
+        for shard in self.shards:
+            for entry in shard.entries.itervalues():
+                numPending[entry]= len(entry.dependencies)
+                if numPending[entry] == 0:
+                    ready.append(entry)
+        order= []
+        while ready:
+            entry= ready.pop()
+            order.append(entry)
+            for dependee in entry.dependees:
+                numPending[dependee]-= 1
+                if numPending[dependee] == 0:
+                    ready.append(dependee)
+        return order
+
+    def getInstallOrder(self):
+        """Returns: list of the names of every package in the index, ordered
+             so that each package comes after all of its dependencies."""
+        with self.readLock:
+            return [entry.getName() for entry in self.getTopologicalOrder()]
+
+    def iterEntries(self):
+        """Same as PackageIndex.iterEntries, with the install order computed
+             on the spot."""
+        for entry in self.getTopologicalOrder():
+            yield (entry.name, sorted([dep.name for dep in entry.dependencies]))
+
+    def reaches(self, startPtrs, target, lockShards):
+        """Returns: True if <target> is one of the entries in <startPtrs>, or
+             any of them (transitively) depends on it; False otherwise.
+           Precondition: startPtrs is an iterable of IndexEntry instances;
+             target is an IndexEntry instance.  If lockShards is True, the
+             caller holds self.reindexLock and this locks each entry's shard
+             while reading its dependencies; otherwise the caller holds
+             self.lock."""
+        visited= set()
+        stack= list(startPtrs)
+        while stack:
+            node= stack.pop()
+            if node is target:
+                metrics.trace.cycleVisits+= len(visited)
+                return True
+            if node in visited:
+                continue
+            visited.add(node)
+            if lockShards:
+                with self.getShard(node.name).lock:
+                    stack.extend(list(node.dependencies))
+            else:
+                stack.extend(node.dependencies)
+        metrics.trace.cycleVisits+= len(visited)
+        return False
+
+    def hasCycle(self, root, newDepPtrs):
+        """Returns: True if making <root> depend on every entry in <newDepPtrs>
+             would create a cycle; False otherwise.
+           Precondition: root is an IndexEntry instance; newDepPtrs is a list
+             of IndexEntry instances; caller holds self.lock."""
+        if tracing.traceOn:
+            tracing.emit(tracing.TRACE, "hasCycle", package=root.name,
+                newDeps=[dep.name for dep in newDepPtrs])
+        if not self.reachability.mayReachAny([dep.name for dep in newDepPtrs], root.name):
+            return False
+        isCycle= self.reaches(newDepPtrs, root, False)
+        if isCycle and tracing.traceOn:
+            tracing.emit(tracing.TRACE, "hasCycle.found", package=root.name,
+                visits=metrics.trace.cycleVisits)
+        return isCycle
+
+    def handleIndex(self, pkg, deps):
+        """Returns: RESP_OK if pkg was successfully added to or updated in the index;
+             RESP_FAIL otherwise.
+           Precondition: pkg is a str; deps is a list of str."""
+        while True:
+            locks= self.lockShards([pkg] + deps)
+            try:
+                #A new package can't close a cycle, since nothing depends on it yet
+                if pkg not in self.entries:
+                    return self.indexPackage(pkg, deps)
+            finally:
+                self.unlockShards(locks)
+            result= self.reindex(pkg, deps)
+            if result != None:
+                return result
+
+    def reindex(self, pkg, deps):
+        """Updates <pkg>'s dependencies to <deps>, unless that would create a
+             cycle.  The cycle check runs holding only the reindex lock (and
+             one shard lock at a time), and the edges are then swapped in under
+             the locks of the shards involved.  Nothing can add a path between
+             existing packages in between, since only reindexes can, and a
+             package created in between can't be reached from an existing
+             one; removals only take paths away.
+           Returns: RESP_OK or RESP_FAIL as handleIndex would, or None if pkg
+             was removed before it could be reindexed, and the caller must
+             index it again as a new package.
+           Precondition: pkg is a str; deps is a list of str."""
+        with self.reindexLock:
+            while True:
+                with self.getShard(pkg).lock:
+                    entry= self.getShard(pkg).entries.get(pkg)
+                    if entry == None:
+                        return None
+                    oldDeps= [dep.name for dep in entry.dependencies]
+                if tracing.debugOn:
+                    tracing.emit(tracing.DEBUG, "index.update", package=pkg)
+                newDepPtrs= []
+                for dep in deps:
+                    with self.getShard(dep).lock:
+                        depPtr= self.getShard(dep).entries.get(dep)
+                    if depPtr == None or depPtr is entry:
+                        if depPtr == None and tracing.debugOn:
+                            tracing.emit(tracing.DEBUG, "index.missingDependency", package=pkg,
+                                dependency=dep)
+                        return RESP_FAIL
+                    newDepPtrs.append(depPtr)
+                onlyNewPtrs= [dep for dep in newDepPtrs if dep.name not in oldDeps]
+                #The labels rule most cycles out without walking the graph
+                onlyNewDeps= [dep.name for dep in onlyNewPtrs]
+                if self.reachability.mayReachAny(onlyNewDeps, pkg) and self.reaches(onlyNewPtrs, entry, True):
+                    return RESP_FAIL
+                locks= self.lockShards([pkg] + deps + oldDeps)
+                try:
+                    if self.entries.get(pkg) is not entry:
+                        continue
+                    #A dependency that was removed and recreated since the
+                    #cycle check may depend on pkg now, so check again
+                    if any([self.entries.get(dep.name) is not dep for dep in newDepPtrs]):
+                        continue
+                    newDepSet= set(newDepPtrs)
+                    for dep in list(entry.dependencies):
+                        if dep not in newDepSet:
+                            self.unlinkDependency(entry, dep)
+                    for dep in onlyNewPtrs:
+                        self.linkDependency(entry, dep)
+                    self.logMutation("INDEX", pkg, deps)
+                    return RESP_OK
+                finally:
+                    self.unlockShards(locks)
+
+    def handleRemove(self, pkg, deps):
+        """Returns: RESP_OK if pkg isn't in the index or could be removed
+             successfully; RESP_FAIL otherwise.
+           Precondition: pkg is a str; deps is a list of str."""
+        while True:
+            shard= self.getShard(pkg)
+            with shard.lock:
+                entry= shard.entries.get(pkg)
+                if entry == None:
+                    if tracing.debugOn:
+                        tracing.emit(tracing.DEBUG, "remove.notIndexed", package=pkg)
+                    return RESP_OK
+                if len(entry.dependees) > 0:
+                    if tracing.debugOn:
+                        tracing.emit(tracing.DEBUG, "remove.hasDependees", package=pkg,
+                            numDependees=len(entry.dependees))
+                    return RESP_FAIL
+                depNames= [dep.name for dep in entry.dependencies]
+                if len(depNames) == 0:
+                    return self.removePackage(pkg, deps)
+            locks= self.lockShards([pkg] + depNames)
+            try:
+                #Retry if a reindex changed the entry while no lock was held
+                if shard.entries.get(pkg) is not entry:
+                    continue
+                if [dep.name for dep in entry.dependencies] != depNames:
+                    continue
+                return self.removePackage(pkg, deps)
+            finally:
+                self.unlockShards(locks)
+
+    def handleQuery(self, pkg, deps):
+        """Returns: RESP_OK if <pkg> has an entry in the index; RESP_FAIL otherwise.
+           Precondition: pkg is a str; deps is a list of str."""
+        shard= self.getShard(pkg)
+        with shard.lock:
+            if pkg not in shard.entries:
+                return RESP_FAIL
+            return RESP_OK
+
+
+class IndexShard(object):
+    def __init__(self):
+        """Class to model one partition of a ShardedPackageIndex: the entries
+             of the package names that hash to it, and the lock that guards
+             them (and their edge sets)."""
+        self.entries= {}
+        self.lock= Lock()
+
+
+class ShardedEntries(object):
+    def __init__(self, indexPtr):
+        """Class to present the shards of <indexPtr> as the single name->entry
+             dict that the rest of PackageIndex expects (as self.entries).
+             Each operation goes to the dict of the name's shard; callers hold
+             that shard's lock, as they would the index lock."""
+        self.indexPtr= indexPtr
+
+    def __contains__(self, name):
+        return name in self.indexPtr.getShard(name).entries
+
+    def __getitem__(self, name):
+        return self.indexPtr.getShard(name).entries[name]
+
+    def __setitem__(self, name, entryPtr):
+        self.indexPtr.getShard(name).entries[name]= entryPtr
+
+    def __delitem__(self, name):
+        del self.indexPtr.getShard(name).entries[name]
+
+    def __iter__(self):
+        for shard in self.indexPtr.shards:
+            for name in shard.entries:
+                yield name
+
+    def __len__(self):
+        return sum([len(shard.entries) for shard in self.indexPtr.shards])
+
+    def get(self, name, default=None):
+        return self.indexPtr.getShard(name).entries.get(name, default)
+
+
+class CompactPackageIndex(PackageIndex):
+    def __init__(self, concurrency="global"):
+        """Alternative storage backend for very large indexes, with the same
+             INDEX/REMOVE/QUERY semantics as PackageIndex.  Instead of one
+             IndexEntry object per package, names are interned to int ids and
+             everything else lives in flat arrays indexed by id:
+             -orders: each id's position in the install order
+             -dep/dependee offsets and targets: CSR adjacency, where the edges
+              of id i are targets[offsets[i]:offsets[i+1]]
+           Ids whose edges change after the arrays were built (including all
+             new ids) keep their edges in small overflow sets instead, and the
+             arrays are rebuilt once the overflow or freed ids pass a fraction
+             of the index, so each mutation is still O(1) amortized."""
+        PackageIndex.__init__(self, concurrency)
+        self.ids= {}
+        self.names= []
+        self.orders= array("i")
+        self.orderSlots= array("i")
+        self.depOffsets= array("i", [0])
+        self.depTargets= array("i")
+        self.depOverflow= {}
+        self.dependeeOffsets= array("i", [0])
+        self.dependeeTargets= array("i")
+        self.dependeeOverflow= {}
+        self.numBaseIds= 0
+
+    def __str__(self):
+        """Returns: repr of the index as a str, for visual debugging of small
+             indexes (see dump to inspect a large one)."""
+        lines= ["Ids:\n    %s\nEntries:" % str(self.ids)]
+        for name in self.getInstallOrder():
+            pkgId= self.ids[name]
+            lines.append("    %s (id %d):" % (name, pkgId))
+            lines.append("        Dependencies:")
+            for depId in self.getDependencyIds(pkgId):
+                lines.append("            %s" % self.names[depId])
+            lines.append("        Dependees:")
+            for dependeeId in self.getDependeeIds(pkgId):
+                lines.append("            %s" % self.names[dependeeId])
+        return "\n".join(lines)
+
+    def getNumPackages(self):
+        """Returns: number of packages in the index."""
+        return len(self.ids)
+
+    def getInstallOrder(self):
+        """Returns: list of the names of every package in the index, ordered
+             so that each package comes after all of its dependencies."""
+        with self.readLock:
+            return [self.names[pkgId] for pkgId in self.orderSlots if pkgId != -1]
+
+    def getDependencyIds(self, pkgId):
+        """Returns: iterable of the ids that <pkgId> depends on."""
+        if pkgId in self.depOverflow:
+            return self.depOverflow[pkgId]
+        if pkgId >= self.numBaseIds:
+            return ()
+        return self.depTargets[self.depOffsets[pkgId]:self.depOffsets[pkgId+1]]
+
+    def getDependeeIds(self, pkgId):
+        """Returns: iterable of the ids that depend on <pkgId>."""
+        if pkgId in self.dependeeOverflow:
+            return self.dependeeOverflow[pkgId]
+        if pkgId >= self.numBaseIds:
+            return ()
+        return self.dependeeTargets[self.dependeeOffsets[pkgId]:self.dependeeOffsets[pkgId+1]]
+
+    def getMutableDependencyIds(self, pkgId):
+        """Returns: set of the ids that <pkgId> depends on, moving them to the
+             overflow first if they still live in the CSR arrays."""
+        if pkgId not in self.depOverflow:
+            self.depOverflow[pkgId]= set(self.getDependencyIds(pkgId))
+        return self.depOverflow[pkgId]
+
+    def getMutableDependeeIds(self, pkgId):
+        """Returns: set of the ids that depend on <pkgId>, moving them to the
+             overflow first if they still live in the CSR arrays."""
+        if pkgId not in self.dependeeOverflow:
+            self.dependeeOverflow[pkgId]= set(self.getDependeeIds(pkgId))
+        return self.dependeeOverflow[pkgId]
+
+    def linkDependency(self, pkgId, depId):
+        """Adds the edge "<pkgId> depends on <depId>" to the graph."""
+        self.getMutableDependencyIds(pkgId).add(depId)
+        self.getMutableDependeeIds(depId).add(pkgId)
+        self.closureCache.invalidateEdge(self.names[pkgId], self.names[depId])
+        self.reachability.addEdge(self.names[pkgId], self.names[depId])
+
+    def unlinkDependency(self, pkgId, depId):
+        """Removes the edge "<pkgId> depends on <depId>" from the graph."""
+        self.getMutableDependencyIds(pkgId).remove(depId)
+        self.getMutableDependeeIds(depId).remove(pkgId)
+        self.closureCache.invalidateEdge(self.names[pkgId], self.names[depId])
+        self.reachability.removeEdge(self.names[pkgId], self.names[depId])
+
+    def compact(self):
+        """Rebuilds the CSR arrays from scratch, renumbering the live ids in
+             install order, and empties the overflow."""
+        liveIds= [pkgId for pkgId in self.orderSlots if pkgId != -1]
+        newIds= array("i", [-1]) * len(self.names)
+        for (newId, oldId) in enumerate(liveIds):
+            newIds[oldId]= newId
+        depOffsets= array("i", [0])
+        depTargets= array("i")
+        dependeeOffsets= array("i", [0])
+        dependeeTargets= array("i")
+        for oldId in liveIds:
+            depTargets.extend([newIds[depId] for depId in self.getDependencyIds(oldId)])
+            depOffsets.append(len(depTargets))
+            dependeeTargets.extend([newIds[depId] for depId in self.getDependeeIds(oldId)])
+            dependeeOffsets.append(len(dependeeTargets))
+        self.names= [self.names[oldId] for oldId in liveIds]
+        for (newId, name) in enumerate(self.names):
+            self.ids[name]= newId
+        self.orders= array("i", xrange(len(liveIds)))
+        self.orderSlots= array("i", xrange(len(liveIds)))
+        self.numFreeSlots= 0
+        (self.depOffsets, self.depTargets)= (depOffsets, depTargets)
+        (self.dependeeOffsets, self.dependeeTargets)= (dependeeOffsets, dependeeTargets)
+        self.depOverflow= {}
+        self.dependeeOverflow= {}
+        self.numBaseIds= len(liveIds)
+
+    def compactIfNeeded(self):
+        """Calls compact once the overflow or the freed ids outgrow the CSR
+             arrays, so that rebuilds are amortized over many mutations."""
+        numDirty= len(self.depOverflow) + len(self.dependeeOverflow) + self.numFreeSlots
+        if numDirty > max(COMPACT_MIN_OVERFLOW, self.numBaseIds / 2):
+            self.compact()
+
+    def reorder(self, pkgId, depId):
+        """Same as PackageIndex.reorder, but for ids."""
+        orders= self.orders
+        lowerBound= orders[pkgId]
+        upperBound= orders[depId]
+        forward= []
+        visited= set([pkgId])
+        stack= [pkgId]
+        while stack:
+            node= stack.pop()
+            forward.append(node)
+            for dependee in self.getDependeeIds(node):
+                if dependee == depId:
+                    metrics.trace.cycleVisits+= len(forward)
+                    return False
+                if dependee not in visited and orders[dependee] < upperBound:
+                    visited.add(dependee)
+                    stack.append(dependee)
+        backward= []
+        visited= set([depId])
+        stack= [depId]
+        while stack:
+            node= stack.pop()
+            backward.append(node)
+            for dependency in self.getDependencyIds(node):
+                if dependency not in visited and orders[dependency] > lowerBound:
+                    visited.add(dependency)
+                    stack.append(dependency)
+        metrics.trace.cycleVisits+= len(forward) + len(backward)
+        getOrder= lambda nodeId: orders[nodeId]
+        backward.sort(key=getOrder)
+        forward.sort(key=getOrder)
+        moved= backward + forward
+        slots= sorted([orders[nodeId] for nodeId in moved])
+        for (nodeId, slot) in zip(moved, slots):
+            orders[nodeId]= slot
+            self.orderSlots[slot]= nodeId
+        return True
+
+    def hasCycle(self, root, newDepPtrs):
+        """Same as PackageIndex.hasCycle, but for ids."""
+        if tracing.traceOn:
+            tracing.emit(tracing.TRACE, "hasCycle", package=self.names[root],
+                newDeps=[self.names[dep] for dep in newDepPtrs])
+        for dep in newDepPtrs:
+            if self.orders[dep] < self.orders[root]:
+                continue
+            if not self.reorder(root, dep):
+                if tracing.traceOn:
+                    tracing.emit(tracing.TRACE, "hasCycle.found", package=self.names[root],
+                        dependency=self.names[dep], visits=metrics.trace.cycleVisits)
+                return True
+        return False
+
+    def updateExisting(self, entryPtr, newDeps):
+        """Same as PackageIndex.updateExisting, but <entryPtr> is an id."""
+        existingIds= list(self.getDependencyIds(entryPtr))
+        existingIdSet= set(existingIds)
+        newDepIds= set()
+        onlyNewIds= []
+        for dep in newDeps:
+            if dep == self.names[entryPtr]:
+                return RESP_FAIL
+            depId= self.ids[dep]
+            if depId not in existingIdSet and depId not in newDepIds:
+                onlyNewIds.append(depId)
+            newDepIds.add(depId)
+        if self.hasCycle(entryPtr, onlyNewIds):
+            return RESP_FAIL
+        for depId in existingIds:
+            if depId not in newDepIds:
+                self.unlinkDependency(entryPtr, depId)
+        for depId in onlyNewIds:
+            self.linkDependency(entryPtr, depId)
+        self.compactIfNeeded()
+        return RESP_OK
+
+    def indexPackage(self, pkg, deps):
+        """Does the work of handleIndex.
+           Precondition: caller holds self.lock."""
+        for dep in deps:
+            if dep not in self.ids:
+                if tracing.debugOn:
+                    tracing.emit(tracing.DEBUG, "index.missingDependency", package=pkg, dependency=dep)
+                return RESP_FAIL
+        if pkg in self.ids:
+            if tracing.debugOn:
+                tracing.emit(tracing.DEBUG, "index.update", package=pkg)
+            if self.updateExisting(self.ids[pkg], deps) != RESP_OK:
+                return RESP_FAIL
+            self.logMutation("INDEX", pkg, deps)
+            return RESP_OK
+        if tracing.debugOn:
+            tracing.emit(tracing.DEBUG, "index.create", package=pkg)
+        pkgId= len(self.names)
+        self.names.append(pkg)
+        self.ids[pkg]= pkgId
+        self.orders.append(len(self.orderSlots))
+        self.orderSlots.append(pkgId)
+        for dep in deps:
+            self.linkDependency(pkgId, self.ids[dep])
+        self.compactIfNeeded()
+        self.logMutation("INDEX", pkg, deps)
+        return RESP_OK
+
+    def buildSorted(self, pkgs, manifest):
+        """Same as PackageIndex.buildSorted, but the arrays are only rebuilt
+             once, after every package has been added to the overflow."""
+        failed= []
+        for pkg in pkgs:
+            if pkg in self.ids:
+                if self.updateExisting(self.ids[pkg], manifest[pkg]) != RESP_OK:
+                    failed.append(pkg)
+                continue
+            pkgId= len(self.names)
+            self.names.append(pkg)
+            self.ids[pkg]= pkgId
+            self.orders.append(len(self.orderSlots))
+            self.orderSlots.append(pkgId)
+            for dep in manifest[pkg]:
+                self.linkDependency(pkgId, self.ids[dep])
+        self.compact()
+        return failed
+
+    def iterEntries(self):
+        """Same as PackageIndex.iterEntries, but for ids."""
+        for pkgId in self.orderSlots:
+            if pkgId != -1:
+                yield (self.names[pkgId], [self.names[depId] for depId in self.getDependencyIds(pkgId)])
+
+    def removePackage(self, pkg, deps):
+        """Does the work of handleRemove.
+           Precondition: caller holds self.lock."""
+        if pkg not in self.ids:
+            if tracing.debugOn:
+                tracing.emit(tracing.DEBUG, "remove.notIndexed", package=pkg)
+            return RESP_OK
+        pkgId= self.ids[pkg]
+        if len(self.getDependeeIds(pkgId)) > 0:
+            if tracing.debugOn:
+                tracing.emit(tracing.DEBUG, "remove.hasDependees", package=pkg,
+                    numDependees=len(self.getDependeeIds(pkgId)))
+            return RESP_FAIL
+        for depId in list(self.getDependencyIds(pkgId)):
+            self.unlinkDependency(pkgId, depId)
+        del self.ids[pkg]
+        self.names[pkgId]= None
+        self.orderSlots[self.orders[pkgId]]= -1
+        self.orders[pkgId]= -1
+        self.numFreeSlots+= 1
+        self.compactIfNeeded()
+        self.closureCache.invalidatePackage(pkg)
+        self.reachability.removePackage(pkg)
+        self.logMutation("REMOVE", pkg, deps)
+        return RESP_OK
+
+    def queryPackage(self, pkg, deps):
+        """Does the work of handleQuery.  In lockfree mode, note that
+             rebuilding the arrays only reassigns values in self.ids, never
+             its keys.
+           Precondition: caller holds self.readLock, or the index is in
+             lockfree mode."""
+        if pkg not in self.ids:
+            return RESP_FAIL
+        return RESP_OK
+
+    def getPackageNames(self):
+        """Same as PackageIndex.getPackageNames."""
+        return (name for name in self.names if name != None)
+
+    def getDependencyNames(self, pkg):
+        """Same as PackageIndex.getDependencyNames."""
+        if pkg not in self.ids:
+            return []
+        return [self.names[depId] for depId in self.getDependencyIds(self.ids[pkg])]
+
+    def getDependeeNames(self, pkg):
+        """Same as PackageIndex.getDependeeNames."""
+        if pkg not in self.ids:
+            return []
+        return [self.names[dependeeId] for dependeeId in self.getDependeeIds(self.ids[pkg])]
+
+    def getNumDependees(self, pkg):
+        """Same as PackageIndex.getNumDependees."""
+        return len(self.getDependeeIds(self.ids[pkg]))
+
+    def getClosure(self, pkg, reverse):
+        """Same as PackageIndex.getClosure."""
+        if pkg not in self.ids:
+            return None
+        pkgId= self.ids[pkg]
+        if reverse:
+            pkgIds= self.walkPostorder(pkgId, self.getDependeeIds)
+            pkgIds.reverse()
+        else:
+            pkgIds= self.walkPostorder(pkgId, self.getDependencyIds)
+        return [self.names[closureId] for closureId in pkgIds if closureId != pkgId]
+
+
+class MappedPackageIndex(CompactPackageIndex):
+    def __init__(self, path, concurrency="global"):
+        """Backend that serves a base file written with --export (see
+             persistence.writeBase) straight from a read-only memory map,
+             with the same INDEX/REMOVE/QUERY semantics as PackageIndex.  The
+             base is never modified or deserialized: the id map, names and
+             install order of CompactPackageIndex are replaced with views
+             that read base packages out of the mapped file, and keep every
+             change in memory on top of it (the overlay).  Changed edges live
+             in the overflow sets as usual, but are never compacted back into
+             the base, so opening even a huge base takes constant time and
+             memory."""
+        CompactPackageIndex.__init__(self, concurrency)
+        self.base= persistence.MappedBase(path)
+        numPkgs= self.base.getNumPackages()
+        self.ids= OverlayIds(self.base)
+        self.names= OverlayList(self.base.getName, numPkgs)
+        self.orders= OverlayList(self.base.getRank, numPkgs)
+        self.orderSlots= OverlayList(self.base.getSlot, numPkgs)
+        self.numBaseIds= numPkgs
+
+    def getDependencyIds(self, pkgId):
+        """Same as CompactPackageIndex.getDependencyIds, but base edges are
+             read from the mapped file."""
+        if pkgId in self.depOverflow:
+            return self.depOverflow[pkgId]
+        if pkgId >= self.numBaseIds:
+            return ()
+        return self.base.getDependencyIds(pkgId)
+
+    def getDependeeIds(self, pkgId):
+        """Same as CompactPackageIndex.getDependeeIds, but base edges are
+             read from the mapped file."""
+        if pkgId in self.dependeeOverflow:
+            return self.dependeeOverflow[pkgId]
+        if pkgId >= self.numBaseIds:
+            return ()
+        return self.base.getDependeeIds(pkgId)
+
+    def compact(self):
+        """Does nothing: the base is immutable, so the overlay is never folded
+             back into it.  Export the index again to get a new base."""
+        pass
+
+
+class OverlayIds(object):
+    def __init__(self, base):
+        """Class to model the name->id map of a MappedPackageIndex, with the
+             dict operations that CompactPackageIndex uses.  Names are looked
+             up in the overlay first, then binary searched in the mapped
+             <base>, unless that base package has been removed."""
+        self.base= base
+        self.added= {}
+        self.removedIds= set()
+
+    def lookup(self, name):
+        """Returns: int id of the live package named <name>; -1 if there is none.
+           Note: in lockfree mode, QUERY calls this without the lock, so the
+             overlay is read with a single dict operation: a check and then a
+             read could see a REMOVE happen in between."""
+        pkgId= self.added.get(name)
+        if pkgId != None:
+            return pkgId
+        pkgId= self.base.findId(name)
+        if pkgId in self.removedIds:
+            return -1
+        return pkgId
+
+    def __contains__(self, name):
+        return self.lookup(name) != -1
+
+    def __len__(self):
+        #A re-added base package is in both added and removedIds
+        return self.base.getNumPackages() - len(self.removedIds) + len(self.added)
+
+    def __getitem__(self, name):
+        pkgId= self.lookup(name)
+        if pkgId == -1:
+            raise KeyError(name)
+        return pkgId
+
+    def __setitem__(self, name, pkgId):
+        self.added[name]= pkgId
+
+    def __delitem__(self, name):
+        if name in self.added:
+            del self.added[name]
+        else:
+            self.removedIds.add(self.base.findId(name))
+
+
+class OverlayList(object):
+    def __init__(self, baseGetter, numBase):
+        """Class to model a list whose first <numBase> items are read from a
+             mapped base file with <baseGetter>, and whose writes and appends
+             are kept in memory on top of it."""
+        self.baseGetter= baseGetter
+        self.numBase= numBase
+        self.overrides= {}
+        self.appended= []
+
+    def __len__(self):
+        return self.numBase + len(self.appended)
+
+    def __getitem__(self, i):
+        if i >= self.numBase:
+            return self.appended[i - self.numBase]
+        if i in self.overrides:
+            return self.overrides[i]
+        return self.baseGetter(i)
+
+    def __setitem__(self, i, value):
+        if i >= self.numBase:
+            self.appended[i - self.numBase]= value
+        else:
+            self.overrides[i]= value
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def append(self, value):
+        self.appended.append(value)
+
+
+class ReadWriteLock(object):
+    def __init__(self):
+        """Class to model a lock that can be held by any number of readers at
+             once, or by a single writer.  Waiting writers block new readers,
+             so a steady stream of reads can't starve writes."""
+        self.cond= Condition(Lock())
+        self.numReaders= 0
+        self.numWritersWaiting= 0
+        self.hasWriter= False
+        self.readLock= LockHandle(self.acquireRead, self.releaseRead)
+        self.writeLock= LockHandle(self.acquireWrite, self.releaseWrite)
+
+    def getReadLock(self):
+        """Returns: lock-like object for the shared (reader) side."""
+        return self.readLock
+
+    def getWriteLock(self):
+        """Returns: lock-like object for the exclusive (writer) side."""
+        return self.writeLock
+
+    def acquireRead(self):
+        with self.cond:
+            while self.hasWriter or self.numWritersWaiting > 0:
+                self.cond.wait()
+            self.numReaders+= 1
+
+    def releaseRead(self):
+        with self.cond:
+            self.numReaders-= 1
+            if self.numReaders == 0:
+                self.cond.notify_all()
+
+    def acquireWrite(self):
+        with self.cond:
+            self.numWritersWaiting+= 1
+            while self.hasWriter or self.numReaders > 0:
+                self.cond.wait()
+            self.numWritersWaiting-= 1
+            self.hasWriter= True
+
+    def releaseWrite(self):
+        with self.cond:
+            self.hasWriter= False
+            self.cond.notify_all()
+
+
+class LockHandle(object):
+    def __init__(self, acquireFunc, releaseFunc):
+        """Class to wrap a pair of acquire/release functions in the same
+             interface as threading.Lock, so it can be used in with blocks."""
+        self.acquire= acquireFunc
+        self.release= releaseFunc
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+
+
+class GcPause(object):
+    def __init__(self):
+        """Class to model a with block during which Python's cyclic garbage
+             collector is paused.  Building or copying a whole graph creates
+             millions of container objects (entries, their adjacency sets,
+             dependency lists), and the collector would otherwise rescan the
+             ever growing heap over and over while they're created."""
+        self.wasEnabled= False
+
+    def __enter__(self):
+        self.wasEnabled= gc.isenabled()
+        gc.disable()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if self.wasEnabled:
+            gc.enable()
+
+
+class DumpStream(object):
+    def __init__(self, pid, readFd):
+        """Class to model the reading end of a dump that child process <pid>
+             writes to the pipe <readFd> (see PackageIndex.dump).  Iterating
+             over it yields the dump's chunks, and then reaps the child.  If
+             the child failed, the dump ends with a FAIL line instead of its
+             OK line.  Closing it early (eg: the client left) kills the child.
+           Once made non-blocking (eg: by the event loop, which polls
+             fileno()), it yields an empty str whenever the child hasn't
+             written the next chunk yet, instead of waiting for it."""
+        self.pid= pid
+        self.readFd= readFd
+        self.isBlocking= True
+
+    def __iter__(self):
+        return self
+
+    def fileno(self):
+        """Returns: fd of the pipe the dump is read from."""
+        return self.readFd
+
+    def setNonBlocking(self):
+        """Makes next() return an empty str instead of waiting for the child."""
+        if not self.isBlocking or self.readFd == None:
+            return
+        self.isBlocking= False
+        flags= fcntl.fcntl(self.readFd, fcntl.F_GETFL)
+        fcntl.fcntl(self.readFd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def next(self):
+        """Returns: the next chunk of the dump; empty str if it's non-blocking
+             and the child hasn't written one yet.
+           Raises: StopIteration once the whole dump was returned."""
+        if self.readFd == None:
+            raise StopIteration
+        try:
+            chunk= os.read(self.readFd, DUMP_CHUNK_BYTES)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return ""
+            raise
+        if len(chunk) > 0:
+            return chunk
+        if self.reap(False) != 0:
+            return RESP_FAIL
+        raise StopIteration
+
+    def close(self):
+        """Abandons the dump, killing the child if it's still writing."""
+        if self.readFd != None:
+            self.reap(True)
+
+    def reap(self, isKilled):
+        """Closes the pipe, and waits for the child to exit (after killing it
+             if <isKilled>).
+           Returns: the child's exit status."""
+        os.close(self.readFd)
+        self.readFd= None
+        if isKilled:
+            os.kill(self.pid, signal.SIGKILL)
+        (pid, status)= os.waitpid(self.pid, 0)
+        return status
+
+
+class IndexRegistry(object):
+    def __init__(self, defaultIndex, dataDirPath):
+        """Class to model the named indices a server hosts next to its default
+             one (DEFAULT_INDEX_NAME), which clients switch between with a
+             USE|<name>| command.  Each named index is a separate instance of
+             the selected backend, with locks of its own (and, with a data
+             dir, its own snapshot and log under <dataDirPath>/indices/<name>),
+             created the first time a client uses it.
+           The registry counts the sessions using each index and the packages
+             in it, and evicts idle ones:
+             -an empty index as soon as its last session leaves it
+             -with a data dir, the least recently used idle indices, whenever
+              the named indices hold more than MAX_RESIDENT_PACKAGES packages
+              in total, or MAX_NAMED_INDICES of them are open
+           Evicted indices are closed (their data dir is recovered on their
+             next use).  Without a data dir, evicting a non-empty index would
+             lose it, so those are never evicted: instead, no new index is
+             opened while there are MAX_NAMED_INDICES of them, or while they
+             hold more than MAX_RESIDENT_PACKAGES packages.  The ones already
+             open can still grow past that."""
+        self.defaultIndex= defaultIndex
+        self.dataDirPath= dataDirPath
+        self.slots= {}
+        self.lock= Lock()
+
+    def acquire(self, name):
+        """Returns: the index named <name>, opened if needed, with the caller
+             counted as one of its sessions until it calls release(name);
+             None if <name> isn't a valid index name, too many indices are
+             open, or the index couldn't be opened.
+           Precondition: name is a str."""
+        if name == DEFAULT_INDEX_NAME:
+            return self.defaultIndex
+        if not re.match(INDEX_NAME_PATTERN, name):
+            return None
+        if name not in self.slots and len(self.slots) >= MAX_NAMED_INDICES:
+            self.evictIdle(MAX_NAMED_INDICES - 1)
+        with self.lock:
+            slot= self.slots.get(name)
+            if slot == None:
+                if len(self.slots) >= MAX_NAMED_INDICES:
+                    return None
+                if self.dataDirPath == None and self.getNumResident() > MAX_RESIDENT_PACKAGES:
+                    return None
+                slot= IndexSlot(name)
+                self.slots[name]= slot
+            slot.numSessions+= 1
+            slot.lastUsedTimestamp= time.time()
+        #Only this index's lock is held while it's recovered, not the registry's
+        with slot.lock:
+            if slot.indexPtr == None:
+                try:
+                    self.openSlot(slot)
+                except Exception as e:
+                    print "Couldn't open index %s: <%s> %s" % (name, e.__class__.__name__, e)
+            indexPtr= slot.indexPtr
+        if indexPtr == None:
+            self.release(name)
+            return None
+        self.evictIdle(MAX_NAMED_INDICES)
+        return indexPtr
+
+    def getNumResident(self):
+        """Returns: number of packages in every open named index.
+           Precondition: caller holds self.lock."""
+        return sum([slot.getNumPackages() for slot in self.slots.itervalues()])
+
+    def getLockTimers(self):
+        """Returns: dict of index name->metrics.TimedLock of the default index
+             and every open named index whose lock is timed."""
+        with self.lock:
+            indexes= [(name, slot.indexPtr) for (name, slot) in self.slots.items()
+                if slot.indexPtr != None]
+        indexes.append((DEFAULT_INDEX_NAME, self.defaultIndex))
+        return dict((name, indexPtr.getLockTimer()) for (name, indexPtr) in indexes
+            if indexPtr.getLockTimer() != None)
+
+    def release(self, name):
+        """Stops counting the caller as a session of the index named <name>,
+             and evicts it if it's now idle and empty.
+           Precondition: the caller acquired it."""
+        if name == DEFAULT_INDEX_NAME:
+            return
+        with self.lock:
+            slot= self.slots[name]
+            slot.numSessions-= 1
+            isEmpty= slot.numSessions == 0 and slot.getNumPackages() == 0
+        if isEmpty:
+            self.closeSlot(slot)
+        else:
+            self.evictIdle(MAX_NAMED_INDICES)
+
+    def openSlot(self, slot):
+        """Creates the index of <slot>, and recovers it from its data dir if
+             the server has one.  It starts empty: only the default index is
+             mapped from --base.
+           Precondition: caller holds slot.lock."""
+        indexPtr= createIndex(False)
+        if self.dataDirPath != None:
+            path= os.path.join(self.dataDirPath, NAMED_INDICES_DIR, slot.name)
+            slot.store= openDataDir(indexPtr, path)
+        slot.indexPtr= indexPtr
+
+    def closeSlot(self, slot):
+        """Closes the index of <slot> and forgets it, unless a session started
+             using it again in the meantime."""
+        with slot.lock:
+            #Sessions are counted before they wait for slot.lock, so this can't
+            #close an index that someone is about to use
+            if slot.numSessions > 0 or slot.indexPtr == None:
+                return
+            if slot.store != None:
+                slot.store.close()
+            slot.indexPtr= None
+            slot.store= None
+        with self.lock:
+            if slot.numSessions == 0 and self.slots.get(slot.name) is slot:
+                del self.slots[slot.name]
+
+    def evictIdle(self, maxSlots):
+        """Evicts idle indices, least recently used first, until the named
+             indices hold at most MAX_RESIDENT_PACKAGES packages and at most
+             <maxSlots> of them are open, or nothing else can be evicted."""
+        with self.lock:
+            numPackages= self.getNumResident()
+            numSlots= len(self.slots)
+            if numPackages <= MAX_RESIDENT_PACKAGES and numSlots <= maxSlots:
+                return
+            idleSlots= [slot for slot in self.slots.itervalues() if slot.numSessions == 0]
+            idleSlots.sort(key=lambda slot: slot.lastUsedTimestamp)
+            victims= []
+            for slot in idleSlots:
+                if numPackages <= MAX_RESIDENT_PACKAGES and numSlots <= maxSlots:
+                    break
+                if slot.getNumPackages() > 0 and self.dataDirPath == None:
+                    continue
+                victims.append(slot)
+                numPackages-= slot.getNumPackages()
+                numSlots-= 1
+        for slot in victims:
+            self.closeSlot(slot)
+
+
+class IndexSlot(object):
+    def __init__(self, name):
+        """Class to model one named index in an IndexRegistry: the index
+             itself (None while it isn't open), its DurableStore if it has
+             one, how many sessions are using it and when one last did, and
+             the lock held while it's opened or closed."""
+        self.name= name
+        self.indexPtr= None
+        self.store= None
+        self.numSessions= 0
+        self.lastUsedTimestamp= time.time()
+        self.lock= Lock()
+
+    def getNumPackages(self):
+        """Returns: number of packages in this index; 0 if it isn't open."""
+        indexPtr= self.indexPtr
+        if indexPtr == None:
+            return 0
+        return indexPtr.getNumPackages()
+
+
+class ClientSession(object):
+    def __init__(self, sessionId, cltSock, indexPtr):
+        """Class to model the protocol state of one connected client: its
+             session timeout, error count, and the parsing and running of its
+             commands.  This is shared by both server cores, which only differ
+             in how they wait on the client's socket."""
+        self.sessionId= sessionId
         self.cltSock= cltSock
         self.indexPtr= indexPtr
         self.sessionSecsRemaining= MAX_SESSION_SECS
         self.lastActionTimestamp= time.time()
         self.numFailures= 0
-    
-    def run(self):
+        self.inBuf= ""
+        self.isDiscarding= False
+        self.batch= None
+        self.indexName= DEFAULT_INDEX_NAME
+        self.usedIndexes= [indexPtr]
+        self.stream= None
+        self.parser= CommandParser(indexPtr.commands)
+        serverMetrics.increment("connections")
+        if tracing.infoOn:
+            tracing.emit(tracing.INFO, "session.start", session=sessionId)
+
+    def handleData(self, data):
+        """Buffers <data> read from the client, and runs every complete
+             command line in the buffer in order.  Any number of commands may
+             arrive in one read, and one command may be split across reads.
+             A command with a streamed response (DUMP) stops the run, and
+             leaves its iterator of chunks in self.stream: the server must
+             send the responses returned so far, then every chunk, and then
+             call this again with "" to run the commands buffered behind it.
+           Returns: str of the responses to every command that was run.
+           Precondition: data is a str."""
+        lines= (self.inBuf + data).split("\n")
+        self.inBuf= lines.pop()
+        responses= []
+        for (i, line) in enumerate(lines):
+            if self.isDiscarding:
+                #Tail of a line already rejected for being too long
+                self.isDiscarding= False
+            elif len(line) >= MAX_LINE_BYTES:
+                self.numFailures+= 1
+                serverMetrics.increment("malformed")
+                responses.append(RESP_ERR)
+            else:
+                responses.append(self.handleInput(line))
+            if not self.isSessionAlive():
+                self.inBuf= ""
+                break
+            if self.stream != None:
+                self.inBuf= "\n".join(lines[i+1:] + [self.inBuf])
+                return "".join(responses)
+        if len(self.inBuf) >= MAX_LINE_BYTES:
+            if not self.isDiscarding:
+                self.numFailures+= 1
+                serverMetrics.increment("malformed")
+                responses.append(RESP_ERR)
+            self.inBuf= ""
+            self.isDiscarding= True
+        return "".join(responses)
+
+    def handleEof(self):
+        """Handles the client closing its side of the connection.
+           Returns: str of the response to an unterminated final command, if
+             there was one; empty str otherwise."""
+        if tracing.infoOn:
+            tracing.emit(tracing.INFO, "session.eof", session=self.sessionId,
+                droppedBatch=self.batch != None)
+        #An uncommitted batch is dropped without running any of it
+        self.batch= None
+        if len(self.inBuf) == 0:
+            return ""
+        self.inBuf= ""
+        self.numFailures+= 1
+        return RESP_ERR
+
+    def handleInput(self, s):
+        """Parses and runs the command in <s>, or queues it if a batch is open.
+           Returns: response str to send back to the client (empty while the
+             command is queued in a batch).
+           Precondition: s is a str, without its newline."""
+        #Index commands are parsed first, as they're nearly all of the traffic:
+        #no control line can parse as one, since none has exactly 3 fields
+        #and an index command's name
+        cmdObj= self.parser.parse(s, self.batch == None)
+        if cmdObj == None:
+            control= s.rstrip()
+            if control == BATCH_BEGIN and self.batch == None:
+                self.batch= []
+                return ""
+            if control == BATCH_COMMIT and self.batch != None:
+                return self.commitBatch()
+            if control.startswith(USE_COMMAND + "|") and self.batch == None:
+                return self.useIndex(control)
+            if control.startswith(DUMP_COMMAND + "|") and self.batch == None:
+                return self.startDump(control)
+            if control.startswith(STATS_COMMAND + "|") and self.batch == None:
+                return self.getStats(control)
+            if control.startswith(SLOWLOG_COMMAND + "|") and self.batch == None:
+                return self.getSlowLog(control)
+            if control.startswith(PROFILE_COMMAND + "|") and self.batch == None:
+                return self.startProfile(control)
+            if control.startswith(TRACE_COMMAND + "|") and self.batch == None:
+                return self.setTraceLevel(control)
+            self.numFailures+= 1
+            serverMetrics.increment("malformed")
+            if tracing.debugOn:
+                tracing.emit(tracing.DEBUG, "command.malformed", session=self.sessionId, line=s)
+        if self.batch != None:
+            self.batch.append(cmdObj)
+            if len(self.batch) >= MAX_BATCH_COMMANDS:
+                return self.commitBatch() + self.handleInput(BATCH_BEGIN)
+            return ""
+        if cmdObj == None:
+            return RESP_ERR
+        metrics.trace.reset()
+        start= time.time()
+        result= cmdObj.runCommand()
+        if type(result) is ForwardedResult:
+            #Sent to the writer without waiting for it (see ReplicaIndex): the
+            #response is streamed, and recorded, once it arrives
+            cmd= cmdObj.getCommandName()
+            result.respond= lambda results: self.finishForwarded(cmd, results[0], start)
+            self.stream= result
+            return ""
+        elapsed= time.time() - start
+        serverMetrics.recordCommand(cmdObj.getCommandName(), result, elapsed)
+        if result == RESP_ERR:
+            self.countMalformed()
+        if elapsed >= slowLog.thresholdSecs:
+            slowLog.record(cmdObj.getCommandName(), elapsed, {"package": cmdObj.packageName,
+                "numDeps": len(cmdObj.dependencies)})
+        if tracing.debugOn:
+            tracing.emit(tracing.DEBUG, "command", session=self.sessionId,
+                command=cmdObj.getCommandName(), package=cmdObj.packageName,
+                deps=cmdObj.dependencies, result=result.partition("|")[0].rstrip(),
+                elapsedMs=elapsed * 1000)
+        return result
+
+    def commitBatch(self):
+        """Runs every command queued since BEGIN with a single lock
+             acquisition, and closes the batch.
+           Returns: str of the responses to every queued command, in order,
+             exactly as if they had been sent without the batch."""
+        (batch, self.batch)= (self.batch, None)
+        metrics.trace.reset()
+        start= time.time()
+        results= self.indexPtr.runBatch([cmdObj for cmdObj in batch if cmdObj != None])
+        if type(results) is ForwardedResult:
+            results.respond= lambda results: self.finishBatch(batch, results, start)
+            self.stream= results
+            return ""
+        return self.finishBatch(batch, results, start)
+
+    def finishBatch(self, batch, results, start):
+        """Records the batch <batch>, started at <start>, now that its
+             commands' <results> (for those that parsed) are in.
+           Returns: str of the responses to every command in the batch."""
+        results= iter(results)
+        elapsed= time.time() - start
+        serverMetrics.recordCommand(BATCH_COMMIT, RESP_OK, elapsed)
+        serverMetrics.increment("batched_commands", len(batch))
+        if elapsed >= slowLog.thresholdSecs:
+            slowLog.record(BATCH_COMMIT, elapsed, {"numCommands": len(batch)})
+        if tracing.debugOn:
+            tracing.emit(tracing.DEBUG, "batch", session=self.sessionId, numCommands=len(batch),
+                elapsedMs=elapsed * 1000)
+        responses= []
+        for cmdObj in batch:
+            if cmdObj == None:
+                responses.append(RESP_ERR)
+            else:
+                responses.append(results.next())
+                if responses[-1] == RESP_ERR:
+                    self.countMalformed()
+        return "".join(responses)
+
+    def finishForwarded(self, cmd, response, start):
+        """Records the command named <cmd> that this session forwarded to the
+             writer at <start>, now that its <response> arrived.
+           Returns: response."""
+        serverMetrics.recordCommand(cmd, response, time.time() - start)
+        if response == RESP_ERR:
+            self.countMalformed()
+        return response
+
+    def countMalformed(self):
+        """Counts a command that parsed, but that its handler found malformed
+             (eg: a DEPENDS without exactly one dep), toward MAX_ERRORS."""
+        self.numFailures+= 1
+        serverMetrics.increment("malformed")
+
+    def useIndex(self, s):
+        """Switches this session to the named index in the USE command <s>.
+           Returns: RESP_OK if the session now uses that index; RESP_FAIL if
+             it can't be used (eg: this server has no named indices, or the
+             name is invalid); RESP_ERR if s is malformed.
+           Precondition: s is a str starting with "USE|", without its newline."""
+        fields= s.split("|")
+        if len(fields) != 3 or len(fields[1]) == 0 or len(fields[2]) > 0:
+            self.numFailures+= 1
+            serverMetrics.increment("malformed")
+            return RESP_ERR
+        if indexRegistry == None:
+            return RESP_FAIL
+        indexPtr= indexRegistry.acquire(fields[1])
+        if indexPtr == None:
+            return RESP_FAIL
+        indexRegistry.release(self.indexName)
+        (self.indexName, self.indexPtr)= (fields[1], indexPtr)
+        self.parser.setHandlers(indexPtr.commands)
+        self.usedIndexes.append(indexPtr)
+        return RESP_OK
+
+    def startDump(self, s):
+        """Starts streaming a dump of this session's index into self.stream,
+             for the DUMP command <s> (see PackageIndex.dump).
+           Returns: empty str, since the whole response is streamed; RESP_ERR
+             if s is malformed; RESP_FAIL if the dump couldn't be started.
+           Precondition: s is a str starting with "DUMP|", without its newline."""
+        fields= s.split("|")
+        if len(fields) != 3 or fields[1] not in DUMP_FORMATS or len(fields[2]) > 0:
+            self.numFailures+= 1
+            serverMetrics.increment("malformed")
+            return RESP_ERR
+        serverMetrics.increment("dumps")
         try:
-            while self.isSessionAlive():
-                cmd= self.cltSock.recv(MAX_PKT_BYTES)
-                if len(cmd) == 0:
-                    break
-                cmdObj= self.parseInput(cmd)
-                if cmdObj == None:
-                    self.cltSock.send(RESP_ERR)
-                    self.numFailures+= 1
-                    continue
-                start= time.time()
-                result= cmdObj.runCommand()
-                if isDebug:
-                    info= (cmd.split("|")[0], (time.time()-start) * 1000)
-                    print "Elapsed time for call %s: %f ms" % info
-                self.cltSock.send(result)
-                #Done last to not count server work time in the session's duration (fairness)
-                self.updateSessionTimeout()
-        except Exception as e:
-            errMsgTup= (e.__class__.__name__, self.threadId, e)
-            print "Caught exception <%s> from client thread %d: %s" % errMsgTup
+            self.stream= self.indexPtr.dump(fields[1])
+        except OSError as e:
+            print "Couldn't start a dump for client session %d: %s" % (self.sessionId, e)
+            return RESP_FAIL
+        return ""
+
+    def getStats(self, s):
+        """Returns: response to the STATS command <s>: OK, followed by the
+             server's metrics and the lock times of this session's index as
+             one line of JSON (see metrics.ServerMetrics.getReport); RESP_ERR
+             if s is malformed.
+           Precondition: s is a str starting with "STATS|", without its newline."""
+        if s != STATS_COMMAND + "||":
+            self.numFailures+= 1
+            serverMetrics.increment("malformed")
+            return RESP_ERR
+        lockTimers= {}
+        if self.indexPtr.getLockTimer() != None:
+            lockTimers[self.indexName]= self.indexPtr.getLockTimer()
+        return "OK|%s\n" % serverMetrics.getJson(lockTimers)
+
+    def getSlowLog(self, s):
+        """Returns: response to the SLOWLOG command <s>: OK, followed by the
+             slow log's entries as one line of JSON (see metrics.SlowLog);
+             RESP_ERR if s is malformed.
+           Precondition: s is a str starting with "SLOWLOG|", without its newline."""
+        if s != SLOWLOG_COMMAND + "||":
+            self.numFailures+= 1
+            serverMetrics.increment("malformed")
+            return RESP_ERR
+        return "OK|%s\n" % json.dumps(slowLog.getEntries(), sort_keys=True, separators=(",", ":"))
+
+    def startProfile(self, s):
+        """Starts sampling the stacks of every thread in this process for the
+             number of secs in the PROFILE command <s> (see metrics.StackSampler).
+           Returns: OK, followed by the path the collapsed stacks will be
+             written to once it's done; RESP_FAIL if a profile is already
+             running; RESP_ERR if s is malformed.
+           Precondition: s is a str starting with "PROFILE|", without its newline."""
+        fields= s.split("|")
         try:
-            self.cltSock.shutdown(socket.SHUT_RDWR)
-            self.cltSock.close()
+            assert(len(fields) == 3 and len(fields[2]) == 0)
+            durationSecs= float(fields[1])
+            assert(0 < durationSecs <= metrics.PROFILE_MAX_SECS)
         except:
-            pass
+            self.numFailures+= 1
+            serverMetrics.increment("malformed")
+            return RESP_ERR
+        global profiler
+        with profilerLock:
+            if profiler != None and profiler.isAlive():
+                return RESP_FAIL
+            #A fresh file that only we can open, since any client can ask for one
+            (fd, path)= tempfile.mkstemp(prefix="indexer-%d-" % os.getpid(), suffix=".folded")
+            profiler= metrics.StackSampler(durationSecs, fd, path)
+            profiler.start()
+        return "OK|%s\n" % path
+
+    def setTraceLevel(self, s):
+        """Sets the trace level of this process (see tracing) to the one named
+             in the TRACE command <s>, eg: "TRACE|debug|".  It takes effect at
+             once, for every session.
+           Returns: RESP_OK; RESP_ERR if s is malformed.
+           Precondition: s is a str starting with "TRACE|", without its newline."""
+        fields= s.split("|")
+        if len(fields) != 3 or tracing.getLevel(fields[1]) == None or len(fields[2]) > 0:
+            self.numFailures+= 1
+            serverMetrics.increment("malformed")
+            return RESP_ERR
+        tracing.setLevel(tracing.getLevel(fields[1]))
+        return RESP_OK
+
+    def closeStream(self):
+        """Abandons the streamed response in progress, if any."""
+        if self.stream != None:
+            self.stream.close()
+            self.stream= None
+
+    def popUsedIndexes(self):
+        """Returns: list of every index this session ran commands on since the
+             last call, whose logs its responses must wait for."""
+        (usedIndexes, self.usedIndexes)= (self.usedIndexes, [self.indexPtr])
+        return usedIndexes
+
+    def handleClose(self):
+        """Releases the named index this session was using, if any, once its
+             connection is closed."""
+        if tracing.infoOn:
+            tracing.emit(tracing.INFO, "session.end", session=self.sessionId,
+                secsRemaining=self.sessionSecsRemaining, numFailures=self.numFailures)
+        self.closeStream()
+        if indexRegistry != None:
+            indexRegistry.release(self.indexName)
+        self.indexName= DEFAULT_INDEX_NAME
 
     def updateSessionTimeout(self):
         """Reduces the remaining time in this client's session by subtracting
@@ -270,31 +2682,570 @@ class IndexThread(Thread):
         return isAlive
 
 
-    def parseInput(self, s):
-        """Returns: IndexCommand object if the command could be successfully
-             parsed; None otherwise.
-           Precondition: s is a string."""
-        if not isinstance(s, str):
-            return None
-        if not re.match(".*\n", s):
-            return None
-        s= s.rstrip()
-        if s.count("|") != 2:
-            return None
-        (cmd, pkg, deps)= s.split("|")
-        #Parse command portion
-        cmdHandlerPtr= self.indexPtr.getHandlerPtr(cmd)
-        if cmdHandlerPtr == None:
-            return None
-        #Parse package portion
-        if len(pkg) == 0:
+class IndexThread(Thread, ClientSession):
+    def __init__(self, threadId, cltSock, indexPtr):
+        """Class to serve as a handling thread to handle each new client
+             that connects to the indexer."""
+        Thread.__init__(self)
+        ClientSession.__init__(self, threadId, cltSock, indexPtr)
+        self.threadId= threadId
+    
+    def run(self):
+        try:
+            while self.isSessionAlive():
+                data= self.cltSock.recv(MAX_PKT_BYTES)
+                if len(data) == 0:
+                    self.cltSock.sendall(self.handleEof())
+                    break
+                self.sendResponses(self.handleData(data))
+                while self.stream != None:
+                    for chunk in self.stream:
+                        self.cltSock.sendall(chunk)
+                    self.stream= None
+                    self.sendResponses(self.handleData(""))
+                #Done last to not count server work time in the session's duration (fairness)
+                self.updateSessionTimeout()
+        except Exception as e:
+            errMsgTup= (e.__class__.__name__, self.threadId, e)
+            print "Caught exception <%s> from client thread %d: %s" % errMsgTup
+            if tracing.infoOn:
+                tracing.emit(tracing.INFO, "session.exception", session=self.sessionId,
+                    error=e.__class__.__name__, message=str(e))
+        self.handleClose()
+        try:
+            self.cltSock.shutdown(socket.SHUT_RDWR)
+            self.cltSock.close()
+        except:
+            pass
+
+    def sendResponses(self, responses):
+        """Sends <responses> (all of the responses to one read, in order) with
+             one sendall, once every mutation they acknowledge is durable."""
+        for indexPtr in self.popUsedIndexes():
+            indexPtr.waitDurable()
+        self.cltSock.sendall(responses)
+
+
+class EventLoopSession(ClientSession):
+    def __init__(self, sessionId, cltSock, indexPtr):
+        """Class to model one client of the EventLoopServer: a ClientSession
+             plus the buffering a non-blocking socket needs."""
+        ClientSession.__init__(self, sessionId, cltSock, indexPtr)
+        self.pendingOutput= ""
+        self.lastRecvTimestamp= time.time()
+        self.isClosing= False
+        self.isWaitingStream= False
+
+
+class EventLoopServer(object):
+    def __init__(self, srvSock, indexPtr):
+        """Class to serve every client from a single thread, using a
+             readiness loop (epoll where available, poll otherwise) instead of
+             one IndexThread per connection.  It speaks the same protocol and
+             enforces the same session timeout, socket timeout and error limit
+             as IndexThread, but each connection only costs a socket and a
+             small EventLoopSession rather than an OS thread."""
+        self.srvSock= srvSock
+        self.indexPtr= indexPtr
+        self.sessions= {}
+        self.answeredSessions= []
+        self.streamSessions= {}
+        self.nextSessionId= 1
+        self.lastSweepTimestamp= time.time()
+        self.isAcceptPaused= False
+        if hasattr(select, "epoll"):
+            self.poller= select.epoll()
+            self.pollUnitsPerSec= 1.0
+        else:
+            self.poller= select.poll()
+            self.pollUnitsPerSec= 1000.0
+
+    def serveForever(self):
+        """Accepts and services clients until the process is killed."""
+        self.srvSock.setblocking(0)
+        self.poller.register(self.srvSock.fileno(), select.POLLIN)
+        while True:
+            events= self.poller.poll(EVENT_LOOP_SWEEP_SECS * self.pollUnitsPerSec)
+            for (fd, eventMask) in events:
+                if fd == self.srvSock.fileno():
+                    self.acceptClients()
+                elif fd in self.sessions:
+                    self.serviceClient(self.sessions[fd], eventMask)
+                elif fd in self.streamSessions:
+                    self.serviceStream(self.streamSessions[fd])
+            self.flushAnswered()
+            if time.time() - self.lastSweepTimestamp >= EVENT_LOOP_SWEEP_SECS:
+                self.closeIdleClients()
+                #Out of fds system-wide (ENFILE), one of ours closing may not help
+                self.resumeAccepting()
+
+    def acceptClients(self):
+        """Accepts every pending connection on the server socket.  Once out
+             of fds, it stops polling the server socket, which would otherwise
+             stay readable and spin the loop, until a session closes or the
+             next sweep."""
+        while True:
+            try:
+                (cliSock, addr)= self.srvSock.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                #The client gave up before we got to it
+                if e.errno in (errno.ECONNABORTED, errno.EPROTO, errno.EINTR):
+                    continue
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    serverMetrics.increment("accept_pauses")
+                    self.poller.unregister(self.srvSock.fileno())
+                    self.isAcceptPaused= True
+                    return
+                raise
+            cliSock.setblocking(0)
+            session= EventLoopSession(self.nextSessionId, cliSock, self.indexPtr)
+            self.sessions[cliSock.fileno()]= session
+            self.poller.register(cliSock.fileno(), select.POLLIN)
+            self.nextSessionId+= 1
+
+    def resumeAccepting(self):
+        """Polls the server socket again, if acceptClients paused it."""
+        if self.isAcceptPaused:
+            self.poller.register(self.srvSock.fileno(), select.POLLIN)
+            self.isAcceptPaused= False
+
+    def serviceClient(self, session, eventMask):
+        """Reads, runs and answers whatever <session>'s socket is ready for,
+             closing the session if it ended or misbehaved."""
+        try:
+            if eventMask & select.POLLOUT:
+                self.flushOutput(session)
+                if len(session.pendingOutput) == 0 and session.stream != None and not session.isWaitingStream:
+                    self.pumpStream(session)
+                isDone= session.isClosing or not session.isSessionAlive()
+                if isDone and len(session.pendingOutput) == 0 and session.stream == None:
+                    self.closeClient(session)
+            elif eventMask & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                data= session.cltSock.recv(MAX_PKT_BYTES)
+                if session.stream != None and len(data) == 0:
+                    #Only a hangup gets here mid-stream, and the rest can't be sent now
+                    self.closeClient(session)
+                    return
+                elif session.stream != None:
+                    #Keep anything the hangup carried
+                    session.inBuf+= data
+                elif len(data) == 0:
+                    session.pendingOutput+= session.handleEof()
+                    session.isClosing= True
+                else:
+                    session.lastRecvTimestamp= time.time()
+                    session.pendingOutput+= session.handleData(data)
+                session.updateSessionTimeout()
+                #Its responses are sent by flushAnswered, after this round of events
+                self.answeredSessions.append(session)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.closeClient(session)
+        except Exception as e:
+            errMsgTup= (e.__class__.__name__, session.sessionId, e)
+            print "Caught exception <%s> from client session %d: %s" % errMsgTup
+            if tracing.infoOn:
+                tracing.emit(tracing.INFO, "session.exception", session=session.sessionId,
+                    error=e.__class__.__name__, message=str(e))
+            self.closeClient(session)
+
+    def flushAnswered(self):
+        """Sends the responses of every session that ran commands in this
+             round of events, once the mutations they acknowledge are
+             durable.  The whole round waits for each index's log once, so all
+             of its clients share one group commit instead of waiting one by
+             one."""
+        (answered, self.answeredSessions)= (self.answeredSessions, [])
+        usedIndexes= set([self.indexPtr])
+        for session in answered:
+            usedIndexes.update(session.popUsedIndexes())
+        for indexPtr in usedIndexes:
+            indexPtr.waitDurable()
+        for session in answered:
+            self.serviceClient(session, select.POLLOUT)
+
+    def flushOutput(self, session):
+        """Sends as much of <session>'s pending output as the socket accepts,
+             and only waits for writability while some of it remains."""
+        if len(session.pendingOutput) > 0:
+            numSent= session.cltSock.send(session.pendingOutput)
+            session.pendingOutput= session.pendingOutput[numSent:]
+        eventMask= select.POLLIN
+        if len(session.pendingOutput) > 0 or (session.stream != None and not session.isWaitingStream):
+            eventMask= select.POLLOUT
+        elif session.isWaitingStream:
+            #Nothing to do for the client until the stream's pipe is readable
+            eventMask= 0
+        self.poller.modify(session.cltSock.fileno(), eventMask)
+
+    def pumpStream(self, session):
+        """Queues the next chunk of <session>'s streamed response (eg: a
+             DUMP) once the last one is sent.  Once the stream is finished,
+             runs the commands the client sent behind it, and queues their
+             responses once they're durable.  Waiting here holds up the loop
+             for that one log sync, but only happens once per stream.
+           The stream is read without blocking: if its next chunk isn't ready
+             yet, its pipe is polled along with the clients, and the session
+             is pumped again once it's readable (see serviceStream)."""
+        session.stream.setNonBlocking()
+        chunk= next(session.stream, None)
+        if chunk == "":
+            self.streamSessions[session.stream.fileno()]= session
+            self.poller.register(session.stream.fileno(), select.POLLIN)
+            session.isWaitingStream= True
+        elif chunk != None:
+            session.pendingOutput= chunk
+            #A stream in progress counts as activity, like a read would
+            session.lastRecvTimestamp= time.time()
+        else:
+            session.stream= None
+            responses= session.handleData("")
+            for indexPtr in session.popUsedIndexes():
+                indexPtr.waitDurable()
+            session.pendingOutput+= responses
+        self.flushOutput(session)
+
+    def serviceStream(self, session):
+        """Pumps the next chunk of <session>'s stream, now that its pipe is
+             readable (or the child closed it)."""
+        self.stopWaitingStream(session)
+        self.serviceClient(session, select.POLLOUT)
+
+    def stopWaitingStream(self, session):
+        """Stops polling the pipe of <session>'s stream, if it was waiting on
+             it.  This must come before the stream is closed: a dump child
+             forked meanwhile holds a copy of the pipe, which keeps it in the
+             poller even once this process closes its fd."""
+        if session.isWaitingStream:
+            fd= session.stream.fileno()
+            self.poller.unregister(fd)
+            del self.streamSessions[fd]
+            session.isWaitingStream= False
+
+    def closeIdleClients(self):
+        """Closes every session whose client hasn't sent anything in the last
+             MAX_SOCK_TIMEOUT_SECS, like the socket timeout in IndexThread.  A
+             session waiting on its stream is waiting on the server, not the
+             client, so it's left alone."""
+        now= time.time()
+        self.lastSweepTimestamp= now
+        for session in self.sessions.values():
+            if now - session.lastRecvTimestamp > MAX_SOCK_TIMEOUT_SECS and not session.isWaitingStream:
+                self.closeClient(session)
+
+    def closeClient(self, session):
+        """Unregisters and closes <session>'s socket."""
+        fd= session.cltSock.fileno()
+        if self.sessions.pop(fd, None) == None:
+            return
+        self.poller.unregister(fd)
+        self.stopWaitingStream(session)
+        session.handleClose()
+        try:
+            session.cltSock.shutdown(socket.SHUT_RDWR)
+            session.cltSock.close()
+        except:
+            pass
+        self.resumeAccepting()
+
+
+class ReplicationStream(object):
+    def __init__(self, mutationLog):
+        """Class to serve as the mutation log of the writer process's index in
+             --workers mode: every successful mutation is sent to each worker
+             process's WorkerLink, in the order the index made them, and then
+             passed on to <mutationLog> (eg: the write-ahead log), if any.
+           Precondition: mutationLog is None or has append(cmd, pkg, deps)
+             and waitDurable() methods."""
+        self.mutationLog= mutationLog
+        self.links= []
+        self.lock= Lock()
+
+    def addLink(self, link):
+        """Starts sending every new mutation to <link>."""
+        with self.lock:
+            self.links.append(link)
+
+    def removeLink(self, link):
+        """Stops sending mutations to <link> (eg: its worker exited)."""
+        with self.lock:
+            self.links.remove(link)
+
+    def append(self, cmd, pkg, deps):
+        """Sends a record of a successful mutation to every worker.
+           Precondition: caller holds the lock(s) the mutation was made under."""
+        if self.mutationLog != None:
+            self.mutationLog.append(cmd, pkg, deps)
+        line= "%s|%s|%s\n" % (cmd, pkg, ",".join(deps))
+        #One lock around the whole fan-out, so every worker gets the same order
+        with self.lock:
+            for link in self.links:
+                try:
+                    link.send(line)
+                except socket.error:
+                    #A dead worker is dropped once its process is reaped
+                    pass
+
+    def waitDurable(self):
+        """Blocks until the calling thread's mutations are durable in the
+             underlying log, if there is one."""
+        if self.mutationLog != None:
+            self.mutationLog.waitDurable()
+
+
+class WorkerLink(Thread):
+    def __init__(self, workerId, pid, workerSock, indexPtr):
+        """Class to model the writer process's end of its connection to one
+             worker process.  This thread runs every command the worker
+             forwards (single INDEX/REMOVEs, or whole batches) on <indexPtr>,
+             the one writable index, and sends their results back over
+             <workerSock>.  The ReplicationStream sends every mutation over
+             the same socket, and a result always follows the mutation it
+             reports, so the worker has applied it by the time it answers.
+           Precondition: workerSock is one end of a socketpair whose other end
+             is held by a ReplicaIndex in process <pid>."""
+        Thread.__init__(self)
+        self.daemon= True
+        self.workerId= workerId
+        self.pid= pid
+        self.workerSock= workerSock
+        self.indexPtr= indexPtr
+        self.sendLock= Lock()
+        self.parser= CommandParser(indexPtr.commands)
+
+    def send(self, data):
+        """Sends <data> to the worker, whole, without interleaving it with
+             other threads' sends."""
+        with self.sendLock:
+            self.workerSock.sendall(data)
+
+    def run(self):
+        reader= self.workerSock.makefile("rb")
+        try:
+            #Each request is a line with its number of commands, then the commands
+            for line in iter(reader.readline, ""):
+                cmdObjs= [self.parseForwarded(reader.readline()) for i in range(int(line))]
+                metrics.trace.reset()
+                start= time.time()
+                if len(cmdObjs) == 1:
+                    results= [cmdObjs[0].runCommand()]
+                else:
+                    results= self.indexPtr.runBatch(cmdObjs)
+                elapsed= time.time() - start
+                #The worker's slow log can't see the cycle checks, which run here
+                if elapsed >= slowLog.thresholdSecs and len(cmdObjs) == 1:
+                    slowLog.record(cmdObjs[0].getCommandName(), elapsed, {"package":
+                        cmdObjs[0].packageName, "numDeps": len(cmdObjs[0].dependencies)})
+                elif elapsed >= slowLog.thresholdSecs:
+                    slowLog.record(BATCH_COMMIT, elapsed, {"numCommands": len(cmdObjs)})
+                self.indexPtr.waitDurable()
+                self.send("=%d\n%s" % (len(results), "".join(results)))
+        except Exception as e:
+            errMsgTup= (e.__class__.__name__, self.workerId, e)
+            print "Caught exception <%s> from the link to worker %d: %s" % errMsgTup
+
+    def parseForwarded(self, line):
+        """Returns: IndexCommand object for the forwarded command in <line>.
+           Precondition: line is a "cmd|pkg|deps" line that a ReplicaIndex
+             built from a command it already parsed."""
+        return self.parser.parse(line.rstrip("\n"))
+
+
+class ForwardedResult(object):
+    def __init__(self, isAsync):
+        """Class to model the results of commands a ReplicaIndex forwarded to
+             the writer, which its thread fills in once they arrive.  If not
+             <isAsync>, the forwarding thread simply waits for them.
+             Otherwise, the session that forwarded them leaves this in
+             session.stream as a stream of one chunk (the response built
+             from them by self.respond): it yields an empty str until they
+             arrive, and its fileno() becomes readable once they do, so the
+             event loop polls it like a dump's pipe instead of blocking."""
+        self.results= None
+        self.respond= None
+        self.isSent= False
+        self.lock= None
+        (self.readFd, self.writeFd)= (None, None)
+        if isAsync:
+            (self.readFd, self.writeFd)= os.pipe()
+        else:
+            self.lock= Lock()
+            self.lock.acquire()
+
+    def complete(self, results):
+        """Fills in the <results>, and wakes up whoever waits for them.
+           Precondition: called once, by the ReplicaIndex thread."""
+        self.results= results
+        if self.lock != None:
+            self.lock.release()
+            return
+        try:
+            os.write(self.writeFd, "!")
+        except OSError:
+            #The session was closed in the meantime
+            pass
+        finally:
+            os.close(self.writeFd)
+
+    def wait(self):
+        """Returns: the list of results, once they arrived.
+           Precondition: not isAsync."""
+        self.lock.acquire()
+        return self.results
+
+    def __iter__(self):
+        return self
+
+    def fileno(self):
+        """Returns: fd that becomes readable once the results arrived."""
+        return self.readFd
+
+    def setNonBlocking(self):
+        """Does nothing: next() never blocks."""
+        pass
+
+    def next(self):
+        """Returns: the response, once the results arrived; empty str until then.
+           Raises: StopIteration once the response was returned."""
+        if self.isSent:
+            raise StopIteration
+        if self.results == None:
+            return ""
+        self.isSent= True
+        self.close()
+        return self.respond(self.results)
+
+    def close(self):
+        """Closes the reading end of the wakeup pipe; the ReplicaIndex thread
+             closes the other end."""
+        if self.readFd != None:
+            os.close(self.readFd)
+            self.readFd= None
+
+
+class ReplicaIndex(Thread):
+    def __init__(self, indexPtr, writerSock, isAsync):
+        """Class to serve as the index of a worker process in --workers mode.
+             READ_COMMANDS (and batches of only those) are answered from
+             <indexPtr>, this process's replica of the writer's index, while
+             INDEX, REMOVE and CASCADE are forwarded to the writer process
+             over <writerSock> and wait for their result.  This thread reads that socket: it applies
+             the stream of mutations to the replica, and hands each result to
+             the command waiting for it.
+           Since a result only arrives after its own mutation and every one
+             made before it, a worker always sees the writes it acknowledged.
+             Other workers see them once they have read that far in their
+             own streams, which already hold them by then.
+           If <isAsync> (ie: with the event loop), forwarded commands don't
+             wait for their results, which would stall every other client of
+             the worker's only thread: they return a ForwardedResult instead,
+             which streams the response once it arrives."""
+        Thread.__init__(self)
+        self.daemon= True
+        self.indexPtr= indexPtr
+        self.writerSock= writerSock
+        self.isAsync= isAsync
+        self.sendLock= Lock()
+        self.waiters= deque()
+        self.commands= {
+            "INDEX": self.handleIndex,
+            "REMOVE": self.handleRemove,
+            "CASCADE": self.handleCascade,
+            "QUERY": indexPtr.handleQuery,
+            "DEPS": indexPtr.handleDeps,
+            "RDEPS": indexPtr.handleRdeps,
+            "DEPENDS": indexPtr.handleDepends
+        }
+
+    def getHandlerPtr(self, cmd):
+        """Returns: pointer to function to handle the given command if it
+             exists in this index instance; None otherwise."""
+        if cmd not in self.commands:
             return None
-        #Parse dependency portion (optional)
-        deps= deps.split(",")
-        deps= [dep for dep in deps if len(dep) > 0]
-        deps= list(set(deps))
-        #Completed command
-        return IndexCommand(cmdHandlerPtr, pkg, deps)
+        return self.commands[cmd]
+
+    def waitDurable(self):
+        """Returns at once: the writer only sends results once they're durable."""
+        pass
+
+    def dump(self, fmt):
+        """Same as PackageIndex.dump, from this process's replica."""
+        return self.indexPtr.dump(fmt)
+
+    def getLockTimer(self):
+        """Same as PackageIndex.getLockTimer, for this process's replica."""
+        return self.indexPtr.getLockTimer()
+
+    def handleIndex(self, pkg, deps):
+        """Returns: the writer's response to INDEX <pkg> with <deps>."""
+        return self.forwardOne("INDEX", pkg, deps)
+
+    def handleRemove(self, pkg, deps):
+        """Returns: the writer's response to REMOVE <pkg>."""
+        return self.forwardOne("REMOVE", pkg, deps)
+
+    def handleCascade(self, pkg, deps):
+        """Returns: the writer's response to CASCADE <pkg> with <deps>."""
+        return self.forwardOne("CASCADE", pkg, deps)
+
+    def forwardOne(self, cmd, pkg, deps):
+        """Returns: the writer's response to the command <cmd> on <pkg> with
+             <deps>; a ForwardedResult of it if isAsync."""
+        results= self.forward([(cmd, pkg, deps)])
+        if self.isAsync:
+            return results
+        return results[0]
+
+    def runBatch(self, cmdObjs):
+        """Runs a batch of only READ_COMMANDS on the replica, and forwards any
+             other batch to the writer, which runs it under one lock acquisition.
+           Returns: list of the response strs of each command, in order; a
+             ForwardedResult of it if the batch was forwarded and isAsync."""
+        cmds= [(cmdObj.getCommandName(), cmdObj.packageName, cmdObj.dependencies)
+            for cmdObj in cmdObjs]
+        if all([cmd[0] in READ_COMMANDS for cmd in cmds]):
+            return self.indexPtr.runBatch(cmdObjs)
+        return self.forward(cmds)
+
+    def forward(self, cmds):
+        """Sends every command in <cmds> to the writer as one request, and
+             waits for their results, unless isAsync.
+           Returns: list of the response strs of each command, in order; a
+             ForwardedResult of it if isAsync.
+           Precondition: cmds is a non-empty list of (cmd, pkg, deps) tuples."""
+        lines= ["%d\n" % len(cmds)]
+        lines.extend(["%s|%s|%s\n" % (cmd, pkg, ",".join(deps)) for (cmd, pkg, deps) in cmds])
+        #The writer answers each worker's requests in order, so results are
+        #matched to waiters first in, first out
+        waiter= ForwardedResult(self.isAsync)
+        with self.sendLock:
+            self.waiters.append(waiter)
+            self.writerSock.sendall("".join(lines))
+        if self.isAsync:
+            return waiter
+        return waiter.wait()
+
+    def run(self):
+        reader= self.writerSock.makefile("rb")
+        try:
+            for line in iter(reader.readline, ""):
+                #Results come as a line with their number, then one line each
+                if line.startswith("="):
+                    waiter= self.waiters.popleft()
+                    waiter.complete([reader.readline() for i in range(int(line[1:]))])
+                    continue
+                (cmd, pkg, deps)= line.rstrip("\n").split("|")
+                deps= [dep for dep in deps.split(",") if len(dep) > 0]
+                self.indexPtr.getHandlerPtr(cmd)(pkg, deps)
+        except Exception as e:
+            print "Caught exception <%s> from the writer stream: %s" % (e.__class__.__name__, e)
+        #Without the stream, this replica would silently fall behind
+        print "Worker lost its connection to the writer process, exiting"
+        sys.stdout.flush()
+        os._exit(1)
 
 
 #---------------------- Server Functions -------------------------
@@ -307,12 +3258,137 @@ def parseFlags():
     if "--localhost" in sys.argv:
         global useLocalhost
         useLocalhost= True
+    if "--compact" in sys.argv:
+        global useCompactStore
+        useCompactStore= True
+    if "--event-loop" in sys.argv:
+        global useEventLoop
+        useEventLoop= True
+    global manifestPath
+    manifestPath= getFlagValue("load", manifestPath)
+    global dataDirPath
+    dataDirPath= getFlagValue("data-dir", dataDirPath)
+    global exportPath
+    exportPath= getFlagValue("export", exportPath)
+    global basePath
+    basePath= getFlagValue("base", basePath)
+    global numWorkers
+    try:
+        numWorkers= int(getFlagValue("workers", numWorkers))
+        assert(numWorkers >= 0)
+    except:
+        print "--workers expects a number of worker processes"
+        sys.exit(1)
+    global numShards
+    try:
+        numShards= int(getFlagValue("shards", numShards))
+        assert(numShards >= 0)
+    except:
+        print "--shards expects a number of shards"
+        sys.exit(1)
+    try:
+        slowLog.thresholdSecs= float(getFlagValue("slowlog-ms", SLOWLOG_MS)) / 1000
+        assert(slowLog.thresholdSecs >= 0)
+    except:
+        print "--slowlog-ms expects a number of milliseconds"
+        sys.exit(1)
+    global metricsPort
+    try:
+        if getFlagValue("metrics-port", None) != None:
+            metricsPort= int(getFlagValue("metrics-port", None))
+            assert(0 < metricsPort < 65536 - numWorkers)
+    except:
+        print "--metrics-port expects a TCP port number"
+        sys.exit(1)
+    traceLevel= tracing.getLevel(getFlagValue("trace", "off"))
+    if traceLevel == None:
+        print "Unknown trace level '%s', expected one of: %s" % (getFlagValue("trace", None),
+            ", ".join(tracing.LEVEL_NAMES))
+        sys.exit(1)
+    tracing.setOutput(getFlagValue("trace-file", None))
+    if traceLevel != tracing.OFF:
+        tracing.setLevel(traceLevel)
+    global concurrencyMode
+    concurrencyMode= getFlagValue("concurrency", concurrencyMode)
+    if concurrencyMode not in CONCURRENCY_MODES:
+        print "Unknown concurrency mode '%s', expected one of: %s" % (concurrencyMode,
+            ", ".join(CONCURRENCY_MODES))
+        sys.exit(1)
+    if useCompactStore and concurrencyMode == "fine":
+        print "--concurrency=fine needs per-entry locks, so it can't be used with --compact"
+        sys.exit(1)
+    if basePath != None and (useCompactStore or concurrencyMode == "fine"):
+        print "--base has a storage backend of its own, so it can't be used with --compact or --concurrency=fine"
+        sys.exit(1)
+    if numShards > 0 and (useCompactStore or basePath != None or concurrencyMode != "global"):
+        print "--shards locks per shard instead, so it can't be used with --compact, --base or --concurrency"
+        sys.exit(1)
+    if basePath != None and dataDirPath != None:
+        print "--base keeps changes in memory only, so it can't be used with --data-dir"
+        sys.exit(1)
+
+
+def getFlagValue(name, default):
+    """Returns: str value passed on the command line as --<name>=<value>, or
+         <default> if the flag is absent."""
+    prefix= "--%s=" % name
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+
+def createIndex(isMapped=True):
+    """Returns: new index instance of the type selected by the flags (empty,
+         unless it's mapped from a base file), with its lock timed.  With
+         --base, it's only mapped if <isMapped>; otherwise it's an empty
+         CompactPackageIndex, the backend a mapped index builds on."""
+    if basePath != None and isMapped:
+        indexPtr= MappedPackageIndex(basePath, concurrencyMode)
+    elif useCompactStore or basePath != None:
+        indexPtr= CompactPackageIndex(concurrencyMode)
+    elif numShards > 0:
+        indexPtr= ShardedPackageIndex(numShards)
+    elif concurrencyMode == "fine":
+        indexPtr= FineLockPackageIndex()
+    else:
+        indexPtr= PackageIndex(concurrencyMode)
+    indexPtr.timeLock()
+    return indexPtr
+
+
+def loadManifest(indexPtr, path):
+    """Bulk loads the manifest file at <path> into <indexPtr>, and prints a
+         summary of what was loaded and what was rejected."""
+    print "Loading manifest %s..." % path
+    start= time.time()
+    with open(path) as manifest:
+        (numLoaded, rejected)= indexPtr.bulkLoad(manifest)
+    print "Loaded %d packages in %.2f secs, rejected %d" % (numLoaded,
+        time.time() - start, len(rejected))
+    for (name, reason) in rejected:
+        print "  rejected (%s): %s" % (reason, name)
+
+
+def exportBase(indexPtr, path):
+    """Writes everything in <indexPtr> to a new base file at <path>, for --base."""
+    print "Exporting index to %s..." % path
+    start= time.time()
+    with indexPtr.getReadLock():
+        (pkgs, manifest)= indexPtr.captureGraph()
+    persistence.writeBase(path, pkgs, manifest)
+    print "Exported %d packages in %.2f secs" % (len(pkgs), time.time() - start)
 
 
 def createSrvSocket():
     """Returns: server socket object that listens on port PORT_LISTEN and can
          spawn new client sockets upon connection."""
     srvSock= socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    #Lets a restarted server rebind while old connections are in TIME_WAIT
+    srvSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    #Every worker binds a socket of its own, and the kernel spreads connections over them
+    if numWorkers > 0:
+        srvSock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
     ip= socket.gethostname()
     if useLocalhost:
         ip= "127.0.0.1"
@@ -320,22 +3396,165 @@ def createSrvSocket():
     return srvSock
 
 
-def main():
-    print "Creating server socket..."
-    srvSock= createSrvSocket()
-    print "Created server socket on %s" % (str(srvSock.getsockname()))
+def openDataDir(indexPtr, path):
+    """Recovers <indexPtr> from the data dir at <path>, and starts logging
+         its mutations there.
+       Returns: the opened persistence.DurableStore."""
+    print "Recovering index from %s..." % path
+    start= time.time()
+    store= persistence.DurableStore(indexPtr, path)
+    (numLoaded, numReplayed)= store.open()
+    print "Recovered %d packages from the snapshot and %d logged commands in %.2f secs" % (
+        numLoaded, numReplayed, time.time() - start)
+    return store
+
+
+def getLockTimers():
+    """Returns: dict of index name->metrics.TimedLock of every index in this
+         process whose lock is timed."""
+    if indexRegistry != None:
+        return indexRegistry.getLockTimers()
+    if index.getLockTimer() == None:
+        return {}
+    return {DEFAULT_INDEX_NAME: index.getLockTimer()}
+
+
+def printMetrics():
+    """Prints the text report of the server's metrics every DEBUG_STATS_SECS,
+         forever, for --debug."""
+    while True:
+        time.sleep(DEBUG_STATS_SECS)
+        sys.stdout.write(serverMetrics.getText(getLockTimers()))
+        sys.stdout.flush()
+
+
+def startMetrics(workerId):
+    """Starts the threads that report this process's metrics, as selected by
+         the flags: the --metrics-port endpoint (offset by <workerId>, which is
+         0 outside of workers), and the --debug printouts."""
+    if metricsPort != None:
+        httpServer= metrics.startHttpServer(metricsPort + workerId,
+            lambda: serverMetrics.getText(getLockTimers()))
+        print "Serving metrics on %s" % str(httpServer.server_address)
+    if isDebug:
+        printer= Thread(target=printMetrics)
+        printer.daemon= True
+        printer.start()
+
+
+def serveClients(srvSock, indexPtr):
+    """Accepts clients on <srvSock> and runs their commands on <indexPtr>
+         forever, with the server core selected by the flags."""
     srvSock.listen(MAX_QUEUED_CONNECTIONS)
+    if tracing.infoOn:
+        tracing.emit(tracing.INFO, "server.listen", address=str(srvSock.getsockname()),
+            eventLoop=useEventLoop)
     threadNum= 1
-    global index
-    index= PackageIndex()
+    if useEventLoop:
+        #Every client holds an fd, so lift the soft limit as far as allowed
+        (softLimit, hardLimit)= resource.getrlimit(resource.RLIMIT_NOFILE)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hardLimit, hardLimit))
+        except (ValueError, OSError) as e:
+            #eg: an unlimited hard limit, which the kernel caps lower
+            print "Couldn't raise the fd limit from %d: %s" % (softLimit, e)
+        EventLoopServer(srvSock, indexPtr).serveForever()
     while True:
         (cliSock, addr)= srvSock.accept()
         cliSock.settimeout(MAX_SOCK_TIMEOUT_SECS)
-        cliThr= IndexThread(threadNum, cliSock, index)
+        cliThr= IndexThread(threadNum, cliSock, indexPtr)
         cliThr.start()
         threadNum+= 1
 
 
+def serveWorkers(indexPtr):
+    """Forks numWorkers worker processes, which each start as a copy of
+         <indexPtr> and serve clients from it, while this process stays the
+         single writer: it runs the commands they forward on <indexPtr>, and
+         streams every mutation back to all of them.  Returns once every
+         worker has exited."""
+    stream= ReplicationStream(indexPtr.mutationLog)
+    links= []
+    sys.stdout.flush()
+    #Holding the lock keeps every replica an exact copy of the index as of
+    #the moment the stream starts (eg: a snapshot can't be half taken)
+    lock= indexPtr.getLock()
+    lock.acquire()
+    indexPtr.setMutationLog(stream)
+    for workerId in range(1, numWorkers + 1):
+        (parentSock, workerSock)= socket.socketpair()
+        pid= os.fork()
+        if pid == 0:
+            #Only the forking thread exists in the child, so release its copy
+            lock.release()
+            parentSock.close()
+            for link in links:
+                link.workerSock.close()
+            serveWorker(workerId, indexPtr, workerSock)
+            os._exit(1)
+        workerSock.close()
+        links.append(WorkerLink(workerId, pid, parentSock, indexPtr))
+    for link in links:
+        stream.addLink(link)
+        link.start()
+    lock.release()
+    print "Started %d workers, this process is the writer" % numWorkers
+    startMetrics(0)
+    while len(links) > 0:
+        (pid, status)= os.wait()
+        for link in [link for link in links if link.pid == pid]:
+            print "Worker %d (pid %d) exited with status %d" % (link.workerId, pid, status)
+            if tracing.infoOn:
+                tracing.emit(tracing.INFO, "worker.exit", worker=link.workerId, pid=pid,
+                    status=status)
+            stream.removeLink(link)
+            links.remove(link)
+    print "Every worker exited, shutting down"
+
+
+def serveWorker(workerId, indexPtr, writerSock):
+    """Serves clients in a worker process, from <indexPtr> as a replica kept
+         up to date by the writer process over <writerSock>.  Never returns."""
+    tracing.afterFork()
+    #Mutations are logged once, by the writer, not again by each replica
+    indexPtr.setMutationLog(None)
+    replica= ReplicaIndex(indexPtr, writerSock, useEventLoop)
+    replica.start()
+    srvSock= createSrvSocket()
+    print "Worker %d (pid %d) serving on %s" % (workerId, os.getpid(), str(srvSock.getsockname()))
+    startMetrics(workerId)
+    sys.stdout.flush()
+    serveClients(srvSock, replica)
+
+
+def main():
+    global index
+    index= createIndex()
+    store= None
+    if dataDirPath is not None:
+        store= openDataDir(index, dataDirPath)
+    global indexRegistry
+    #Workers only forward commands on the default index to the writer
+    if numWorkers == 0:
+        indexRegistry= IndexRegistry(index, dataDirPath)
+    if manifestPath is not None:
+        loadManifest(index, manifestPath)
+        #Bulk loads aren't logged command by command, so persist them at once
+        if store != None:
+            store.takeSnapshot()
+    if exportPath != None:
+        exportBase(index, exportPath)
+        return
+    if numWorkers > 0:
+        serveWorkers(index)
+        return
+    print "Creating server socket..."
+    srvSock= createSrvSocket()
+    print "Created server socket on %s" % (str(srvSock.getsockname()))
+    startMetrics(0)
+    serveClients(srvSock, index)
+
+
 
 
 if __name__ == "__main__":
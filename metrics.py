@@ -0,0 +1,351 @@
+#metrics.py
+"""Always-on server metrics: counters, and latency histograms for every
+command type and outcome and for the wait and hold times of index locks.
+The histograms are HDR-style: log-linear buckets of microseconds, so
+recording a latency is a few integer operations on a fixed-size array, and
+any percentile is exact to within a few percent.  They're read through the
+STATS command (as JSON) or the --metrics-port endpoint (as text).
+Commands slower than a threshold are also kept in a slow log, with what
+they did, and a sampling profiler can be run on demand."""
+
+import os
+import sys
+import json
+import time
+import threading
+import BaseHTTPServer
+from collections import deque
+from threading import Lock, Thread
+
+#-------------------------- Constants -----------------------------
+SUB_BUCKET_BITS= 5          #values below 2^5 us get a bucket each, above that 16 per power of 2
+MAX_VALUE_BITS= 40          #~12 days in us; anything longer goes in the last bucket
+PERCENTILES= [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999)]
+SLOWLOG_MAX_ENTRIES= 128    #slow commands kept for the SLOWLOG command, newest first out
+PROFILE_INTERVAL_SECS= 0.005
+PROFILE_MAX_SECS= 300.0
+OUTCOMES= {"OK\n": "OK", "FAIL\n": "FAIL", "ERROR\n": "ERROR"}
+
+NUM_EXACT_BUCKETS= 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF= 1 << (SUB_BUCKET_BITS - 1)
+NUM_BUCKETS= NUM_EXACT_BUCKETS + (MAX_VALUE_BITS - SUB_BUCKET_BITS) * SUB_BUCKET_HALF
+
+getTimestamp= time.time       #bound once, as it's called twice per command and lock hold
+LockType= type(Lock())
+
+
+#--------------------------- Classes ------------------------------
+class LatencyHistogram(object):
+    def __init__(self):
+        """Class to model a histogram of latencies, in log-linear buckets of
+             microseconds: one bucket per value below 2^SUB_BUCKET_BITS, then
+             SUB_BUCKET_HALF buckets per power of 2, so a bucket is never
+             wider than 1/SUB_BUCKET_HALF of the values in it.
+           Note: not thread-safe; callers serialize record() themselves."""
+        self.counts= [0] * NUM_BUCKETS
+        self.totalSecs= 0.0
+        self.maxSecs= 0.0
+
+    def record(self, secs):
+        """Adds a latency of <secs> to the histogram."""
+        #Same as getBucket, inlined since this runs for every command
+        micros= int(secs * 1e6)
+        if micros < NUM_EXACT_BUCKETS:
+            self.counts[micros]+= 1
+        else:
+            numBits= micros.bit_length()
+            if numBits <= MAX_VALUE_BITS:
+                shift= numBits - SUB_BUCKET_BITS
+                self.counts[shift * SUB_BUCKET_HALF + (micros >> shift)]+= 1
+            else:
+                self.counts[-1]+= 1
+        self.totalSecs+= secs
+        if secs > self.maxSecs:
+            self.maxSecs= secs
+
+    def getCount(self):
+        """Returns: number of latencies recorded."""
+        return sum(self.counts)
+
+    def getPercentile(self, fraction):
+        """Returns: the latency in secs that <fraction> of the recorded ones
+             are at or below (as the top of its bucket, capped at the max)."""
+        count= self.getCount()
+        if count == 0:
+            return 0.0
+        rank= max(1, int(count * fraction + 0.5))
+        seen= 0
+        for (bucket, count) in enumerate(self.counts):
+            seen+= count
+            if seen >= rank:
+                return min(self.maxSecs, getBucketTop(bucket) / 1e6)
+        return self.maxSecs
+
+    def getSummary(self):
+        """Returns: dict of the count, and the mean, percentiles and max in ms."""
+        count= self.getCount()
+        summary= {"count": count, "meanMs": 0.0, "maxMs": self.maxSecs * 1000}
+        if count > 0:
+            summary["meanMs"]= self.totalSecs / count * 1000
+        for (name, fraction) in PERCENTILES:
+            summary[name + "Ms"]= self.getPercentile(fraction) * 1000
+        return summary
+
+
+class TimedLock(object):
+    def __init__(self, lock):
+        """Class to wrap an exclusive lock (eg: a threading.Lock, or the write
+             side of a ReadWriteLock) with histograms of how long callers wait
+             to acquire it, and how long they hold it.  Both are recorded
+             while the lock is held, so they need no lock of their own."""
+        self.lock= lock
+        self.isPlainLock= isinstance(lock, LockType)
+        self.waitTimes= LatencyHistogram()
+        self.holdTimes= LatencyHistogram()
+        self.acquiredTimestamp= 0.0
+
+    def acquire(self):
+        start= getTimestamp()
+        self.lock.acquire()
+        self.acquiredTimestamp= getTimestamp()
+        self.waitTimes.record(self.acquiredTimestamp - start)
+
+    def release(self):
+        holdSecs= getTimestamp() - self.acquiredTimestamp
+        self.holdTimes.record(holdSecs)
+        trace.lockHoldSecs+= holdSecs
+        self.lock.release()
+
+    #Same as acquire and release, inlined since every command goes through them
+    def __enter__(self):
+        #A plain lock is usually free, which is a 0 wait without timing it
+        if self.isPlainLock and self.lock.acquire(False):
+            self.waitTimes.counts[0]+= 1
+            self.acquiredTimestamp= getTimestamp()
+            return self
+        start= getTimestamp()
+        self.lock.acquire()
+        self.acquiredTimestamp= getTimestamp()
+        self.waitTimes.record(self.acquiredTimestamp - start)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        holdSecs= getTimestamp() - self.acquiredTimestamp
+        self.holdTimes.record(holdSecs)
+        trace.lockHoldSecs+= holdSecs
+        self.lock.release()
+
+    def getSummary(self):
+        """Returns: dict of the wait and hold time summaries."""
+        return {"wait": self.waitTimes.getSummary(), "hold": self.holdTimes.getSummary()}
+
+
+class CommandTrace(threading.local):
+    def __init__(self):
+        """Class to model what the command a thread is running has done so
+             far, for the slow log: how many nodes its cycle checks visited,
+             and how long it held a TimedLock.  Each thread sees its own."""
+        self.reset()
+
+    def reset(self):
+        """Starts tracing a new command."""
+        self.cycleVisits= 0
+        self.lockHoldSecs= 0.0
+
+
+class SlowLog(object):
+    def __init__(self, thresholdSecs):
+        """Class to model the log of commands that took at least
+             <thresholdSecs>: each one is printed, and the last
+             SLOWLOG_MAX_ENTRIES are kept for the SLOWLOG command."""
+        self.thresholdSecs= thresholdSecs
+        self.entries= deque(maxlen=SLOWLOG_MAX_ENTRIES)
+        self.lock= Lock()
+
+    def record(self, cmd, secs, details):
+        """Logs that the command <cmd> took <secs>, with the dict of <details>
+             about it (eg: its package), and what the calling thread's trace
+             says it did.
+           Precondition: secs >= self.thresholdSecs."""
+        entry= {"timestamp": time.time(), "command": cmd, "elapsedMs": secs * 1000,
+            "cycleVisits": trace.cycleVisits, "lockHoldMs": trace.lockHoldSecs * 1000}
+        entry.update(details)
+        with self.lock:
+            self.entries.append(entry)
+        print "Slow command: %s" % json.dumps(entry, sort_keys=True)
+
+    def getEntries(self):
+        """Returns: list of the logged entry dicts, newest last."""
+        with self.lock:
+            return list(self.entries)
+
+
+class StackSampler(Thread):
+    def __init__(self, durationSecs, fd, path):
+        """Class to serve as a sampling profiler: a thread that, every
+             PROFILE_INTERVAL_SECS for <durationSecs>, records the stack of
+             every other thread, and then writes them as collapsed stacks
+             (one "thread;outer;...;inner count" line per distinct stack),
+             the input format of flame graph tools, to the open file <fd>,
+             whose path is <path>.  It owns fd, and closes it once written."""
+        Thread.__init__(self)
+        self.daemon= True
+        self.durationSecs= durationSecs
+        self.fd= fd
+        self.path= path
+        self.counts= {}
+
+    def run(self):
+        stopAt= time.time() + self.durationSecs
+        while time.time() < stopAt:
+            self.sample()
+            time.sleep(PROFILE_INTERVAL_SECS)
+        try:
+            with os.fdopen(self.fd, "w") as out:
+                for (stack, count) in sorted(self.counts.items()):
+                    out.write("%s %d\n" % (stack, count))
+            print "Wrote profile of %d samples to %s" % (sum(self.counts.values()), self.path)
+        except (IOError, OSError) as e:
+            print "Couldn't write profile to %s: %s" % (self.path, e)
+
+    def sample(self):
+        """Adds the current stack of every other thread to the counts."""
+        threadNames= dict((thread.ident, type(thread).__name__) for thread in threading.enumerate())
+        for (threadId, frame) in sys._current_frames().items():
+            if threadId == self.ident:
+                continue
+            frames= []
+            while frame != None:
+                code= frame.f_code
+                frames.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame= frame.f_back
+            frames.append(threadNames.get(threadId, "Thread"))
+            stack= ";".join(reversed(frames))
+            self.counts[stack]= self.counts.get(stack, 0) + 1
+
+
+class ServerMetrics(object):
+    def __init__(self):
+        """Class to model the metrics of one server process: named counters,
+             and a LatencyHistogram for every (command, outcome) pair seen."""
+        self.lock= Lock()
+        self.startTimestamp= time.time()
+        self.counters= {}
+        self.commands= {}
+
+    def recordCommand(self, cmd, response, secs):
+        """Records that the command named <cmd> took <secs> and answered
+             <response> (its outcome is OK, FAIL or ERROR)."""
+        outcome= OUTCOMES.get(response)
+        if outcome == None:
+            #A response with a payload, eg: to DEPS
+            outcome= "OK" if response.startswith("OK") else "ERROR"
+        with self.lock:
+            try:
+                self.commands[cmd][outcome].record(secs)
+            except KeyError:
+                self.commands.setdefault(cmd, {})[outcome]= LatencyHistogram()
+                self.commands[cmd][outcome].record(secs)
+
+    def increment(self, name, amount=1):
+        """Adds <amount> to the counter <name>."""
+        with self.lock:
+            self.counters[name]= self.counters.get(name, 0) + amount
+
+    def getReport(self, lockTimers):
+        """Returns: dict of every metric, plus the lock summaries of the
+             TimedLocks in the dict of index name-><lockTimers>."""
+        with self.lock:
+            commands= {}
+            for (cmd, outcomes) in self.commands.items():
+                commands[cmd]= dict((outcome, histogram.getSummary())
+                    for (outcome, histogram) in outcomes.items())
+            report= {"uptimeSecs": time.time() - self.startTimestamp,
+                "counters": dict(self.counters), "commands": commands}
+        report["locks"]= dict((name, timer.getSummary()) for (name, timer) in lockTimers.items())
+        return report
+
+    def getJson(self, lockTimers):
+        """Returns: str of the report (see getReport) as one line of JSON."""
+        return json.dumps(self.getReport(lockTimers), sort_keys=True, separators=(",", ":"))
+
+    def getText(self, lockTimers):
+        """Returns: str of the report (see getReport) in the Prometheus text
+             exposition format, one "name{labels} value" line per value."""
+        report= self.getReport(lockTimers)
+        lines= ["indexer_uptime_seconds %f" % report["uptimeSecs"]]
+        for (name, value) in sorted(report["counters"].items()):
+            lines.append("indexer_%s_total %d" % (name, value))
+        for cmd in sorted(report["commands"]):
+            for (outcome, summary) in sorted(report["commands"][cmd].items()):
+                labels= 'command="%s",outcome="%s"' % (cmd, outcome)
+                lines.extend(getSummaryLines("indexer_command_seconds", labels, summary))
+        for (name, summary) in sorted(report["locks"].items()):
+            labels= 'index="%s"' % name
+            lines.extend(getSummaryLines("indexer_lock_wait_seconds", labels, summary["wait"]))
+            lines.extend(getSummaryLines("indexer_lock_hold_seconds", labels, summary["hold"]))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        """Answers any GET with the text report of the server's metrics."""
+        body= self.server.getText()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        #Scrapes would otherwise print a line each
+        pass
+
+
+#------------------------- Global State ---------------------------
+trace= CommandTrace()       #what the calling thread's command has done so far
+
+
+#-------------------------- Functions -----------------------------
+def getBucket(micros):
+    """Returns: index of the LatencyHistogram bucket for <micros>."""
+    numBits= micros.bit_length()
+    if numBits <= SUB_BUCKET_BITS:
+        return micros
+    if numBits > MAX_VALUE_BITS:
+        return NUM_BUCKETS - 1
+    shift= numBits - SUB_BUCKET_BITS
+    return NUM_EXACT_BUCKETS + (shift - 1) * SUB_BUCKET_HALF + (micros >> shift) - SUB_BUCKET_HALF
+
+
+def getBucketTop(bucket):
+    """Returns: the highest number of microseconds that goes in <bucket>."""
+    if bucket < NUM_EXACT_BUCKETS:
+        return bucket
+    shift= (bucket - NUM_EXACT_BUCKETS) / SUB_BUCKET_HALF + 1
+    subBucket= (bucket - NUM_EXACT_BUCKETS) % SUB_BUCKET_HALF + SUB_BUCKET_HALF
+    return ((subBucket + 1) << shift) - 1
+
+
+def getSummaryLines(name, labels, summary):
+    """Returns: list of text exposition lines for the histogram <summary>, as
+         the metric <name> with the str of <labels>."""
+    lines= []
+    for (percentile, fraction) in PERCENTILES:
+        lines.append('%s{%s,quantile="%g"} %.6f' % (name, labels, fraction,
+            summary[percentile + "Ms"] / 1000))
+    lines.append("%s_sum{%s} %.6f" % (name, labels, summary["meanMs"] * summary["count"] / 1000))
+    lines.append("%s_count{%s} %d" % (name, labels, summary["count"]))
+    return lines
+
+
+def startHttpServer(port, getText):
+    """Starts a daemon thread serving the str returned by <getText>() to any
+         GET on localhost:<port>.
+       Returns: the BaseHTTPServer.HTTPServer."""
+    httpServer= BaseHTTPServer.HTTPServer(("127.0.0.1", port), MetricsRequestHandler)
+    httpServer.getText= getText
+    server= Thread(target=httpServer.serve_forever)
+    server.daemon= True
+    server.start()
+    return httpServer
@@ -0,0 +1,505 @@
+#persistence.py
+"""Durable storage for a package index: a write-ahead log of every successful
+mutation, plus periodic binary snapshots of the whole graph, so that a
+restarted server only has to load the latest snapshot and replay the short
+log tail written after it.  Also writes and maps read-only "base" files, an
+immutable export of an index that a server can answer QUERYs from directly.
+Used by indexer.py when it is started with --data-dir=<dir>, --export=<file>
+or --base=<file>."""
+
+import gc
+import os
+import sys
+import time
+import mmap
+import struct
+from array import array
+from threading import Condition, Lock, Thread, local
+
+#-------------------------- Constants -----------------------------
+SNAPSHOT_EVERY_MUTATIONS= 100000    #take a new snapshot once the log grows by this many records
+SNAPSHOT_CHECK_SECS= 1.0            #how often the snapshot thread checks the log's growth
+SNAPSHOT_FILE= "snapshot.bin"
+SNAPSHOT_MAGIC= "PKGSNAP1"
+SNAPSHOT_HEADER= "<QIIQ"            #last LSN, num packages, num edges, num name bytes
+BASE_MAGIC= "PKGBASE1"
+BASE_HEADER= "<IIQ"                 #num packages, num edges, num name bytes
+LOG_PREFIX= "wal."
+LOG_COMMANDS= ("INDEX", "REMOVE")
+
+syncData= getattr(os, "fdatasync", os.fsync)
+
+
+#--------------------------- Classes -----------------------------
+class WriteAheadLog(Thread):
+    def __init__(self, dirPath, nextLsn):
+        """Class to model the log of every successful mutation, as lines in
+             the same INDEX|pkg|deps format as the protocol.  Each record gets
+             the next log sequence number (LSN).  Appending only buffers the
+             record: this thread writes out everything buffered so far and
+             syncs it with a single fsync, so many concurrent writers share
+             the cost of each sync (group commit).
+           The log is split into segment files, each named after the LSN of
+             its first record, so that a snapshot can drop the segments it
+             covers.
+           Precondition: nextLsn is the LSN the first new record should get."""
+        Thread.__init__(self)
+        self.daemon= True
+        self.dirPath= dirPath
+        self.lock= Lock()
+        self.hasPending= Condition(self.lock)
+        self.isDurable= Condition(self.lock)
+        self.pending= []
+        self.appendedLsn= nextLsn - 1
+        self.durableLsn= nextLsn - 1
+        self.threadState= local()
+        self.segment= openSegment(dirPath, nextLsn)
+        self.numSyncs= 0
+        self.isClosing= False
+
+    def getLsn(self):
+        """Returns: int LSN of the last record appended so far."""
+        return self.appendedLsn
+
+    def append(self, cmd, pkg, deps):
+        """Buffers a record of a successful mutation, and remembers its LSN as
+             the calling thread's latest, for waitDurable.
+           Returns: int LSN of the new record.
+           Precondition: cmd is one of LOG_COMMANDS; pkg is a str; deps is a
+             list of str."""
+        line= "%s|%s|%s\n" % (cmd, pkg, ",".join(deps))
+        with self.lock:
+            self.appendedLsn+= 1
+            lsn= self.appendedLsn
+            self.pending.append(line)
+            self.hasPending.notify()
+        self.threadState.lastLsn= lsn
+        return lsn
+
+    def rotate(self):
+        """Makes every record appended after this call go to a new segment.
+           Returns: int LSN of the last record in the old segments."""
+        with self.lock:
+            #An int in the buffer marks where the next segment starts
+            self.pending.append(self.appendedLsn + 1)
+            self.hasPending.notify()
+            return self.appendedLsn
+
+    def waitDurable(self):
+        """Blocks until every record the calling thread appended is synced."""
+        lsn= getattr(self.threadState, "lastLsn", 0)
+        if lsn <= self.durableLsn:
+            return
+        with self.lock:
+            while self.durableLsn < lsn:
+                self.isDurable.wait()
+
+    def close(self):
+        """Writes out everything appended so far, then stops this thread and
+             closes the log.
+           Precondition: nothing appends to the log anymore."""
+        with self.lock:
+            self.isClosing= True
+            self.hasPending.notify()
+        self.join()
+        self.segment.close()
+
+    def run(self):
+        try:
+            while True:
+                with self.lock:
+                    while len(self.pending) == 0 and not self.isClosing:
+                        self.hasPending.wait()
+                    if len(self.pending) == 0:
+                        return
+                    (batch, self.pending)= (self.pending, [])
+                    lastLsn= self.appendedLsn
+                self.writeBatch(batch)
+                with self.lock:
+                    self.durableLsn= lastLsn
+                    self.isDurable.notify_all()
+        except Exception as e:
+            #Acknowledging mutations that can't be logged would lose them
+            #silently on the next crash, so stop the whole server instead
+            print "Write-ahead log failed with <%s>: %s" % (e.__class__.__name__, e)
+            os._exit(1)
+
+    def writeBatch(self, batch):
+        """Writes and syncs every buffered record in <batch>, switching to a
+             new segment at each rotation marker."""
+        lines= []
+        for item in batch:
+            if isinstance(item, str):
+                lines.append(item)
+                continue
+            self.segment.write("".join(lines))
+            lines= []
+            self.syncSegment()
+            self.segment.close()
+            self.segment= openSegment(self.dirPath, item)
+        self.segment.write("".join(lines))
+        self.syncSegment()
+
+    def syncSegment(self):
+        self.segment.flush()
+        syncData(self.segment.fileno())
+        self.numSyncs+= 1
+
+
+class DurableStore(Thread):
+    def __init__(self, indexPtr, dirPath):
+        """Class to model the on-disk copy of <indexPtr> in <dirPath>: a
+             snapshot file plus the log segments written after it.  This
+             thread takes a new snapshot every SNAPSHOT_EVERY_MUTATIONS
+             logged mutations, and then deletes the segments it covers.
+           Precondition: indexPtr is a PackageIndex (of any backend)."""
+        Thread.__init__(self)
+        self.daemon= True
+        self.indexPtr= indexPtr
+        self.dirPath= dirPath
+        self.log= None
+        self.snapshotLsn= 0
+        self.snapshotLock= Lock()
+        self.isClosed= False
+
+    def open(self):
+        """Recovers the index from <dirPath> (creating it if needed), then
+             attaches a new log to the index and starts the log and snapshot
+             threads.
+           Returns: tuple of (int number of packages loaded from the snapshot,
+             int number of log records replayed)."""
+        if not os.path.isdir(self.dirPath):
+            os.makedirs(self.dirPath)
+        #Same as indexer.GcPause: recovery creates the whole graph at once
+        wasGcEnabled= gc.isenabled()
+        gc.disable()
+        try:
+            (self.snapshotLsn, pkgs, manifest)= readSnapshot(self.dirPath)
+            self.indexPtr.loadSorted(pkgs, manifest)
+            (lastLsn, numReplayed)= replayLog(self.indexPtr, self.dirPath, self.snapshotLsn)
+        finally:
+            if wasGcEnabled:
+                gc.enable()
+        #New records go to a new segment, never after a possibly torn line
+        self.log= WriteAheadLog(self.dirPath, lastLsn + 1)
+        self.indexPtr.setMutationLog(self.log)
+        self.log.start()
+        self.start()
+        return (len(pkgs), numReplayed)
+
+    def run(self):
+        while not self.isClosed:
+            time.sleep(SNAPSHOT_CHECK_SECS)
+            if self.log.getLsn() - self.snapshotLsn >= SNAPSHOT_EVERY_MUTATIONS:
+                self.takeSnapshot()
+
+    def close(self):
+        """Takes a last snapshot if anything was logged since the previous
+             one, so that reopening doesn't have to replay it, then stops the
+             log and snapshot threads.
+           Precondition: nothing mutates the index anymore."""
+        with self.snapshotLock:
+            if self.log.getLsn() > self.snapshotLsn:
+                self.saveSnapshot()
+            self.isClosed= True
+        self.log.close()
+
+    def takeSnapshot(self):
+        """Writes a snapshot of the whole index, and deletes the log segments
+             it makes obsolete.  The snapshot is written by a child process
+             forked while holding the read lock, which sees a copy-on-write
+             snapshot of the whole index, so writers are only blocked for the
+             fork, not while the graph is copied, encoded or written to disk."""
+        with self.snapshotLock:
+            if not self.isClosed:
+                self.saveSnapshot()
+
+    def saveSnapshot(self):
+        """Does the work of takeSnapshot.
+           Precondition: caller holds self.snapshotLock."""
+        with self.indexPtr.getReadLock():
+            lsn= self.log.rotate()
+            pid= os.fork()
+            if pid == 0:
+                self.writeChildSnapshot(lsn)
+        (pid, status)= os.waitpid(pid, 0)
+        if status != 0:
+            raise IOError("snapshot at LSN %d failed (child exit status %d)" % (lsn, status))
+        pruneSegments(self.dirPath, lsn)
+        self.snapshotLsn= lsn
+
+    def writeChildSnapshot(self, lsn):
+        """Writes the snapshot taken at <lsn>, and exits.  The child only has
+             the thread that forked it, so it must not take any lock another
+             thread might have held at the fork: the read lock it inherited
+             is enough to keep its copy of the index consistent.
+           Precondition: this is the child process forked by saveSnapshot."""
+        exitCode= 1
+        try:
+            (pkgs, manifest)= self.indexPtr.captureGraph()
+            writeSnapshot(self.dirPath, lsn, pkgs, manifest)
+            exitCode= 0
+        finally:
+            os._exit(exitCode)
+
+
+class MappedBase(object):
+    def __init__(self, path):
+        """Class to model a base file written by writeBase, mapped read-only
+             into memory.  Nothing is read up front: every lookup reads the
+             few values it needs straight out of the mapped pages, so opening
+             it is O(1), and only the pages that lookups touch are ever
+             loaded.  Packages are identified by their int position in the
+             file's name table, which is sorted."""
+        with open(path, "rb") as f:
+            self.mm= mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(BASE_MAGIC)] != BASE_MAGIC:
+            raise IOError("%s is not a base file" % path)
+        (self.numPkgs, numEdges, numNameBytes)= struct.unpack_from(BASE_HEADER,
+            self.mm, len(BASE_MAGIC))
+        #Sections, in file order: uint32 arrays, then the name bytes
+        sectionLens= [("nameOffsets", self.numPkgs + 1), ("ranks", self.numPkgs),
+            ("slots", self.numPkgs), ("depOffsets", self.numPkgs + 1), ("deps", numEdges),
+            ("dependeeOffsets", self.numPkgs + 1), ("dependees", numEdges)]
+        self.sections= {}
+        offset= len(BASE_MAGIC) + struct.calcsize(BASE_HEADER)
+        for (name, count) in sectionLens:
+            self.sections[name]= offset
+            offset+= 4 * count
+        self.sections["names"]= offset
+        if self.mm.size() < offset + numNameBytes:
+            raise IOError("%s is truncated" % path)
+
+    def getNumPackages(self):
+        """Returns: int number of packages in the base."""
+        return self.numPkgs
+
+    def getValue(self, section, i):
+        """Returns: int <i>th value of the uint32 array <section>."""
+        return struct.unpack_from("<I", self.mm, self.sections[section] + 4 * i)[0]
+
+    def getRange(self, section, i):
+        """Returns: tuple of the <i>th and <i+1>th values of <section>."""
+        return struct.unpack_from("<II", self.mm, self.sections[section] + 4 * i)
+
+    def getName(self, pkgId):
+        """Returns: str name of the package with id <pkgId>."""
+        (start, end)= self.getRange("nameOffsets", pkgId)
+        namesStart= self.sections["names"]
+        return self.mm[namesStart + start:namesStart + end]
+
+    def findId(self, name):
+        """Returns: int id of the package named <name>, found by binary search
+             over the sorted name table; -1 if it's not in the base."""
+        (lo, hi)= (0, self.numPkgs)
+        while lo < hi:
+            mid= (lo + hi) / 2
+            if self.getName(mid) < name:
+                lo= mid + 1
+            else:
+                hi= mid
+        if lo < self.numPkgs and self.getName(lo) == name:
+            return lo
+        return -1
+
+    def getRank(self, pkgId):
+        """Returns: int position of <pkgId> in the base's install order."""
+        return self.getValue("ranks", pkgId)
+
+    def getSlot(self, rank):
+        """Returns: int id of the package at position <rank> in the install order."""
+        return self.getValue("slots", rank)
+
+    def getDependencyIds(self, pkgId):
+        """Returns: tuple of the ids that <pkgId> depends on."""
+        (start, end)= self.getRange("depOffsets", pkgId)
+        return struct.unpack_from("<%dI" % (end - start), self.mm, self.sections["deps"] + 4 * start)
+
+    def getDependeeIds(self, pkgId):
+        """Returns: tuple of the ids that depend on <pkgId>."""
+        (start, end)= self.getRange("dependeeOffsets", pkgId)
+        return struct.unpack_from("<%dI" % (end - start), self.mm,
+            self.sections["dependees"] + 4 * start)
+
+
+#------------------------- File Functions ------------------------
+def syncDir(dirPath):
+    """Syncs <dirPath> itself, so that files created or renamed in it survive a crash."""
+    fd= os.open(dirPath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def openSegment(dirPath, firstLsn):
+    """Returns: file object to write the log segment that starts at <firstLsn>
+         to.  If that segment already exists, it can only hold a torn record
+         (or nothing), since recovery would have replayed any complete one
+         and started after it, so it is truncated."""
+    segment= open(os.path.join(dirPath, "%s%020d" % (LOG_PREFIX, firstLsn)), "wb")
+    syncDir(dirPath)
+    return segment
+
+
+def listSegments(dirPath):
+    """Returns: list of (first LSN, path) tuples of every log segment in
+         <dirPath>, in LSN order."""
+    segments= []
+    for name in os.listdir(dirPath):
+        if name.startswith(LOG_PREFIX) and name[len(LOG_PREFIX):].isdigit():
+            segments.append((int(name[len(LOG_PREFIX):]), os.path.join(dirPath, name)))
+    return sorted(segments)
+
+
+def pruneSegments(dirPath, lsn):
+    """Deletes every log segment that only holds records up to <lsn>.
+       Precondition: the log was rotated at <lsn>, and a snapshot of <lsn>
+         is durable."""
+    for (firstLsn, path) in listSegments(dirPath):
+        if firstLsn <= lsn:
+            os.remove(path)
+
+
+def replayLog(indexPtr, dirPath, snapshotLsn):
+    """Runs every logged mutation after <snapshotLsn> on <indexPtr>, in order.
+         A segment is read up to its first torn or unparsable line, which can
+         only be a write that was never acknowledged.
+       Returns: tuple of (int LSN of the last record recovered, int number of
+         records replayed)."""
+    lastLsn= snapshotLsn
+    numReplayed= 0
+    with indexPtr.getLock():
+        for (firstLsn, path) in listSegments(dirPath):
+            lsn= firstLsn - 1
+            with open(path, "rb") as segment:
+                for line in segment:
+                    fields= line.rstrip("\n").split("|")
+                    if not line.endswith("\n") or len(fields) != 3 or fields[0] not in LOG_COMMANDS:
+                        break
+                    lsn+= 1
+                    if lsn <= snapshotLsn:
+                        continue
+                    deps= [dep for dep in fields[2].split(",") if len(dep) > 0]
+                    indexPtr.unlockedCommands[fields[0]](fields[1], deps)
+                    numReplayed+= 1
+            lastLsn= max(lastLsn, lsn)
+    return (lastLsn, numReplayed)
+
+
+def writeArray(f, arr):
+    """Writes <arr> to <f> as little-endian values, whatever the host's byte order."""
+    if sys.byteorder == "big":
+        arr= array(arr.typecode, arr)
+        arr.byteswap()
+    arr.tofile(f)
+
+
+def readArray(f, typecode, count):
+    """Returns: array of <count> little-endian values of <typecode> read from <f>."""
+    arr= array(typecode)
+    arr.fromfile(f, count)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+def writeSnapshot(dirPath, lsn, pkgs, manifest):
+    """Atomically replaces the snapshot in <dirPath> with the graph in
+         (<pkgs>, <manifest>), as captured when the log was at <lsn>.  The
+         graph is stored as flat arrays: every name back to back with their
+         offsets, then each package's dependencies as indexes into the
+         package list (CSR, like the compact backend), so it loads with a
+         handful of bulk reads.
+       Precondition: pkgs is in install order, as from captureGraph."""
+    positions= dict((pkg, i) for (i, pkg) in enumerate(pkgs))
+    nameOffsets= array("I", [0])
+    numNameBytes= 0
+    depOffsets= array("I", [0])
+    depTargets= array("I")
+    for pkg in pkgs:
+        numNameBytes+= len(pkg)
+        nameOffsets.append(numNameBytes)
+        depTargets.extend([positions[dep] for dep in manifest[pkg]])
+        depOffsets.append(len(depTargets))
+    path= os.path.join(dirPath, SNAPSHOT_FILE)
+    with open(path + ".tmp", "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack(SNAPSHOT_HEADER, lsn, len(pkgs), len(depTargets), numNameBytes))
+        writeArray(f, nameOffsets)
+        f.write("".join(pkgs))
+        writeArray(f, depOffsets)
+        writeArray(f, depTargets)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+    syncDir(dirPath)
+
+
+def readSnapshot(dirPath):
+    """Returns: tuple of (int LSN the snapshot in <dirPath> was taken at,
+         list of package names in install order, dict of package name->list
+         of dependency names), or an empty graph at LSN 0 if there is no
+         snapshot yet."""
+    path= os.path.join(dirPath, SNAPSHOT_FILE)
+    if not os.path.exists(path):
+        return (0, [], {})
+    with open(path, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise IOError("%s is not a snapshot file" % path)
+        header= f.read(struct.calcsize(SNAPSHOT_HEADER))
+        (lsn, numPkgs, numEdges, numNameBytes)= struct.unpack(SNAPSHOT_HEADER, header)
+        nameOffsets= readArray(f, "I", numPkgs + 1)
+        names= f.read(numNameBytes)
+        depOffsets= readArray(f, "I", numPkgs + 1)
+        depTargets= readArray(f, "I", numEdges)
+    pkgs= [names[nameOffsets[i]:nameOffsets[i+1]] for i in xrange(numPkgs)]
+    manifest= {}
+    for i in xrange(numPkgs):
+        manifest[pkgs[i]]= [pkgs[j] for j in depTargets[depOffsets[i]:depOffsets[i+1]]]
+    return (lsn, pkgs, manifest)
+
+
+def writeBase(path, pkgs, manifest):
+    """Writes the graph in (<pkgs>, <manifest>) to a new base file at <path>,
+         for MappedBase.  Ids are positions in the sorted list of names, and
+         the file holds, as little-endian uint32 arrays: the offsets of each
+         name in the name bytes, each id's position in the install order
+         (its rank), the id at each position, and CSR dependency and dependee
+         lists; then all of the names back to back.
+       Precondition: pkgs is in install order, as from captureGraph."""
+    sortedPkgs= sorted(pkgs)
+    ids= dict((pkg, i) for (i, pkg) in enumerate(sortedPkgs))
+    nameOffsets= array("I", [0])
+    numNameBytes= 0
+    for pkg in sortedPkgs:
+        numNameBytes+= len(pkg)
+        nameOffsets.append(numNameBytes)
+    slots= array("I", [ids[pkg] for pkg in pkgs])
+    ranks= array("I", [0]) * len(pkgs)
+    for (rank, pkgId) in enumerate(slots):
+        ranks[pkgId]= rank
+    depOffsets= array("I", [0])
+    deps= array("I")
+    dependeeLists= [[] for pkg in sortedPkgs]
+    for (pkgId, pkg) in enumerate(sortedPkgs):
+        depIds= sorted([ids[dep] for dep in manifest[pkg]])
+        deps.extend(depIds)
+        depOffsets.append(len(deps))
+        for depId in depIds:
+            dependeeLists[depId].append(pkgId)
+    dependeeOffsets= array("I", [0])
+    dependees= array("I")
+    for dependeeIds in dependeeLists:
+        dependees.extend(dependeeIds)
+        dependeeOffsets.append(len(dependees))
+    with open(path + ".tmp", "wb") as f:
+        f.write(BASE_MAGIC)
+        f.write(struct.pack(BASE_HEADER, len(pkgs), len(deps), numNameBytes))
+        for arr in (nameOffsets, ranks, slots, depOffsets, deps, dependeeOffsets, dependees):
+            writeArray(f, arr)
+        f.write("".join(sortedPkgs))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + ".tmp", path)
+    syncDir(os.path.dirname(os.path.abspath(path)))
@@ -0,0 +1,83 @@
+#protocol.py
+"""Parsing of the indexer's line protocol: turns "cmd|pkg|deps" lines into
+IndexCommand objects bound to an index's handler functions.  This is the
+hottest code in the server (it runs for every single command), so it only
+does the work a line actually needs: one split for the fields, and a deps
+list only when there are deps."""
+
+from collections import OrderedDict
+
+#-------------------------- Constants -----------------------------
+TRAILING_SPACE= " \t\r\n\x0b\x0c"    #what str.rstrip() strips, to check before calling it
+
+
+#--------------------------- Classes ------------------------------
+class IndexCommand(object):
+    def __init__(self, handlerFunc, packageName, dependencies, commandName=None):
+        """Class to model a command on an index, by storing a pointer to that
+             index instance's handler function, along with any needed arguments.
+           Precondition: handlerFunc is a function pointer, packageName is a str,
+             dependencies is a list of str, commandName is the str the
+             handler was looked up by (eg: "INDEX")."""
+        self.handlerFunc= handlerFunc
+        self.packageName= packageName
+        self.dependencies= dependencies
+        self.commandName= commandName
+
+    def getCommandName(self):
+        """Returns: str name of this command, eg: "INDEX"."""
+        return self.commandName
+
+    def runCommand(self):
+        return self.handlerFunc(self.packageName, self.dependencies)
+
+
+class CommandParser(object):
+    def __init__(self, handlers):
+        """Class to parse command lines into IndexCommands for the index whose
+             dict of command name->handler function is <handlers> (eg: its
+             commands).  It keeps one IndexCommand to refill for commands
+             that are run right away, instead of allocating one per line."""
+        self.handlers= handlers
+        self.command= IndexCommand(None, None, None)
+
+    def setHandlers(self, handlers):
+        """Binds the commands parsed from now on to <handlers> instead (eg:
+             after the session switched to another index)."""
+        self.handlers= handlers
+
+    def parse(self, line, reuse=False):
+        """Returns: IndexCommand for the command in <line>; None if it's
+             malformed or not a command of this index.  Trailing whitespace is
+             ignored, and so are empty and repeated deps (the first of each is
+             kept, in order).  If <reuse> is True, every such call refills and
+             returns the same IndexCommand, so the caller must be done with it
+             before parsing the next line.
+           Precondition: line is a str, without its newline."""
+        if line[-1:] in TRAILING_SPACE:
+            line= line.rstrip()
+        fields= line.split("|")
+        if len(fields) != 3:
+            return None
+        (cmd, pkg, deps)= fields
+        handlerFunc= self.handlers.get(cmd)
+        if handlerFunc == None or len(pkg) == 0:
+            return None
+        if len(deps) == 0:
+            deps= []
+        elif "," not in deps:
+            deps= [deps]
+        else:
+            deps= deps.split(",")
+            if "" in deps:
+                deps= [dep for dep in deps if len(dep) > 0]
+            if len(set(deps)) != len(deps):
+                deps= list(OrderedDict.fromkeys(deps))
+        if not reuse:
+            return IndexCommand(handlerFunc, pkg, deps, cmd)
+        command= self.command
+        command.handlerFunc= handlerFunc
+        command.packageName= pkg
+        command.dependencies= deps
+        command.commandName= cmd
+        return command
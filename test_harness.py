@@ -2,6 +2,7 @@
 """Dummy client to test initial network capabilities of the indexer."""
 
 import sys
+import json
 import time
 import socket
 from threading import Thread
@@ -39,8 +40,20 @@ class Client(Thread):
             cliSock.settimeout(1.0)
             cliSock.connect((self.ip, self.port))
             cliSock.send(self.msg)
-            status= cliSock.recv(MAX_PKT_BYTES)
-            self.returnObj.passed= status == self.expected
+            #Half-close, so the server knows an unterminated command is complete
+            cliSock.shutdown(socket.SHUT_WR)
+            #Read until the server closes, as several pipelined responses
+            #may come in more than one packet
+            status= ""
+            while True:
+                data= cliSock.recv(MAX_PKT_BYTES)
+                if len(data) == 0:
+                    break
+                status+= data
+            if callable(self.expected):
+                self.returnObj.passed= self.expected(status)
+            else:
+                self.returnObj.passed= status == self.expected
         except:
             pass
         try:
@@ -269,6 +282,203 @@ def testCycles():
     return results
 
 
+def testPipelining():
+    print "\nTesting pipelined commands..."
+    pipeTests= [
+        ("INDEX|A|\nINDEX|B|A\nQUERY|B|\nREMOVE|A|\nREMOVE|B|\nREMOVE|A|\n",
+            RESP_OK * 3 + RESP_FAIL + RESP_OK * 2),
+        ("QUERY|A|\nFAKE|A|\nQUERY|A|\n", RESP_FAIL + RESP_ERR + RESP_FAIL),
+        ("INDEX|A|\nQUERY|A|\nREMOVE|A|\nQUERY|A", RESP_OK * 3 + RESP_ERR)
+    ]
+    results= runAPITests(pipeTests)
+    return results
+
+
+def testBatches():
+    print "\nTesting batched commands..."
+    batchTests= [
+        ("BEGIN\nINDEX|A|\nINDEX|B|A\nQUERY|B|\nCOMMIT\n", RESP_OK * 3),
+        ("BEGIN\nINDEX|C|X\nFAKE\nQUERY|C|\nCOMMIT\n", RESP_FAIL + RESP_ERR + RESP_FAIL),
+        ("BEGIN\nINDEX|C|B\n", ""),
+        ("QUERY|C|\n", RESP_FAIL),
+        ("BEGIN\nDUMP|native|\nUSE|harness|\nCOMMIT\n", RESP_ERR * 2),
+        ("COMMIT\n", RESP_ERR),
+        ("BEGIN\nREMOVE|B|\nREMOVE|A|\nCOMMIT\n", RESP_OK * 2)
+    ]
+    results= runAPITests(batchTests)
+    return results
+
+
+def isUseIsolated(status):
+    """Returns: whether <status> answers a USE of a named index that doesn't
+         see the default index's packages, or a USE that FAILs because this
+         server has no named indices (eg: with --workers)."""
+    isolated= RESP_OK * 5 + RESP_FAIL + RESP_OK + RESP_ERR + RESP_FAIL + RESP_OK
+    unsupported= RESP_OK + RESP_FAIL + RESP_OK * 4 + RESP_FAIL + RESP_ERR + RESP_FAIL + RESP_OK
+    return status in (isolated, unsupported)
+
+
+def testUse():
+    print "\nTesting named indices..."
+    useTests= [
+        ("INDEX|A|\nUSE|harness|\nINDEX|N|\nQUERY|N|\nREMOVE|N|\nQUERY|A|\nUSE|default|\n" +
+            "USE|harness|x\nUSE|bad/name|\nREMOVE|A|\n", isUseIsolated),
+        ("USE||\n", RESP_ERR)
+    ]
+    results= runAPITests(useTests)
+    return results
+
+
+def testTraversals():
+    print "\nTesting dependency traversal commands..."
+    inputs= [
+        ("INDEX|A|\n", RESP_OK),
+        ("INDEX|B|A\n", RESP_OK),
+        ("INDEX|C|A\n", RESP_OK),
+        ("INDEX|D|B,C\n", RESP_OK),
+        ("INDEX|E|\n", RESP_OK)
+    ]
+    runAPITests(inputs, suppressTests=True, suppressSummary=True)
+    travTests= [
+        ("DEPS|A|\n", "OK|\n"),
+        ("DEPS|B|\n", "OK|A\n"),
+        ("DEPS|X|\n", RESP_FAIL),
+        ("RDEPS|D|\n", "OK|\n"),
+        ("RDEPS|B|\n", "OK|D\n"),
+        ("RDEPS|X|\n", RESP_FAIL),
+        ("DEPS|D|\nRDEPS|A|\n", lambda status: status in ("OK|A,B,C\nOK|B,C,D\n",
+            "OK|A,C,B\nOK|C,B,D\n", "OK|A,B,C\nOK|C,B,D\n", "OK|A,C,B\nOK|B,C,D\n")),
+        ("DEPENDS|D|A\n", RESP_OK),
+        ("DEPENDS|B|C\n", RESP_FAIL),
+        ("DEPENDS|A|D\n", RESP_FAIL),
+        ("DEPENDS|D|E\n", RESP_FAIL),
+        ("DEPENDS|D|X\n", RESP_FAIL),
+        ("DEPENDS|X|A\n", RESP_FAIL),
+        ("DEPENDS|D|\n", RESP_ERR),
+        ("DEPENDS|D|A,B\n", RESP_ERR)
+    ]
+    results= runAPITests(travTests)
+    cleanupIndex(inputs)
+    return results
+
+
+def testCascade():
+    print "\nTesting cascading removes..."
+    inputs= [
+        ("INDEX|A|\n", RESP_OK),
+        ("INDEX|B|A\n", RESP_OK),
+        ("INDEX|C|B\n", RESP_OK),
+        ("INDEX|D|\n", RESP_OK),
+        ("INDEX|E|D\n", RESP_OK)
+    ]
+    runAPITests(inputs, suppressTests=True, suppressSummary=True)
+    cascadeTests= [
+        ("CASCADE|X|\n", "OK|\n"),
+        ("CASCADE|B|bad\n", RESP_ERR),
+        ("CASCADE|B|\n", "OK|C,B\n"),
+        ("QUERY|A|\nQUERY|B|\nQUERY|C|\n", RESP_OK + RESP_FAIL * 2),
+        ("CASCADE|E|orphans\n", "OK|E,D\n"),
+        ("QUERY|D|\n", RESP_FAIL),
+        ("CASCADE|A|\n", "OK|A\n")
+    ]
+    results= runAPITests(cascadeTests)
+    return results
+
+
+def isDump(status, fmt):
+    """Returns: whether <status> is a whole dump in the format <fmt>: a line
+         per package, the harness's B after its dependency A, then a last
+         line counting the packages (and the responses pipelined after it)."""
+    lines= status.split("\n")
+    if lines[-4:] != ["OK|%d" % (len(lines) - 4), "OK", "OK", ""]:
+        return False
+    if fmt == "native":
+        names= [line.split("|")[1] for line in lines[:-4]]
+        return "INDEX|B|A" in lines and names.index("A") < names.index("B")
+    names= [json.loads(line)["name"] for line in lines[:-4]]
+    return {"name": "B", "deps": ["A"]} in [json.loads(line) for line in lines[:-4]] and \
+        names.index("A") < names.index("B")
+
+
+def testDump():
+    print "\nTesting dumps..."
+    dumpTests= [
+        ("INDEX|A|\nINDEX|B|A\n", RESP_OK * 2),
+        ("DUMP|native|\nREMOVE|B|\nINDEX|B|A\n", lambda status: isDump(status, "native")),
+        ("DUMP|ndjson|\nREMOVE|B|\nINDEX|B|A\n", lambda status: isDump(status, "ndjson")),
+        ("DUMP|xml|\n", RESP_ERR),
+        ("DUMP|native|x\n", RESP_ERR),
+        ("REMOVE|B|\nREMOVE|A|\n", RESP_OK * 2)
+    ]
+    results= runAPITests(dumpTests)
+    return results
+
+
+def isJsonResponse(status, jsonType):
+    """Returns: whether <status> is OK, followed by one line of JSON that
+         decodes to a <jsonType>."""
+    if not status.startswith("OK|") or status.count("\n") != 1 or not status.endswith("\n"):
+        return False
+    try:
+        return type(json.loads(status[3:])) is jsonType
+    except ValueError:
+        return False
+
+
+def countsMalformed(status, numMalformed):
+    """Returns: whether <status> answers STATS, then <numMalformed> malformed
+         commands, then STATS again, which counted them as malformed."""
+    lines= status.split("\n")
+    if len(lines) != numMalformed + 3 or lines[1:-2] != [RESP_ERR.strip()] * numMalformed:
+        return False
+    if not isJsonResponse(lines[0] + "\n", dict) or not isJsonResponse(lines[-2] + "\n", dict):
+        return False
+    (before, after)= [json.loads(line[3:])["counters"].get("malformed", 0) for line in (lines[0], lines[-2])]
+    return after - before == numMalformed
+
+
+def testMetrics():
+    print "\nTesting metrics and tracing commands..."
+    metricsTests= [
+        ("STATS||\n", lambda status: isJsonResponse(status, dict) and
+            "counters" in json.loads(status[3:])),
+        ("SLOWLOG||\n", lambda status: isJsonResponse(status, list)),
+        ("STATS|x|\n", RESP_ERR),
+        ("SLOWLOG|1|\n", RESP_ERR),
+        ("PROFILE|0|\n", RESP_ERR),
+        ("PROFILE|x|\n", RESP_ERR),
+        ("TRACE|off|\n", RESP_OK),
+        ("TRACE|loud|\n", RESP_ERR),
+        ("TRACE||\n", RESP_ERR),
+        ("STATS||\nUSE||\nUSE|a|b\nDUMP|xml|\nSTATS||\n", lambda status: countsMalformed(status, 3))
+    ]
+    results= runAPITests(metricsTests)
+    return results
+
+
+def isEveryQueryAnswered(status, numQueries):
+    """Returns: whether <status> answers all <numQueries> QUERYs, each one
+         with either OK or FAIL."""
+    return status.count("\n") == numQueries and \
+        status.replace(RESP_OK, "").replace(RESP_FAIL, "") == ""
+
+
+def testConcurrentQueries():
+    print "\nTesting queries racing with writes..."
+    #Few enough writes that even when each one is forwarded to the writer
+    #(with --workers), a packet's worth of responses comes within the timeout
+    numWrites= 1000
+    numQueries= 5000
+    raceTests= [
+        (("INDEX|R|\nREMOVE|R|\n" * numWrites), RESP_OK * (2 * numWrites)),
+        (("QUERY|R|\n" * numQueries), lambda status: isEveryQueryAnswered(status, numQueries)),
+        (("INDEX|R|\nREMOVE|R|\n" * numWrites), RESP_OK * (2 * numWrites)),
+        (("QUERY|R|\n" * numQueries), lambda status: isEveryQueryAnswered(status, numQueries))
+    ]
+    results= runAPITests(raceTests, canParallel=True)
+    return results
+
+
 def testMaxSessionLen():
     print "\nTesting session duration..."
     timeInSession= 0.0
@@ -306,7 +516,15 @@ def main():
         testIndex,
         testRemove,
         testQuery,
-        testCycles
+        testCycles,
+        testPipelining,
+        testBatches,
+        testUse,
+        testTraversals,
+        testCascade,
+        testDump,
+        testMetrics,
+        testConcurrentQueries,
         #testMaxSessionLen
     ]
     numPasses= 0
@@ -0,0 +1,149 @@
+#tracing.py
+"""Levelled, structured trace points for the indexer, in place of a separate
+copy of the server with prints in it.  A trace point is written as
+
+    if tracing.debugOn:
+        tracing.emit(tracing.DEBUG, "index.create", package=pkg)
+
+so while its level is off it costs one attribute check, and its fields are
+never even built.  An emitted event is only appended to an in-memory ring
+buffer; a writer thread drains it every FLUSH_SECS and writes the events as
+JSON lines, so a server under load never waits on the output.  If the
+writer falls behind, the oldest events are overwritten, and it writes how
+many were dropped in their place (roughly: concurrent drops aren't counted
+under a lock).  The level can be changed at any time
+(eg: by the TRACE command)."""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from collections import deque
+from threading import Lock, Thread
+
+#-------------------------- Constants -----------------------------
+OFF= 0
+INFO= 1         #thread and session lifecycle, and other server events
+DEBUG= 2        #every command and its result, and the steps INDEX and REMOVE take
+TRACE= 3        #the internals of cycle checks
+LEVEL_NAMES= ("off", "info", "debug", "trace")
+RING_MAX_EVENTS= 65536      #events buffered for the writer; older ones are dropped past this
+FLUSH_SECS= 0.1             #how often the writer drains the ring buffer
+
+
+#--------------------------- Classes ------------------------------
+class TraceWriter(Thread):
+    def __init__(self, out):
+        """Class to serve as the thread that drains the ring buffer into the
+             file <out>, every FLUSH_SECS, until the process exits."""
+        Thread.__init__(self)
+        self.daemon= True
+        self.out= out
+
+    def run(self):
+        while True:
+            time.sleep(FLUSH_SECS)
+            flush()
+
+
+#------------------------- Global State ---------------------------
+level= OFF
+infoOn= False
+debugOn= False
+traceOn= False
+events= deque(maxlen=RING_MAX_EVENTS)    #appends are atomic, so emitters take no lock
+numDropped= 0
+numReported= 0
+outPath= None
+writer= None
+writerLock= Lock()
+
+
+#-------------------------- Functions -----------------------------
+def emit(eventLevel, event, **fields):
+    """Appends the event named <event>, with <fields>, to the ring buffer.
+       Precondition: eventLevel is at most the current level (ie: the caller
+         checked the matching infoOn/debugOn/traceOn flag)."""
+    global numDropped
+    if len(events) == RING_MAX_EVENTS:
+        numDropped+= 1
+    events.append((time.time(), eventLevel, threading.current_thread().name, event, fields))
+
+
+def getLevel(name):
+    """Returns: level number of the level named <name> (eg: "debug"), or
+         None if there's no such level."""
+    if name not in LEVEL_NAMES:
+        return None
+    return LEVEL_NAMES.index(name)
+
+
+def setLevel(newLevel):
+    """Makes every trace point at or below <newLevel> emit from now on, and
+         starts the writer thread if it isn't running yet.
+       Precondition: newLevel is one of OFF, INFO, DEBUG or TRACE."""
+    global level, infoOn, debugOn, traceOn, writer
+    #Turning tracing off is traced too, as the last event before the gap
+    if infoOn or newLevel >= INFO:
+        emit(INFO, "trace.level", traceLevel=LEVEL_NAMES[newLevel])
+    with writerLock:
+        if newLevel > OFF and writer == None:
+            out= sys.stdout
+            if outPath != None:
+                out= open(outPath, "a")
+            writer= TraceWriter(out)
+            writer.start()
+        (infoOn, debugOn, traceOn)= (newLevel >= INFO, newLevel >= DEBUG, newLevel >= TRACE)
+        level= newLevel
+
+
+def setOutput(path):
+    """Makes the writer append to the file at <path> instead of stdout.
+       Precondition: the writer hasn't been started yet."""
+    global outPath
+    outPath= path
+
+
+def flush():
+    """Writes every event in the ring buffer, oldest first, as one line of
+         JSON each, after a note of how many were dropped since the last
+         flush, if any."""
+    global numReported
+    with writerLock:
+        if writer == None:
+            return
+        lines= []
+        pid= os.getpid()
+        if numDropped != numReported:
+            lines.append(json.dumps({"ts": round(time.time(), 6), "pid": pid, "level": "info",
+                "event": "trace.dropped", "count": numDropped - numReported}, sort_keys=True))
+            numReported= numDropped
+        while True:
+            try:
+                (timestamp, eventLevel, threadName, event, fields)= events.popleft()
+            except IndexError:
+                break
+            record= dict(fields)
+            record.update({"ts": round(timestamp, 6), "pid": pid, "level": LEVEL_NAMES[eventLevel],
+                "thread": threadName, "event": event})
+            lines.append(json.dumps(record, sort_keys=True, default=str))
+        if len(lines) > 0:
+            writer.out.write("\n".join(lines) + "\n")
+            writer.out.flush()
+
+
+def afterFork():
+    """Restarts tracing in a newly forked child process (eg: a worker), which
+         only inherits the thread that forked it: drops the parent's unwritten
+         events, and starts a writer of its own if tracing is on."""
+    global writer, writerLock, numReported
+    writerLock= Lock()
+    writer= None
+    events.clear()
+    numReported= numDropped
+    setLevel(level)
+
+
+atexit.register(flush)